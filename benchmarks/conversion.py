@@ -0,0 +1,269 @@
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import zipfile
+import zlib
+
+from PIL import Image, ImageDraw
+from rich.console import Console
+from rich.table import Table
+
+from benchmarks.environment import BenchmarkEnvironment
+from benchmarks.library import make_epub_bytes
+
+# Conversion benchmarks with regression guardrails :
+#   python -m benchmarks.conversion                     # compare against benchmarks/baselines/conversion.json
+#   python -m benchmarks.conversion --update-baselines  # record new baselines
+# Each case runs in a fresh process so that peak RSS is measured for that case only (imports included).
+# Shared machines get faster or slower from one minute to the next : each run also times a fixed reference workload right
+# before the case, and the case time relative to it is what gets compared. Cases are run several times, medians are compared
+# (baselines are recorded the same way).
+
+BASELINES_FILE = os.path.join(os.path.dirname(__file__), "baselines", "conversion.json")
+
+# (width, height, format) of the generated pages, picked in turn
+PAGE_VARIANTS = [
+    (800, 1200, "JPEG"),
+    (1200, 1800, "JPEG"),
+    (960, 1440, "PNG"),
+    (1600, 2400, "JPEG"),
+    (720, 1080, "PNG")
+]
+
+CASES = ["merge_cbz_to_epub", "epubmaker_run", "merge_epubs_to_epub"]
+
+def make_page(rng: random.Random, width: int, height: int, image_format: str):
+    # Some panels, borders and text-like strokes, so that encoders have realistic work to do
+    image = Image.new("L", (width, height), 255)
+    draw = ImageDraw.Draw(image)
+    for _ in range(rng.randint(3, 6)):
+        x0, y0 = rng.randint(0, width // 2), rng.randint(0, height // 2)
+        x1, y1 = rng.randint(x0 + 50, width), rng.randint(y0 + 50, height)
+        draw.rectangle((x0, y0, x1, y1), outline=0, width=4, fill=rng.randint(180, 255))
+        for _ in range(rng.randint(5, 20)):
+            lx, ly = rng.randint(x0, x1), rng.randint(y0, y1)
+            draw.line((lx, ly, lx + rng.randint(-80, 80), ly + rng.randint(-80, 80)), fill=rng.randint(0, 120), width=rng.randint(1, 3))
+
+    buffer = io.BytesIO()
+    image.save(buffer, format=image_format)
+    return buffer.getvalue(), ".jpg" if image_format == "JPEG" else ".png"
+
+def generate_cbz_chapters(directory: str, chapters: int, pages_per_chapter: int, seed: int):
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+
+    variant = 0
+    for chapter_id in range(1, chapters + 1):
+        with zipfile.ZipFile(os.path.join(directory, f"Benchmark Chapter {chapter_id}.cbz"), "w") as cbz:
+            pages_info = ""
+            for page in range(pages_per_chapter):
+                width, height, image_format = PAGE_VARIANTS[variant % len(PAGE_VARIANTS)]
+                variant += 1
+                data, extension = make_page(rng, width, height, image_format)
+                cbz.writestr(f"{page + 1:03d}{extension}", data)
+                pages_info += f'<Page Image="{page}" ImageWidth="{width}" ImageHeight="{height}" ImageSize="{len(data)}"/>'
+            cbz.writestr("ComicInfo.xml", f'<?xml version="1.0"?><ComicInfo><Writer>Benchmark</Writer><Series>Benchmark</Series><Number>{chapter_id}</Number><Pages>{pages_info}</Pages></ComicInfo>')
+
+def generate_lightnovel_chapters(directory: str, chapters: int, paragraphs: int):
+    os.makedirs(directory, exist_ok=True)
+    for chapter_id in range(1, chapters + 1):
+        with open(os.path.join(directory, f"Benchmark Chapter {chapter_id}.epub"), "wb") as f:
+            f.write(make_epub_bytes(f"Chapter {chapter_id}", paragraphs, resources=True))
+
+def unzip_chapters(source_dir: str, target_dir: str):
+    for filename in os.listdir(source_dir):
+        if filename.endswith(".cbz"):
+            with zipfile.ZipFile(os.path.join(source_dir, filename)) as cbz:
+                cbz.extractall(os.path.join(target_dir, os.path.splitext(filename)[0]))
+
+def max_rss():
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+def reference_workload():
+    # Same kind of work as the conversions (image encoding, deflate, Python loops), its time tells how fast the machine is right now
+    rng = random.Random(0)
+    start = time.perf_counter()
+    for _ in range(3):
+        data, _ = make_page(rng, 1200, 1800, "JPEG")
+        zlib.compress(data * 4, 6)
+        sum(len(str(i)) for i in range(200000))
+    return time.perf_counter() - start
+
+def run_case(case: str, input_dir: str, workdir: str, results):
+    # Runs in a child process
+    from books.converter import Converter
+    from books.formats.epub import EPubMaker
+    from books.models.manga import Manga
+    from books.models.lightnovel import Lightnovel
+
+    shutil.copytree(input_dir, workdir)
+    reference_time = reference_workload()
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        if case == "merge_cbz_to_epub":
+            start = time.perf_counter()
+            output = Converter.merge_cbz_to_epub(Manga("Benchmark", "benchmark"), workdir)
+            wall_time = time.perf_counter() - start
+
+        elif case == "epubmaker_run":
+            images_dir = os.path.join(workdir, "images")
+            unzip_chapters(workdir, images_dir)
+            output = os.path.join(workdir, "Benchmark.epub")
+            start = time.perf_counter()
+            EPubMaker(master=None, input_dir=images_dir, file=output, name="Benchmark", author="Benchmark", wrap_pages=True, grayscale=False, max_width=None, max_height=None).run()
+            wall_time = time.perf_counter() - start
+
+        else:
+            start = time.perf_counter()
+            output = Converter.merge_epubs_to_epub(Lightnovel("Benchmark"), workdir)
+            wall_time = time.perf_counter() - start
+
+    # Timed again afterwards, the machine may have changed pace during the case
+    reference_time = (reference_time + reference_workload()) / 2
+
+    results.put({
+        "wall_time": wall_time,
+        "reference_time": reference_time,
+        "peak_rss": max_rss(),
+        "output_size": os.path.getsize(output) if output and os.path.isfile(output) else None
+    })
+
+def measure_case(case: str, input_dir: str, workdir: str, units: int, repeat: int):
+    context = multiprocessing.get_context("spawn")
+    runs = []
+
+    for idx in range(repeat):
+        results = context.Queue()
+        process = context.Process(target=run_case, args=(case, input_dir, os.path.join(workdir, f"{case}-{idx}"), results))
+        process.start()
+        run = results.get()
+        process.join()
+        runs.append(run)
+
+    # Medians, a single run disturbed by the rest of the machine doesn't move them
+    wall_time = statistics.median(run["wall_time"] for run in runs)
+    return {
+        "units_per_second": units / wall_time,
+        "wall_time": wall_time,
+        "relative_time": statistics.median(run["wall_time"] / run["reference_time"] for run in runs),
+        "peak_rss": statistics.median(run["peak_rss"] for run in runs),
+        "output_size": runs[0]["output_size"]
+    }
+
+def compare(case: str, result: dict, baseline: dict, threshold: float):
+    regressions = []
+    if not baseline:
+        return regressions
+
+    if result["relative_time"] > baseline["relative_time"] * (1 + threshold):
+        regressions.append(f"{case}: {result['relative_time']:.2f}x the reference workload time > baseline {baseline['relative_time']:.2f}x")
+    if result["peak_rss"] > baseline["peak_rss"] * (1 + threshold):
+        regressions.append(f"{case}: peak RSS {result['peak_rss'] / 1024 / 1024:.1f} MiB > baseline {baseline['peak_rss'] / 1024 / 1024:.1f} MiB")
+    if result["output_size"] is None or (baseline["output_size"] and result["output_size"] > baseline["output_size"] * (1 + threshold)):
+        regressions.append(f"{case}: output size {result['output_size']} > baseline {baseline['output_size']}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark CBZ->EPUB conversion and lightnovel EPUB merges")
+    parser.add_argument("--chapters", type=int, default=20, help="Number of generated manga chapters")
+    parser.add_argument("--pages", type=int, default=25, help="Number of pages per manga chapter")
+    parser.add_argument("--lightnovel-chapters", type=int, default=300, help="Number of generated lightnovel chapters")
+    parser.add_argument("--paragraphs", type=int, default=200, help="Number of paragraphs per lightnovel chapter")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of runs per case, their median is kept")
+    parser.add_argument("--threshold", type=float, default=0.25, help="Allowed relative regression before failing")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--baselines", default=BASELINES_FILE, help="Baselines file")
+    parser.add_argument("--update-baselines", action="store_true", help="Store the results as the new baselines")
+    parser.add_argument("--case", action="append", choices=CASES, help="Only run these cases")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="covertheair-conversion-bench-")
+    try:
+        # The converter needs a configuration to import, the SFTP stand-ins are not needed here
+        env = BenchmarkEnvironment(workdir=os.path.join(workdir, "env"))
+        os.makedirs(env.data_dir, exist_ok=True)
+        env.write_config(0, 0)
+
+        manga_dir = os.path.join(workdir, "manga")
+        lightnovel_dir = os.path.join(workdir, "lightnovel")
+        generate_cbz_chapters(manga_dir, args.chapters, args.pages, args.seed)
+        generate_lightnovel_chapters(lightnovel_dir, args.lightnovel_chapters, args.paragraphs)
+
+        inputs = {
+            "merge_cbz_to_epub": (manga_dir, args.chapters * args.pages, "pages"),
+            "epubmaker_run": (manga_dir, args.chapters * args.pages, "pages"),
+            "merge_epubs_to_epub": (lightnovel_dir, args.lightnovel_chapters, "chapters")
+        }
+
+        baselines = {}
+        if os.path.isfile(args.baselines):
+            with open(args.baselines) as f:
+                baselines = json.load(f)
+
+        parameters = {key: getattr(args, key) for key in ["chapters", "pages", "lightnovel_chapters", "paragraphs", "seed"]}
+        if baselines and baselines.get("parameters") != parameters:
+            if not args.update_baselines:
+                Console().print("[yellow]Parameters differ from the ones used for the baselines, results are not comparable[/yellow]")
+            baselines = {}
+
+        table = Table(title="Conversion benchmark")
+        for column in ["Case", "Throughput", "Wall time (s)", "Relative time", "Baseline", "Peak RSS (MiB)", "Output size (KiB)"]:
+            table.add_column(column, justify="left" if column == "Case" else "right")
+
+        results = {}
+        regressions = []
+        for case in args.case or CASES:
+            input_dir, units, unit_name = inputs[case]
+            result = measure_case(case, input_dir, os.path.join(workdir, "runs"), units, args.repeat)
+            results[case] = result
+
+            baseline = baselines.get("cases", {}).get(case)
+            if baseline and "relative_time" not in baseline:
+                # Recorded before relative times, it needs to be recorded again
+                baseline = None
+            regressions.extend(compare(case, result, baseline, args.threshold))
+            # Just as far off in the other direction, the baseline doesn't tell much anymore
+            if baseline and result["relative_time"] < baseline["relative_time"] * (1 - args.threshold):
+                Console().print(f"[yellow]{case} is much faster than its baseline, it may need to be recorded again[/yellow]")
+
+            table.add_row(
+                case,
+                f"{result['units_per_second']:.1f} {unit_name}/s",
+                f"{result['wall_time']:.2f}",
+                f"{result['relative_time']:.2f}x",
+                f"{baseline['relative_time']:.2f}x" if baseline else "-",
+                f"{result['peak_rss'] / 1024 / 1024:.1f}",
+                f"{(result['output_size'] or 0) / 1024:.0f}"
+            )
+
+        Console().print(table)
+
+        if args.update_baselines:
+            os.makedirs(os.path.dirname(args.baselines), exist_ok=True)
+            with open(args.baselines, "w") as f:
+                json.dump({"parameters": parameters, "cases": {**baselines.get("cases", {}), **results}}, f, indent=4)
+            Console().print(f"Baselines written to {args.baselines}")
+
+        elif regressions:
+            for regression in regressions:
+                Console().print(f"[red]REGRESSION[/red] {regression}")
+            sys.exit(1)
+
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+import configparser
+import os
+import shutil
+import tempfile
+from typing import List
+
+import paramiko
+
+from benchmarks.library import MANGAS_DIR, LIGHTNOVELS_DIR, EBOOKS_DIR
+from benchmarks.sftp_server import LocalSftpServer
+
+MEDIA_SERVER_USERNAME = "media"
+MEDIA_SERVER_PASSWORD = "benchmark"
+EBOOK_READER_USERNAME = "reader"
+EBOOK_READER_BASE_PATH = "/books"
+
+# Self-contained CoverTheAir setup for benchmarks : a working directory holding the synthetic library, the data files,
+# and the reader storage, two local SFTP stand-ins (media server and ebook reader), and a cota.cfg pointing at them.
+# The configuration is exported through COTA_CONFIG, so start the environment BEFORE importing anything that imports config.
+class BenchmarkEnvironment:
+
+    def __init__(self, workdir: str = None, keep: bool = False, log_level: str = "WARNING", media_server_backend: str = "sftp", ebook_readers: int = 1):
+        self.workdir = workdir or tempfile.mkdtemp(prefix="covertheair-bench-")
+        self.keep = keep or workdir is not None
+        self.log_level = log_level
+        self.media_server_backend = media_server_backend
+
+        self.library_root = os.path.join(self.workdir, "library")
+        self.reader_root = os.path.join(self.workdir, "reader")
+        # Other readers (see [ebook_reader.<name>] sections) get reader-2, reader-3, ...
+        self.extra_reader_roots = [os.path.join(self.workdir, f"reader-{i}") for i in range(2, ebook_readers + 1)]
+        self.data_dir = os.path.join(self.workdir, "data")
+        self.config_file = os.path.join(self.workdir, "cota.cfg")
+        self.reader_pkey_file = os.path.join(self.data_dir, "reader_rsa")
+
+        self.media_server: LocalSftpServer = None
+        self.ebook_reader: LocalSftpServer = None
+        self.extra_ebook_readers: List[LocalSftpServer] = []
+
+    def start(self, media_server_port: int = None, ebook_reader_port: int = None):
+        for directory in [self.library_root, self.data_dir]:
+            os.makedirs(directory, exist_ok=True)
+        for reader_root in [self.reader_root] + self.extra_reader_roots:
+            os.makedirs(os.path.join(reader_root, EBOOK_READER_BASE_PATH.lstrip("/")), exist_ok=True)
+        for directory in [MANGAS_DIR, LIGHTNOVELS_DIR, EBOOKS_DIR]:
+            os.makedirs(os.path.join(self.library_root, directory), exist_ok=True)
+
+        host_key = paramiko.RSAKey.generate(2048)
+        reader_key = paramiko.RSAKey.generate(2048)
+        reader_key.write_private_key_file(self.reader_pkey_file)
+
+        self.media_server = LocalSftpServer(self.library_root, MEDIA_SERVER_USERNAME, password=MEDIA_SERVER_PASSWORD, host_key=host_key).start()
+        self.ebook_reader = LocalSftpServer(self.reader_root, EBOOK_READER_USERNAME, authorized_key=reader_key, host_key=host_key).start()
+        self.extra_ebook_readers = [LocalSftpServer(reader_root, EBOOK_READER_USERNAME, authorized_key=reader_key, host_key=host_key).start() for reader_root in self.extra_reader_roots]
+
+        # Ports can be overridden to put something in between (see benchmarks.netem)
+        self.write_config(media_server_port or self.media_server.port, ebook_reader_port or self.ebook_reader.port)
+        return self
+
+    def stop(self):
+        if self.media_server:
+            self.media_server.stop()
+        if self.ebook_reader:
+            self.ebook_reader.stop()
+        for ebook_reader in self.extra_ebook_readers:
+            ebook_reader.stop()
+        if not self.keep:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def write_config(self, media_server_port: int, ebook_reader_port: int):
+        settings = configparser.ConfigParser()
+
+        # Absolute paths are kept as is by config.store_in_data_folder
+        settings["general"] = {
+            "application_name": "CoverTheAir",
+            "downloads_dir": os.path.join(self.data_dir, "downloads"),
+            "local_uploads_dir": os.path.join(self.data_dir, "uploads"),
+            "logfile": os.path.join(self.data_dir, "covertheair.log"),
+            "log_level": self.log_level,
+            "comicinfo_cache": os.path.join(self.data_dir, "comicinfo.json"),
+            "volumes_dir": os.path.join(self.data_dir, "volumes"),
+            "reader_tuning": os.path.join(self.data_dir, "reader_tuning.json")
+        }
+        settings["daemon"] = {
+            "ready_dir": os.path.join(self.data_dir, "ready")
+        }
+        settings["tracked_books"] = {
+            "manga": os.path.join(self.data_dir, "mangas.json"),
+            "lightnovel": os.path.join(self.data_dir, "lightnovels.json"),
+            "ebook": os.path.join(self.data_dir, "ebooks.json")
+        }
+        # The local backend reads the library directly, the SFTP one through the stand-in which serves library_root as /
+        library_root = self.library_root if self.media_server_backend == "local" else ""
+        settings["media_server"] = {
+            "backend": self.media_server_backend,
+            "ip": "127.0.0.1",
+            "port": str(media_server_port),
+            "username": MEDIA_SERVER_USERNAME,
+            "password": MEDIA_SERVER_PASSWORD,
+            "path_to_mangas": library_root + "/" + MANGAS_DIR,
+            "path_to_lightnovels": library_root + "/" + LIGHTNOVELS_DIR,
+            "path_to_ebooks": library_root + "/" + EBOOKS_DIR
+        }
+        settings["ebook_reader"] = {
+            "ip": "127.0.0.1",
+            "port": str(ebook_reader_port),
+            "username": EBOOK_READER_USERNAME,
+            "pkey": self.reader_pkey_file,
+            "base_path": EBOOK_READER_BASE_PATH
+        }
+        for i, ebook_reader in enumerate(self.extra_ebook_readers, start=2):
+            settings[f"ebook_reader.reader-{i}"] = {
+                "ip": "127.0.0.1",
+                "port": str(ebook_reader.port),
+                "username": EBOOK_READER_USERNAME,
+                "pkey": self.reader_pkey_file,
+                "base_path": EBOOK_READER_BASE_PATH
+            }
+
+        with open(self.config_file, "w") as f:
+            settings.write(f)
+
+        os.makedirs(os.path.join(self.data_dir, "downloads"), exist_ok=True)
+        os.environ["COTA_CONFIG"] = self.config_file
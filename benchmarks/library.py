@@ -0,0 +1,137 @@
+import io
+import os
+import shutil
+import zipfile
+
+from PIL import Image
+
+# Synthetic media server tree, laid out the way MediaServer expects it :
+#   <root>/mangas/<source>/<title>/<title> Chapter <n>.cbz
+#   <root>/lightnovels/<title>/<title> Chapter <n>.epub
+#   <root>/ebooks/<series>/<book>.epub
+# Every chapter is a hardlink to the same small template file so that 100k chapters stay cheap to generate.
+
+MANGAS_DIR = "mangas"
+LIGHTNOVELS_DIR = "lightnovels"
+EBOOKS_DIR = "ebooks"
+
+def manga_title(source_id: int, title_id: int):
+    return f"Manga {source_id:03d}-{title_id:04d}"
+
+def manga_chapter_name(title: str, chapter_id: int):
+    return f"{title} Chapter {chapter_id}.cbz"
+
+def lightnovel_title(title_id: int):
+    return f"Lightnovel {title_id:04d}"
+
+def lightnovel_chapter_name(title: str, chapter_id: int):
+    return f"{title} Chapter {chapter_id}.epub"
+
+def make_cbz_bytes(pages: int = 2, width: int = 64, height: int = 96):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as cbz:
+        for page in range(pages):
+            image = Image.new("L", (width, height), 255)
+            image_buffer = io.BytesIO()
+            image.save(image_buffer, format="PNG")
+            cbz.writestr(f"{page + 1:03d}.png", image_buffer.getvalue())
+
+        pages_info = "".join(f'<Page Image="{page}" ImageWidth="{width}" ImageHeight="{height}"/>' for page in range(pages))
+        cbz.writestr("ComicInfo.xml", f'<?xml version="1.0"?><ComicInfo><Writer>Benchmark</Writer><Pages>{pages_info}</Pages></ComicInfo>')
+    return buffer.getvalue()
+
+# Shared by every chapter generated with resources, the way a whole novel embeds the same font and stylesheet
+CHAPTER_FONT = bytes(range(256)) * 256  # Not a real font, only its size matters
+CHAPTER_STYLESHEET = '@font-face { font-family: "Novel"; src: url("../Fonts/novel.ttf"); } p { font-family: "Novel"; }'
+
+def make_epub_bytes(title: str = "Chapter 1", paragraphs: int = 20, resources: bool = False):
+    body = "".join(f"<p>Paragraph {idx} of {title}.</p>" for idx in range(paragraphs))
+
+    # With resources, the chapter uses a stylesheet, a font and an illustration of its own
+    chapter_name = f"{title}.xhtml"
+    head = f'<title>{title}</title>' + ('<link href="Styles/style.css" rel="stylesheet" type="text/css"/>' if resources else "")
+    if resources:
+        body = f'<img src="Images/illustration.png" alt=""/>{body}'
+    manifest = f'<item id="chapter" href="{chapter_name}" media-type="application/xhtml+xml"/><item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>'
+    if resources:
+        manifest += '<item id="style" href="Styles/style.css" media-type="text/css"/><item id="font" href="Fonts/novel.ttf" media-type="application/x-font-ttf"/><item id="illustration" href="Images/illustration.png" media-type="image/png"/>'
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as epub:
+        epub.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        epub.writestr("META-INF/container.xml", '<?xml version="1.0"?><container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container"><rootfiles><rootfile full-path="content.opf" media-type="application/oebps-package+xml"/></rootfiles></container>')
+        epub.writestr("content.opf", f'<?xml version="1.0" encoding="utf-8"?><package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="id"><metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:identifier id="id">{title}</dc:identifier><dc:title>{title}</dc:title><dc:language>en</dc:language><dc:creator>Benchmark</dc:creator></metadata><manifest>{manifest}</manifest><spine><itemref idref="chapter"/></spine></package>')
+        epub.writestr("nav.xhtml", f'<?xml version="1.0" encoding="utf-8"?><html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops"><head><title>{title}</title></head><body><nav epub:type="toc"><ol><li><a href="{chapter_name}">{title}</a></li></ol></nav></body></html>')
+        epub.writestr(chapter_name, f'<?xml version="1.0" encoding="utf-8"?><html xmlns="http://www.w3.org/1999/xhtml"><head>{head}</head><body><h2>{title}</h2>{body}</body></html>')
+        if resources:
+            image = io.BytesIO()
+            Image.new("L", (64, 96), 128).save(image, format="PNG")
+            epub.writestr("Styles/style.css", CHAPTER_STYLESHEET)
+            epub.writestr("Fonts/novel.ttf", CHAPTER_FONT)
+            epub.writestr("Images/illustration.png", image.getvalue())
+    return buffer.getvalue()
+
+def link_or_copy(template: str, target: str):
+    try:
+        os.link(template, target)
+    except OSError:
+        shutil.copyfile(template, target)
+
+class SyntheticLibrary:
+
+    def __init__(self, root: str, sources: int, titles: int, chapters: int, lightnovels: int = 0, lightnovel_chapters: int = 0, ebook_series: int = 0, ebooks_per_series: int = 0):
+        self.root = root
+        self.sources = sources
+        self.titles = titles
+        self.chapters = chapters
+        self.lightnovels = lightnovels
+        self.lightnovel_chapters = lightnovel_chapters
+        self.ebook_series = ebook_series
+        self.ebooks_per_series = ebooks_per_series
+
+        self.cbz_template = os.path.join(root, ".template.cbz")
+        self.epub_template = os.path.join(root, ".template.epub")
+
+    @property
+    def manga_chapters_count(self):
+        return self.sources * self.titles * self.chapters
+
+    def generate(self):
+        os.makedirs(self.root, exist_ok=True)
+
+        with open(self.cbz_template, "wb") as f:
+            f.write(make_cbz_bytes())
+        with open(self.epub_template, "wb") as f:
+            f.write(make_epub_bytes())
+
+        for source_id in range(self.sources):
+            for title_id in range(self.titles):
+                self.add_manga_chapters(source_id, title_id, 1, self.chapters)
+
+        for title_id in range(self.lightnovels):
+            self.add_lightnovel_chapters(title_id, 1, self.lightnovel_chapters)
+
+        for series_id in range(self.ebook_series):
+            series_dir = os.path.join(self.root, EBOOKS_DIR, f"Series {series_id:03d}")
+            os.makedirs(series_dir, exist_ok=True)
+            for book_id in range(self.ebooks_per_series):
+                link_or_copy(self.epub_template, os.path.join(series_dir, f"Series {series_id:03d} Book {book_id + 1}.epub"))
+
+        os.makedirs(os.path.join(self.root, LIGHTNOVELS_DIR), exist_ok=True)
+        os.makedirs(os.path.join(self.root, EBOOKS_DIR), exist_ok=True)
+        return self
+
+    def manga_dir(self, source_id: int, title_id: int):
+        return os.path.join(self.root, MANGAS_DIR, f"Source {source_id:02d}", manga_title(source_id, title_id))
+
+    def add_manga_chapters(self, source_id: int, title_id: int, first_chapter: int, count: int):
+        title_dir = self.manga_dir(source_id, title_id)
+        os.makedirs(title_dir, exist_ok=True)
+        for chapter_id in range(first_chapter, first_chapter + count):
+            link_or_copy(self.cbz_template, os.path.join(title_dir, manga_chapter_name(manga_title(source_id, title_id), chapter_id)))
+
+    def add_lightnovel_chapters(self, title_id: int, first_chapter: int, count: int):
+        title_dir = os.path.join(self.root, LIGHTNOVELS_DIR, lightnovel_title(title_id))
+        os.makedirs(title_dir, exist_ok=True)
+        for chapter_id in range(first_chapter, first_chapter + count):
+            link_or_copy(self.epub_template, os.path.join(title_dir, lightnovel_chapter_name(lightnovel_title(title_id), chapter_id)))
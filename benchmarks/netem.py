@@ -0,0 +1,286 @@
+import argparse
+import contextlib
+import os
+import random
+import socket
+import threading
+import time
+
+from rich.console import Console
+from rich.table import Table
+
+from benchmarks.environment import BenchmarkEnvironment, EBOOK_READER_BASE_PATH
+from benchmarks.library import SyntheticLibrary
+from benchmarks.sftp_server import LocalSftpServer
+
+# Network condition emulation in front of the local SFTP stand-ins :
+#   python -m benchmarks.netem --preset flaky-wifi
+# Clients connect to an EmulatedLink which relays bytes to the stand-in with latency, jitter, a bandwidth cap
+# and optional mid-transfer disconnects, so transfers can be measured without real hardware.
+
+RELAY_CHUNK_SIZE = 16 * 1024
+
+class NetworkConditions:
+
+    def __init__(self, latency_ms: float = 0, jitter_ms: float = 0, bandwidth_kbps: float = 0, disconnect_after_bytes: int = 0, disconnects: int = 1, seed: int = 42):
+        self.latency_ms = latency_ms            # One-way latency
+        self.jitter_ms = jitter_ms              # Uniform jitter added to the latency of each chunk
+        self.bandwidth_kbps = bandwidth_kbps    # Per-direction cap in kilobits per second, 0 for unlimited
+        self.disconnect_after_bytes = disconnect_after_bytes  # Cut a connection after this many relayed bytes, 0 to never
+        self.disconnects = disconnects          # How many connections get cut before the link behaves again
+        self.random = random.Random(seed)
+
+    def __str__(self):
+        bandwidth = f"{self.bandwidth_kbps / 1000:g} Mbit/s" if self.bandwidth_kbps else "unlimited"
+        disconnect = f", cut after {self.disconnect_after_bytes} B x{self.disconnects}" if self.disconnect_after_bytes else ""
+        return f"{self.latency_ms:g}±{self.jitter_ms:g} ms, {bandwidth}{disconnect}"
+
+PRESETS = {
+    "lan": NetworkConditions(latency_ms=0.5, bandwidth_kbps=500_000),
+    "wifi": NetworkConditions(latency_ms=5, jitter_ms=3, bandwidth_kbps=40_000),
+    "weak-wifi": NetworkConditions(latency_ms=30, jitter_ms=20, bandwidth_kbps=5_000),
+    "flaky-wifi": NetworkConditions(latency_ms=30, jitter_ms=20, bandwidth_kbps=5_000, disconnect_after_bytes=2 * 1024 * 1024)
+}
+
+
+class ShapedDirection(threading.Thread):
+    # Relays one direction of a connection, delaying each chunk according to the link conditions
+
+    def __init__(self, link: "EmulatedLink", connection: "EmulatedConnection", source: socket.socket, target: socket.socket):
+        threading.Thread.__init__(self, daemon=True)
+        self.link = link
+        self.connection = connection
+        self.source = source
+        self.target = target
+        self.pending = []
+        self.pending_lock = threading.Condition()
+        self.link_free_at = 0.0
+        self.closed = False
+
+    def run(self):
+        sender = threading.Thread(target=self.send_loop, daemon=True)
+        sender.start()
+
+        try:
+            while True:
+                data = self.source.recv(RELAY_CHUNK_SIZE)
+                if not data:
+                    break
+                self.schedule(data)
+        except OSError:
+            pass
+
+        with self.pending_lock:
+            self.closed = True
+            self.pending_lock.notify()
+        sender.join()
+        self.connection.close()
+
+    def schedule(self, data: bytes):
+        conditions = self.link.conditions
+        now = time.monotonic()
+
+        # Serialization delay from the bandwidth cap, then propagation delay (chunks are never reordered)
+        transmission_time = len(data) * 8 / (conditions.bandwidth_kbps * 1000) if conditions.bandwidth_kbps else 0
+        self.link_free_at = max(now, self.link_free_at) + transmission_time
+        delay = (conditions.latency_ms + conditions.random.uniform(0, conditions.jitter_ms)) / 1000
+
+        with self.pending_lock:
+            deliver_at = max(self.link_free_at + delay, self.pending[-1][0] if self.pending else 0)
+            self.pending.append((deliver_at, data))
+            self.pending_lock.notify()
+
+    def send_loop(self):
+        while True:
+            with self.pending_lock:
+                while not self.pending and not self.closed:
+                    self.pending_lock.wait()
+                if not self.pending:
+                    return
+                deliver_at, data = self.pending.pop(0)
+
+            wait = deliver_at - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+
+            if not self.connection.relayed(len(data)):
+                return
+            try:
+                self.target.sendall(data)
+            except OSError:
+                self.connection.close()
+                return
+
+
+class EmulatedConnection:
+
+    def __init__(self, link: "EmulatedLink", client: socket.socket):
+        self.link = link
+        self.client = client
+        self.client_side, self.server_side = socket.socketpair()
+        self.relayed_bytes = 0
+        self.lock = threading.Lock()
+        self.cut = link.take_disconnect()
+        self.is_closed = False
+
+    def start(self):
+        ShapedDirection(self.link, self, self.client, self.client_side).start()
+        ShapedDirection(self.link, self, self.client_side, self.client).start()
+        # The SSH handshake needs the relays to be running
+        threading.Thread(target=self.link.server.serve, args=(self.server_side,), daemon=True).start()
+
+    def relayed(self, count: int):
+        # Returns False once the connection has been cut
+        with self.lock:
+            if self.is_closed:
+                return False
+            self.relayed_bytes += count
+            if self.cut and self.relayed_bytes > self.link.conditions.disconnect_after_bytes:
+                self.link.disconnections += 1
+                self._close()
+                return False
+            return True
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    def _close(self):
+        if self.is_closed:
+            return
+        self.is_closed = True
+        for sock in [self.client, self.client_side]:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+
+class EmulatedLink:
+    # Listens on localhost and serves every connection through `server` (a LocalSftpServer) under `conditions`.
+    # Conditions can be swapped between runs, they apply to new chunks immediately.
+
+    def __init__(self, server: LocalSftpServer, conditions: NetworkConditions = None):
+        self.server = server
+        self.conditions = conditions or NetworkConditions()
+        self.remaining_disconnects = 0
+        self.disconnections = 0
+        self.socket = None
+        self.port = None
+        self.lock = threading.Lock()
+
+    def set_conditions(self, conditions: NetworkConditions):
+        with self.lock:
+            self.conditions = conditions
+            self.remaining_disconnects = conditions.disconnects if conditions.disconnect_after_bytes else 0
+            self.disconnections = 0
+
+    def take_disconnect(self):
+        with self.lock:
+            if self.remaining_disconnects > 0:
+                self.remaining_disconnects -= 1
+                return True
+            return False
+
+    def start(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(("127.0.0.1", 0))
+        self.socket.listen(32)
+        self.port = self.socket.getsockname()[1]
+        self.set_conditions(self.conditions)
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        return self
+
+    def stop(self):
+        try:
+            self.socket.close()
+        except OSError:
+            pass
+
+    def _accept_loop(self):
+        while True:
+            try:
+                client, _ = self.socket.accept()
+            except OSError:
+                return
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            EmulatedConnection(self, client).start()
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure transfers to the media server and the ebook reader under emulated network conditions")
+    parser.add_argument("--preset", action="append", choices=PRESETS.keys(), help="Network presets to run (default: all)")
+    parser.add_argument("--latency", type=float, help="Custom one-way latency in ms (replaces the presets)")
+    parser.add_argument("--jitter", type=float, default=0, help="Custom jitter in ms")
+    parser.add_argument("--bandwidth", type=float, default=0, help="Custom bandwidth cap in kbit/s")
+    parser.add_argument("--disconnect-after", type=int, default=0, help="Custom disconnect after this many bytes")
+    parser.add_argument("--upload-size", type=int, default=8, help="Size of the uploaded ebook in MiB")
+    parser.add_argument("--download-chapters", type=int, default=20, help="Number of chapters downloaded from the media server")
+    parser.add_argument("--titles", type=int, default=20, help="Number of mangas in the synthetic library")
+    args = parser.parse_args()
+
+    if args.latency is not None:
+        scenarios = {"custom": NetworkConditions(args.latency, args.jitter, args.bandwidth, args.disconnect_after)}
+    else:
+        scenarios = {name: PRESETS[name] for name in (args.preset or PRESETS.keys())}
+
+    with BenchmarkEnvironment() as env:
+        SyntheticLibrary(env.library_root, sources=1, titles=args.titles, chapters=args.download_chapters).generate()
+
+        media_server_link = EmulatedLink(env.media_server).start()
+        ebook_reader_link = EmulatedLink(env.ebook_reader).start()
+        env.write_config(media_server_link.port, ebook_reader_link.port)
+
+        upload_file = os.path.join(env.data_dir, "upload.epub")
+        with open(upload_file, "wb") as f:
+            f.write(os.urandom(args.upload_size * 1024 * 1024))
+
+        # Imported once the configuration points at the emulated links
+        from connectivity.ebook_reader import EbookReader
+        from managers.manga import MangaManager
+
+        manga_manager = MangaManager()
+
+        table = Table(title="Transfers under emulated network conditions")
+        for column in ["Conditions", "Operation", "Result", "Time (s)", "Throughput", "Disconnects"]:
+            table.add_column(column, justify="left" if column in ["Conditions", "Operation", "Result"] else "right")
+
+        for name, conditions in scenarios.items():
+            label = f"{name} ({conditions})"
+
+            media_server_link.set_conditions(conditions)
+            _, elapsed = timed(manga_manager.update)
+            table.add_row(label, f"MangaManager.update ({args.titles} titles)", "done", f"{elapsed:.2f}", "-", str(media_server_link.disconnections))
+
+            manga = manga_manager.tracked_mangas[0] if manga_manager.tracked_mangas else None
+            if manga:
+                manga.last_read_chapter = 0
+                media_server_link.set_conditions(conditions)
+                target_dir, elapsed = timed(manga_manager.download_chapters_from_media_server, manga, min(args.download_chapters, len(manga.chapters)))
+                downloaded = sum(os.path.getsize(os.path.join(target_dir, f)) for f in os.listdir(target_dir)) if target_dir else 0
+                table.add_row(label, f"MediaServer.get ({args.download_chapters} chapters)", "ok" if target_dir else "failed", f"{elapsed:.2f}", f"{downloaded / elapsed / 1024:.0f} KiB/s", str(media_server_link.disconnections))
+
+            ebook_reader_link.set_conditions(conditions)
+            reader = EbookReader()
+            _, connect_time = timed(reader.connect)
+            success, elapsed = timed(reader.put, upload_file, EBOOK_READER_BASE_PATH + "/upload.epub") if reader.backend.is_connected() else (False, 0)
+            reader.disconnect()
+            size = os.path.getsize(upload_file)
+            table.add_row(label, f"EbookReader.put ({args.upload_size} MiB, connect {connect_time:.2f}s)", "ok" if success else "failed", f"{elapsed:.2f}", f"{size / elapsed / 1024:.0f} KiB/s" if success else "-", str(ebook_reader_link.disconnections))
+
+        media_server_link.stop()
+        ebook_reader_link.stop()
+
+    Console().print(table)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+import os
+import socket
+import threading
+import traceback
+from collections import Counter
+
+import paramiko
+
+# Local SFTP stand-in for the media server and the ebook reader, serving a directory of this machine.
+# Every SFTP request is counted so that benchmarks can report round-trips.
+
+class RequestStats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = Counter()
+
+    def count(self, request: str):
+        with self.lock:
+            self.requests[request] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return Counter(self.requests)
+
+    def reset(self):
+        with self.lock:
+            self.requests.clear()
+
+    def total(self):
+        with self.lock:
+            return sum(self.requests.values())
+
+
+class LocalSftpHandle(paramiko.SFTPHandle):
+
+    def __init__(self, path: str, flags: int, stats: RequestStats):
+        super().__init__(flags)
+        self.path = path
+        self.stats = stats
+
+    def read(self, offset, length):
+        self.stats.count("read")
+        return super().read(offset, length)
+
+    def write(self, offset, data):
+        self.stats.count("write")
+        return super().write(offset, data)
+
+    def stat(self):
+        self.stats.count("fstat")
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat((self.readfile or self.writefile).fileno()))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def close(self):
+        self.stats.count("close")
+        super().close()
+
+
+class LocalSftpInterface(paramiko.SFTPServerInterface):
+
+    def __init__(self, server, root: str, stats: RequestStats, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.root = os.path.realpath(root)
+        self.stats = stats
+
+    def _local_path(self, path: str):
+        return os.path.join(self.root, self.canonicalize(path).lstrip("/"))
+
+    def list_folder(self, path):
+        self.stats.count("listdir")
+        try:
+            local_path = self._local_path(path)
+            entries = []
+            with os.scandir(local_path) as it:
+                for entry in it:
+                    attributes = paramiko.SFTPAttributes.from_stat(entry.stat(follow_symlinks=False))
+                    attributes.filename = entry.name
+                    entries.append(attributes)
+            return entries
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        self.stats.count("stat")
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._local_path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        self.stats.count("lstat")
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.lstat(self._local_path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        self.stats.count("open")
+        local_path = self._local_path(path)
+        try:
+            binary_flag = getattr(os, "O_BINARY", 0)
+            fd = os.open(local_path, flags | binary_flag, 0o644)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+        if flags & os.O_WRONLY:
+            mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            mode = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            mode = "rb"
+
+        try:
+            f = os.fdopen(fd, mode)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+        handle = LocalSftpHandle(local_path, flags, self.stats)
+        handle.filename = local_path
+        handle.readfile = f
+        handle.writefile = f
+        return handle
+
+    def remove(self, path):
+        self.stats.count("remove")
+        try:
+            os.remove(self._local_path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        self.stats.count("rename")
+        try:
+            os.rename(self._local_path(oldpath), self._local_path(newpath))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def posix_rename(self, oldpath, newpath):
+        self.stats.count("posix_rename")
+        try:
+            os.replace(self._local_path(oldpath), self._local_path(newpath))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def mkdir(self, path, attr):
+        self.stats.count("mkdir")
+        try:
+            os.mkdir(self._local_path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rmdir(self, path):
+        self.stats.count("rmdir")
+        try:
+            os.rmdir(self._local_path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def chattr(self, path, attr):
+        self.stats.count("chattr")
+        try:
+            paramiko.SFTPServer.set_file_attr(self._local_path(path), attr)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+
+class LocalSshServer(paramiko.ServerInterface):
+
+    def __init__(self, username: str, password: str = None, authorized_key: paramiko.PKey = None):
+        self.username = username
+        self.password = password
+        self.authorized_key = authorized_key
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_auth_password(self, username, password):
+        if self.password is not None and username == self.username and password == self.password:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_auth_publickey(self, username, key):
+        if self.authorized_key is not None and username == self.username and key == self.authorized_key:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        auths = []
+        if self.password is not None:
+            auths.append("password")
+        if self.authorized_key is not None:
+            auths.append("publickey")
+        return ",".join(auths)
+
+
+# In-process SFTP server listening on localhost and serving root.
+# Use it as a context manager : it picks a free port (see port) and closes every session on exit.
+class LocalSftpServer:
+
+    def __init__(self, root: str, username: str = "covertheair", password: str = None, authorized_key: paramiko.PKey = None, host_key: paramiko.PKey = None):
+        self.root = root
+        self.username = username
+        self.password = password
+        self.authorized_key = authorized_key
+        self.host_key = host_key or paramiko.RSAKey.generate(2048)
+        self.stats = RequestStats()
+
+        self.socket = None
+        self.port = None
+        self.transports = []
+        self.accept_thread = None
+        self.running = False
+
+    def start(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(("127.0.0.1", 0))
+        self.socket.listen(32)
+        self.port = self.socket.getsockname()[1]
+
+        self.running = True
+        self.accept_thread = threading.Thread(target=self._accept_loop, daemon=True)
+        self.accept_thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        try:
+            self.socket.close()
+        except OSError:
+            pass
+
+        for transport in self.transports:
+            transport.close()
+        self.transports = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _accept_loop(self):
+        while self.running:
+            try:
+                client, _ = self.socket.accept()
+            except OSError:
+                return
+
+            threading.Thread(target=self.serve, args=(client,), daemon=True).start()
+
+    def serve(self, client: socket.socket):
+        # Serves an already connected socket, which lets callers put something between the client and us (see benchmarks.netem).
+        # Blocks until the SSH handshake is over.
+        try:
+            self._serve(client)
+        except Exception:
+            traceback.print_exc()
+
+    def _serve(self, client: socket.socket):
+        transport = paramiko.Transport(client)
+        transport.add_server_key(self.host_key)
+        transport.set_subsystem_handler("sftp", paramiko.SFTPServer, LocalSftpInterface, self.root, self.stats)
+        transport.start_server(server=LocalSshServer(self.username, self.password, self.authorized_key))
+        self.transports.append(transport)
@@ -0,0 +1,130 @@
+import argparse
+import contextlib
+import json
+import os
+import time
+
+from rich.console import Console
+from rich.table import Table
+
+from benchmarks.environment import BenchmarkEnvironment
+from benchmarks.library import SyntheticLibrary
+
+# Times the sync path against a synthetic library served by a local SFTP stand-in :
+#   python -m benchmarks.sync --sources 10 --titles 100 --chapters 100
+# Results (wall time and SFTP round-trips per scenario) can be saved with --output to compare changes to the sync path.
+
+class Measurement:
+
+    def __init__(self, name: str, wall_time: float, requests: dict):
+        self.name = name
+        self.wall_time = wall_time
+        self.requests = requests
+
+    @property
+    def round_trips(self):
+        return sum(self.requests.values())
+
+    def to_dict(self):
+        return {"name": self.name, "wall_time": self.wall_time, "round_trips": self.round_trips, "requests": self.requests}
+
+
+def measure(name: str, env: BenchmarkEnvironment, function, *args, **kwargs):
+    env.media_server.stats.reset()
+
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        function(*args, **kwargs)
+    wall_time = time.perf_counter() - start
+
+    return Measurement(name, wall_time, dict(env.media_server.stats.snapshot()))
+
+
+def run(args):
+    results = []
+
+    with BenchmarkEnvironment(workdir=args.workdir, keep=args.keep, media_server_backend=args.backend) as env:
+        library = SyntheticLibrary(
+            env.library_root,
+            sources=args.sources,
+            titles=args.titles,
+            chapters=args.chapters,
+            lightnovels=args.lightnovels,
+            lightnovel_chapters=args.lightnovel_chapters,
+            ebook_series=args.ebook_series,
+            ebooks_per_series=args.ebooks_per_series
+        )
+
+        start = time.perf_counter()
+        library.generate()
+        Console().print(f"Generated {library.manga_chapters_count} manga chapters in {time.perf_counter() - start:.1f}s ({env.workdir})")
+
+        # Managers read the configuration at import time, so they can only be imported once the environment is up
+        from managers.manga import MangaManager
+        from managers.lightnovel import LightnovelManager
+        from managers.ebook import EbookManager
+
+        manga_manager = MangaManager()
+        lightnovel_manager = LightnovelManager()
+        ebook_manager = EbookManager()
+
+        results.append(measure("Full sync (mangas)", env, manga_manager.update))
+        results.append(measure("Full sync (lightnovels)", env, lightnovel_manager.update))
+        results.append(measure("Full sync (ebooks)", env, ebook_manager.update))
+
+        results.append(measure("No-op sync (mangas)", env, manga_manager.update))
+
+        for title_id in range(min(args.updated_titles, args.titles)):
+            library.add_manga_chapters(0, title_id, args.chapters + 1, args.new_chapters)
+        results.append(measure(f"Incremental sync (mangas, {args.updated_titles} titles with new chapters)", env, manga_manager.update))
+
+        manga = next((manga for manga in manga_manager.tracked_mangas if len(manga.chapters) >= args.download_chapters), None)
+        if manga:
+            manga.last_read_chapter = 0
+            results.append(measure(f"Bulk download ({args.download_chapters} chapters)", env, manga_manager.download_chapters_from_media_server, manga, args.download_chapters))
+
+    return results
+
+
+def print_results(results):
+    table = Table(title="Sync benchmark")
+    table.add_column("Scenario")
+    table.add_column("Wall time (s)", justify="right")
+    table.add_column("Round-trips", justify="right")
+    table.add_column("Requests")
+
+    for result in results:
+        requests = ", ".join(f"{name}={count}" for name, count in sorted(result.requests.items()))
+        table.add_row(result.name, f"{result.wall_time:.3f}", str(result.round_trips), requests)
+
+    Console().print(table)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the media server sync path against a synthetic library")
+    parser.add_argument("--sources", type=int, default=10, help="Number of manga sources")
+    parser.add_argument("--titles", type=int, default=100, help="Number of mangas per source")
+    parser.add_argument("--chapters", type=int, default=100, help="Number of chapters per manga")
+    parser.add_argument("--lightnovels", type=int, default=10, help="Number of lightnovels")
+    parser.add_argument("--lightnovel-chapters", type=int, default=100, help="Number of chapters per lightnovel")
+    parser.add_argument("--ebook-series", type=int, default=10, help="Number of ebook series")
+    parser.add_argument("--ebooks-per-series", type=int, default=10, help="Number of ebooks per series")
+    parser.add_argument("--updated-titles", type=int, default=10, help="Number of mangas receiving new chapters before the incremental sync")
+    parser.add_argument("--new-chapters", type=int, default=5, help="Number of new chapters per updated manga")
+    parser.add_argument("--download-chapters", type=int, default=50, help="Number of chapters for the bulk download")
+    parser.add_argument("--backend", choices=["sftp", "local"], default="sftp", help="Media server backend to benchmark")
+    parser.add_argument("--workdir", help="Working directory (kept after the run), defaults to a temporary directory")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary working directory")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = run(args)
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"parameters": vars(args), "results": [result.to_dict() for result in results]}, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
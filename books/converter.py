@@ -1,4 +1,8 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List
+import contextlib
 import os
+import shutil
 import traceback
 from rich.progress import Progress
 from ebooklib import epub, ITEM_DOCUMENT, ITEM_COVER
@@ -6,50 +10,163 @@ from ebooklib import epub, ITEM_DOCUMENT, ITEM_COVER
 from books.models.manga import Manga
 from books.models.lightnovel import Lightnovel
 from books.formats.cbz import Cbz
-from books.formats.epub import EPubMaker
-from utils.comicinfo import ComicInfo
+from books.formats.epub import EPubMaker, natural_keys
+from books.formats.epub_resources import EpubResources
 from utils.log import Log
+from utils.profiler import Profiler
+
+from config import IMAGE_DEDUP, PAGE_CLEANUP, VOLUME_MAX_PAGES, VOLUME_MAX_SIZE
+
+VOLUME_BUILD_WORKERS = os.cpu_count() or 1
 
 class Converter:
 
     @classmethod
+    @Profiler.profiled("merge_cbz_to_epub")
     def merge_cbz_to_epub(self, manga: Manga, directory: str):
         try:
-            author = ""
-
-            for idx, cbz_filename in enumerate([filename for filename in  os.listdir(directory) if filename.endswith(".cbz")]):
-                cbz = Cbz(os.path.join(directory, cbz_filename))
-                output_directory = cbz.unzip()
-                
-                # We try to find the writer by parsing ComicInfo.xml from the 1st downloaded chapter
-                if idx == 0:
-                    for filename in os.listdir(output_directory):
-                        if filename.lower() == "comicinfo.xml":
-                            comic_info = ComicInfo(os.path.join(output_directory, filename))
-                            author = comic_info.get_writer()
-            
-            epub_file = os.path.join(directory, manga.title.replace(" ","_") + ".epub")
-            
-            EPubMaker(
-                master=None,
-                input_dir=directory,
-                file=epub_file,
-                name=manga.title,
-                author=author,
-                wrap_pages=True,
-                grayscale=False,
-                max_width=None,
-                max_height=None
-            ).run()
-        
+            chapters = self.read_cbz_chapters(directory)
+            epub_file = self.build_volume(manga.title, chapters, directory, directory)
         except Exception:
             Log.error(f"Failed to merge .cbz files from {directory} to .epub", traceback.format_exc())
             epub_file = None
             
         print(" ") if epub_file else print("\n[-] Something went wrong when merging files to .epub !")
         return epub_file
+
+    @classmethod
+    @Profiler.profiled("merge_cbz_to_volumes")
+    def merge_cbz_to_volumes(self, manga: Manga, directory: str, on_built: Callable = None, progress: Progress = None, max_workers: int = VOLUME_BUILD_WORKERS):
+        # Same as merge_cbz_to_epub, but chapters going over VOLUME_MAX_PAGES or VOLUME_MAX_SIZE are split into volumes.
+        # Up to max_workers volumes are built at the same time and on_built(title, epub_file) is called as soon as each one is ready.
+        # Returns the (title, epub_file, chapters count) of each volume in reading order, epub_file being None if it failed.
+        try:
+            chapters = self.read_cbz_chapters(directory)
+            volumes = self.split_into_volumes(chapters, VOLUME_MAX_PAGES, VOLUME_MAX_SIZE)
+        except Exception:
+            Log.error(f"Failed to read .cbz files from {directory}", traceback.format_exc())
+            print("\n[-] Something went wrong when merging files to .epub !")
+            return []
+
+        if len(volumes) > 1:
+            Log.info(f"Splitting {len(chapters)} chapters of {manga.title} into {len(volumes)} volumes")
+            print(f"Splitting {len(chapters)} chapters into {len(volumes)} volumes")
+
+        def build(index: int):
+            title, volume_directory = self.volume_location(manga, directory, index, len(volumes))
+
+            try:
+                epub_file = self.build_volume(title, volumes[index], volume_directory, directory, progress=progress)
+            except Exception:
+                Log.error(f"Failed to merge .cbz files from {directory} to {title}", traceback.format_exc())
+                epub_file = None
+
+            if epub_file and on_built:
+                on_built(title, epub_file)
+            return title, epub_file, len(volumes[index])
+
+        with contextlib.nullcontext(progress) if progress else Progress() as progress:
+            with ThreadPoolExecutor(max_workers=min(len(volumes), max_workers) or 1, thread_name_prefix="volumes") as executor:
+                results = list(executor.map(build, range(len(volumes))))
+
+        print(" ") if all(epub_file for _, epub_file, _ in results) else print("\n[-] Something went wrong when merging files to .epub !")
+        return results
+
+    @classmethod
+    def read_cbz_chapters(self, directory: str):
+        # The .cbz chapters of directory in reading order, with their metadata, page count and size
+        chapters = []
+
+        for cbz_filename in sorted([filename for filename in os.listdir(directory) if filename.endswith(".cbz")], key=natural_keys):
+            cbz = Cbz(os.path.join(directory, cbz_filename))
+
+            # ComicInfo.xml is read straight from the archive, it gives the writer and usually every page dimensions
+            chapters.append({"cbz": cbz, "metadata": cbz.read_metadata(), "pages": cbz.count_pages(), "size": os.path.getsize(cbz.path)})
+
+        Cbz.save_metadata_cache()
+        return chapters
+
+    @classmethod
+    def split_into_volumes(self, chapters: List[dict], max_pages: int, max_size: int, pages: int = 0, size: int = 0):
+        # Chapters are never split : a volume is closed before the chapter that would take it over the limits (0 for none).
+        # pages and size are already in the first volume when appending to an existing one, it is left empty if it is full.
+        volumes = [[]] if pages or size else []
+
+        for chapter in chapters:
+            too_many_pages = max_pages and pages + chapter["pages"] > max_pages
+            too_big = max_size and size + chapter["size"] > max_size
+
+            if not volumes or too_many_pages or too_big:
+                volumes.append([])
+                pages, size = 0, 0
+
+            volumes[-1].append(chapter)
+            pages += chapter["pages"]
+            size += chapter["size"]
+
+        return volumes
+
+    @classmethod
+    def volume_location(self, manga: Manga, directory: str, index: int, volumes_count: int, first_number: int = 1):
+        # Title and directory of a volume, a single volume is built just like merge_cbz_to_epub would.
+        # Volumes following a kept volume (see VolumeStore) are numbered after it.
+        if volumes_count == 1 and first_number == 1:
+            return manga.title, directory
+
+        number = first_number + index
+        volume_directory = os.path.join(directory, f"Vol_{number:02d}")
+        os.makedirs(volume_directory, exist_ok=True)
+        return f"{manga.title} - Vol {number:02d}", volume_directory
+
+    @classmethod
+    def build_volume(self, title: str, chapters: List[dict], volume_directory: str, output_directory: str, progress: Progress = None):
+        # Returns the path of the EPUB, None if it could not be built
+        epub_maker = self.prepare_volume(title, chapters, volume_directory, output_directory, progress=progress)
+        epub_maker.run()
+
+        # EPubMaker deletes the file when it fails
+        return epub_maker.file if os.path.isfile(epub_maker.file) else None
+
+    @classmethod
+    def prepare_volume(self, title: str, chapters: List[dict], volume_directory: str, output_directory: str, master=None, progress: Progress = None, base: dict = None):
+        # Unzips the chapters into volume_directory and returns the EPubMaker building the EPUB into output_directory.
+        # It isn't started : run() builds it right away, start() in its own thread, reporting to master when it is given.
+        # With a kept volume as base (see VolumeStore), the chapters are appended to a copy of it instead.
+        epub_file = os.path.join(output_directory, title.replace(" ","_") + ".epub")
+        if base:
+            shutil.copyfile(base["file"], epub_file)
+
+        author = base["author"] if base else ""
+        known_dimensions = {}
+
+        for chapter in chapters:
+            chapter_directory = chapter["cbz"].unzip(volume_directory)
+
+            if not author:
+                author = chapter["metadata"]["writer"]
+
+            for name, dimensions in chapter["metadata"]["pages"].items():
+                known_dimensions[os.path.join(chapter_directory, name)] = dimensions
+
+        return EPubMaker(
+            master=master,
+            input_dir=volume_directory,
+            file=epub_file,
+            name=title,
+            author=author,
+            wrap_pages=True,
+            grayscale=False,
+            max_width=None,
+            max_height=None,
+            known_dimensions=known_dimensions,
+            dedup=IMAGE_DEDUP,
+            cleanup=PAGE_CLEANUP,
+            progress=progress,
+            base=base["epub"] if base else None
+        )
     
     @classmethod
+    @Profiler.profiled("merge_epubs_to_epub")
     def merge_epubs_to_epub(self, lightnovel: Lightnovel, directory: str):
         try:
             merged_epub = epub.EpubBook()
@@ -76,6 +193,9 @@ class Converter:
             chapters = []
             toc = []
 
+            # Images, fonts and stylesheets used by the chapters, stored once for the whole merged EPUB
+            resources = EpubResources(merged_epub)
+
             # Loop through all files in the directory
             merged_epub_got_cover = False
             merged_epub_got_author = False
@@ -91,6 +211,7 @@ class Converter:
                 for idx, filename in enumerate(epub_files):
                     epub_path = os.path.join(directory, filename)
                     book = epub.read_epub(name=epub_path, options={"ignore_ncx": True})
+                    resources.add_source(book)
 
                     # Retrieving the author from the first .epub
                     if not merged_epub_got_author:
@@ -107,13 +228,16 @@ class Converter:
                         if item.get_type() == ITEM_DOCUMENT and item.get_name().startswith("Chapter "):
                             chapter_id += 1
 
+                            content, stylesheets = resources.rewrite_document(item)
                             chapter = epub.EpubHtml(
                                 uid=f"chapter_{chapter_id}",
                                 file_name=item.get_name(),
-                                content=item.get_content()
+                                content=content
                             )
 
-                            # Making sure the text is formatted correctly
+                            # Keeping the chapter's own style, then making sure the text is formatted correctly
+                            for stylesheet in stylesheets:
+                                chapter.add_link(href=resources.relative_reference(stylesheet, chapter.get_name(), stylesheet), rel="stylesheet", type="text/css")
                             chapter.add_item(default_css)
                             
                             merged_epub.add_item(chapter)
@@ -134,6 +258,10 @@ class Converter:
                 merged_epub.add_item(epub.EpubNav())
                 merged_epub.spine = chapters            
 
+                if resources.duplicates:
+                    Log.info(f"{resources.duplicates} resources shared between chapters stored once ({resources.bytes_saved} bytes saved)")
+                    print(f"Stored {len(resources.stored)} images, fonts and stylesheets once for all chapters ({resources.bytes_saved / 1024 / 1024:.1f} MiB saved)")
+
                 # Write the merged EPUB to the output file
                 epub_file = os.path.join(directory, lightnovel.title + ".epub")
                 epub.write_epub(name=epub_file, book=merged_epub)
@@ -1,20 +1,30 @@
+import json
 import os
 import zipfile
 import traceback
 
+from books.formats.epub import filter_images
+from utils.comicinfo import ComicInfo
 from utils.log import Log
 
+from config import COMICINFO_CACHE_FILE
+
+METADATA_CACHE_MAX_ENTRIES = 5000  # Chapters, the least recently used ones are dropped first
+
 class Cbz:
     
     path: str
 
+    # Metadata read from each chapter's ComicInfo.xml, kept in COMICINFO_CACHE_FILE (see read_metadata)
+    metadata_cache: dict = None
+
     def __init__(self, path: str):
         self.path = path
 
-    def unzip(self):
+    def unzip(self, parent_directory: str = None):
         try:
-            # Extract the directory path and file name
-            directory_path = os.path.dirname(self.path)
+            # Extract the directory path and file name (extracted next to the archive unless told otherwise)
+            directory_path = parent_directory or os.path.dirname(self.path)
             file_name = os.path.basename(self.path)
             
             # Remove the .cbz extension from the file name
@@ -31,5 +41,77 @@ class Cbz:
             Log.debug(f"Unzipped {self.path} successfully")
             return output_directory
         except Exception:
-            Log.debug(f"Failed to unzip {self.path}", traceback.format_exc())
-            return None
\ No newline at end of file
+            Log.error(f"Failed to unzip {self.path}", traceback.format_exc())
+            return None
+
+    def count_pages(self):
+        # Only reads the archive's table of contents
+        with zipfile.ZipFile(self.path, 'r') as zip_ref:
+            return sum(1 for _ in filter_images([info.filename for info in zip_ref.infolist() if not info.is_dir()]))
+
+    def read_metadata(self):
+        # Writer, series, number and page dimensions (archive member => [width, height]) from the ComicInfo.xml
+        # inside the archive, parsed straight from the zip without extracting anything.
+        # Chapters are cached by name and size, downloading them again doesn't mean parsing them again.
+        key = f"{os.path.basename(os.path.dirname(self.path))}/{os.path.basename(self.path)}:{os.path.getsize(self.path)}"
+
+        cache = self.load_metadata_cache()
+        if key in cache:
+            cache[key] = cache.pop(key)
+            return cache[key]
+
+        metadata = {"writer": "", "series": "", "number": "", "pages": {}}
+
+        try:
+            with zipfile.ZipFile(self.path, 'r') as zip_ref:
+                members = {info.filename: info for info in zip_ref.infolist() if not info.is_dir()}
+                comic_info_name = next((name for name in members if os.path.basename(name).lower() == "comicinfo.xml"), None)
+
+                if comic_info_name:
+                    with zip_ref.open(comic_info_name) as f:
+                        comic_info = ComicInfo(f"{self.path}/{comic_info_name}", f)
+
+                    metadata["writer"] = comic_info.writer
+                    metadata["series"] = comic_info.series
+                    metadata["number"] = comic_info.number
+
+                    # Page indexes follow the order of the images in the archive.
+                    # Dimensions are only trusted when ComicInfo.xml agrees with the archive on the image size (when it gives one).
+                    images = [name for name, _, _ in filter_images(list(members))]
+                    for index, name in enumerate(images):
+                        page = comic_info.pages.get(index)
+                        if page and page["size"] in (None, members[name].file_size):
+                            metadata["pages"][name] = [page["width"], page["height"]]
+                else:
+                    Log.debug(f"No ComicInfo.xml in {self.path}")
+
+            cache[key] = metadata
+        except Exception:
+            Log.error(f"Failed to read metadata from {self.path}", traceback.format_exc())
+
+        return metadata
+
+    @classmethod
+    def load_metadata_cache(self):
+        if self.metadata_cache is None:
+            try:
+                with open(COMICINFO_CACHE_FILE, "r") as f:
+                    Cbz.metadata_cache = json.load(f)
+            except FileNotFoundError:
+                Cbz.metadata_cache = {}
+            except Exception:
+                Log.error(f"Failed to read {COMICINFO_CACHE_FILE}, starting from an empty cache", traceback.format_exc())
+                Cbz.metadata_cache = {}
+        return self.metadata_cache
+
+    @classmethod
+    def save_metadata_cache(self):
+        if self.metadata_cache is not None:
+            for key in list(self.metadata_cache)[:-METADATA_CACHE_MAX_ENTRIES]:
+                del self.metadata_cache[key]
+
+            try:
+                with open(COMICINFO_CACHE_FILE, "w") as f:
+                    json.dump(self.metadata_cache, f)
+            except Exception:
+                Log.error(f"Failed to write {COMICINFO_CACHE_FILE}", traceback.format_exc())
@@ -1,11 +1,14 @@
+import contextlib
+import hashlib
 import os
 import re
+import shutil
 import threading
 import traceback
 import uuid
 from pathlib import Path
 from typing import Optional, List
-from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
+from zipfile import ZipFile, ZipInfo, ZIP_STORED, ZIP_DEFLATED
 from rich.progress import Progress
 
 import PIL.Image
@@ -13,10 +16,40 @@ from ebooklib import epub
 from jinja2 import Environment, FileSystemLoader, StrictUndefined
 
 from utils.log import Log
+from utils.profiler import Profiler
+
+# numpy is optional, it isn't in requirements.txt : it is only needed by page cleanup (page_cleanup in cota.cfg),
+# which is skipped with a warning when it is missing (see cleanup_pages). Everything else works without it.
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 MEDIA_TYPES = {'.png': 'image/png', '.jpg': 'image/jpeg', '.gif': 'image/gif', '.jpeg': 'image/jpeg'}
 TEMPLATE_DIR = Path(__file__).parent.joinpath("epub_templates")
 
+# Image deduplication (dedup) : "off", "exact" stores identical files once,
+# "perceptual" also drops pages looking like a page from another chapter (credits, recruitment, ...)
+PERCEPTUAL_HASH_SIZE = 8
+PERCEPTUAL_HASH_MAX_DISTANCE = 4  # Out of PERCEPTUAL_HASH_SIZE ** 2 bits
+
+# Written after every page, they are written again after the new pages when an EPUB is appended to (see append_to_epub)
+METADATA_FILES = ["package.opf", "toc.xhtml", "toc.ncx"]
+
+# Every zip entry gets the same timestamp and permissions : the same pages always give the same bytes, so that
+# a book built again is identical and a grown one only differs from where its new pages start (see connectivity.delta)
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+ZIP_PERMISSIONS = 0o644
+
+# Page cleanup (needs numpy) : pages are analysed by batches, on grayscale thumbnails
+CLEANUP_ANALYSIS_SIZE = (128, 192)  # (width, height)
+CLEANUP_BATCH_SIZE = 64
+CLEANUP_PAPER_LEVEL = 235  # Lighter pixels are paper
+CLEANUP_LINE_MIN_INK = 0.005  # Rows or columns with less ink than that (fraction of their pixels) are margin, this ignores specks of dust
+CLEANUP_BLANK_MAX_INK = 0.002  # Pages with less ink than that (fraction of their pixels) are blank
+CLEANUP_MIN_TRIM = 0.03  # Margins are only trimmed when they add up to that much of the page width or height
+CLEANUP_PADDING = 0.01  # Kept around the content, fraction of the page width or height
+
 def natural_keys(text):
     """
     http://nedbatchelder.com/blog/200712/human_sorting.html
@@ -33,11 +66,26 @@ def filter_images(files):
             yield x, file_type, extension
 
 
+def perceptual_hash(path):
+    # Difference hash : each bit tells whether a pixel is brighter than its right neighbour in a tiny grayscale version
+    with PIL.Image.open(path) as image:
+        image.draft("L", (PERCEPTUAL_HASH_SIZE * 8, PERCEPTUAL_HASH_SIZE * 8))  # JPEG pages are decoded at a fraction of their size
+        pixels = list(image.convert("L").resize((PERCEPTUAL_HASH_SIZE + 1, PERCEPTUAL_HASH_SIZE), PIL.Image.BILINEAR).getdata())
+
+    bits = 0
+    for row in range(PERCEPTUAL_HASH_SIZE):
+        for col in range(PERCEPTUAL_HASH_SIZE):
+            left = pixels[row * (PERCEPTUAL_HASH_SIZE + 1) + col]
+            bits = (bits << 1) | (left > pixels[row * (PERCEPTUAL_HASH_SIZE + 1) + col + 1])
+    return bits
+
+
 class Chapter:
-    def __init__(self, dir_path, title, start: str = None):
+    def __init__(self, dir_path, title, start: str = None, images: List[dict] = None):
         self.dir_path = dir_path
         self.title = title
         self.children: List[Chapter] = []
+        self.images = images or []
         self._start = start
 
     @property
@@ -51,15 +99,26 @@ class Chapter:
     def start(self, value):
         self._start = value
 
+    def walk(self):
+        # This chapter then its sub-chapters, in the order of their images
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
     @property
     def depth(self) -> int:
         if self.children:
             return 1 + max(child.depth for child in self.children)
         return 1
 
+    @property
+    def top_level(self) -> List["Chapter"]:
+        # The chapters of a tree : a single chapter has been collapsed into the tree itself
+        return self.children or [self]
+
 
 class EPubMaker(threading.Thread):
-    def __init__(self, master, input_dir, file, name, author, wrap_pages, grayscale, max_width, max_height):
+    def __init__(self, master, input_dir, file, name, author, wrap_pages, grayscale, max_width, max_height, known_dimensions=None, dedup="off", cleanup=False, progress: Progress = None, base: dict = None):
         threading.Thread.__init__(self)
         self.master = master
         self.dir = input_dir
@@ -75,11 +134,24 @@ class EPubMaker(threading.Thread):
         self.author = author
         self.chapter_tree: Optional[Chapter] = None
         self.images = []
-        self.uuid = 'urn:uuid:' + str(uuid.uuid1())
+        self.uuid = 'urn:uuid:' + str(uuid.uuid5(uuid.NAMESPACE_URL, name or ""))
         self.grayscale = grayscale
         self.max_width = max_width
         self.max_height = max_height
         self.wrap_pages = wrap_pages
+        # Image path => (width, height) when already known (e.g. from ComicInfo.xml), such images don't need to be opened
+        self.known_dimensions = {os.path.normpath(path): dimensions for path, dimensions in (known_dimensions or {}).items()}
+        self.dedup = dedup
+        self.deduplicated_images = 0
+        self.dropped_images = 0
+        self.bytes_saved = 0
+        self.cleanup = cleanup
+        self.trimmed_pages = 0
+        self.blank_pages = 0
+        # Several EPUBs built at the same time share the same progress display
+        self.progress = progress
+        # snapshot() of the EPUB already at file when the chapters of input_dir are appended to it
+        self.base = base
 
     def run(self):
         try:
@@ -96,12 +168,12 @@ class EPubMaker(threading.Thread):
         except Exception as e:
             if not isinstance(e, StopException):
                 if self.master is not None:
-                    self.master.generic_queue.put(lambda: self.master.showerror(
-                        "Error encountered",
-                        "The following error was thrown:\n{}".format(e)
-                    ))
+                    # The master handles it later from its own thread, e and the traceback are gone by then
+                    message = "The following error was thrown:\n{}".format(e)
+                    stacktrace = traceback.format_exc()
+                    self.master.generic_queue.put(lambda: self.master.showerror("Error encountered", message, stacktrace))
                 else:
-                    Log.error(f"Failed to build EPUB {self.file}", traceback.print_exc())
+                    Log.error(f"Failed to build EPUB {self.file}", traceback.format_exc())
             try:
                 if os.path.isfile(self.file):
                     os.remove(self.file)
@@ -109,19 +181,122 @@ class EPubMaker(threading.Thread):
                 pass
 
     def make_epub(self):
+        if self.base:
+            self.append_to_epub()
+            return
+
         with ZipFile(self.file, mode='w', compression=ZIP_DEFLATED) as self.zip:
-            self.zip.writestr('mimetype', 'application/epub+zip', compress_type=ZIP_STORED)
+            self.write_entry('mimetype', 'application/epub+zip', compress_type=ZIP_STORED)
             self.add_file('META-INF', "container.xml")
             self.add_file('stylesheet.css')
             self.make_tree()
+            self.deduplicate_images()
+            self.cleanup_pages()
             self.assign_image_ids()
             self.write_images()
             self.write_template('package.opf')
             self.write_template('toc.xhtml')
             self.write_template('toc.ncx')
 
+    def append_to_epub(self):
+        # Only the pages of the new chapters are processed and written, right after the existing ones.
+        # Identical and lookalike pages are only looked for among the new chapters.
+        # The EPUB is built again next to file from the entries it already has, then moved over it : file is left as it
+        # was if anything goes wrong.
+        base_images, base_chapters = self.load_base()
+        # Numbered after the existing images, with as many digits
+        padding_width = len(base_images[0]["id"].rsplit("_", 1)[1]) if base_images else None
+        building_file = self.file + ".tmp"
+
+        try:
+            with ZipFile(self.file, mode='r') as base_zip, ZipFile(building_file, mode='w', compression=ZIP_DEFLATED) as self.zip:
+                self.copy_base_entries(base_zip)
+                self.make_tree()
+                self.deduplicate_images()
+                self.cleanup_pages()
+                self.assign_image_ids(first_count=len(base_images), padding_width=padding_width)
+                self.write_images()
+
+                self.images = base_images + self.images
+                new_chapters = self.chapter_tree.top_level
+                self.chapter_tree = Chapter(None, self.name)
+                self.chapter_tree.children = base_chapters + new_chapters
+
+                self.write_template('package.opf')
+                self.write_template('toc.xhtml')
+                self.write_template('toc.ncx')
+
+            os.replace(building_file, self.file)
+        finally:
+            if os.path.isfile(building_file):
+                os.remove(building_file)
+
+    def load_base(self):
+        # Images and chapters of the existing EPUB, as much as the templates need
+        self.uuid = self.base["uuid"]
+        images = {image["id"]: dict(image) for image in self.base["images"]}
+        for image in images.values():
+            if image["duplicate_of"]:
+                image["duplicate_of"] = images[image["duplicate_of"]]
+
+        self.cover = images.get(self.base["cover"])
+
+        def load_chapter(state):
+            chapter = Chapter(None, state["title"], images.get(state["start"]))
+            chapter.children = [load_chapter(child) for child in state["children"]]
+            return chapter
+
+        return list(images.values()), [load_chapter(chapter) for chapter in self.base["chapters"]]
+
+    def copy_base_entries(self, base_zip: ZipFile):
+        # Every entry of the existing EPUB but the metadata files, in the same order. They are written just like the first
+        # time (see zip_entry), so the new EPUB starts with the same bytes as the existing one (see connectivity.delta).
+        names = base_zip.namelist()
+        missing_files = [name for name in METADATA_FILES if name not in names]
+        if missing_files:
+            raise IOError(f"{self.file} is missing {', '.join(missing_files)}")
+
+        for info in base_zip.infolist():
+            if info.filename in METADATA_FILES:
+                continue
+            with base_zip.open(info) as base_entry, self.zip.open(self.zip_entry(info.filename, info.compress_type), "w") as entry_file:
+                shutil.copyfileobj(base_entry, entry_file)
+            self.check_is_stopped()
+
+    def snapshot(self):
+        # What append_to_epub needs to know about this EPUB once built (JSON serializable)
+        def chapter_state(chapter: Chapter):
+            return {
+                "title": chapter.title,
+                "start": chapter._start["id"] if chapter._start else None,
+                "children": [chapter_state(child) for child in chapter.children]
+            }
+
+        return {
+            "uuid": self.uuid,
+            "cover": self.cover["id"] if self.cover else None,
+            "images": [{
+                "id": image["id"], "filename": image["filename"], "type": image["type"], "is_cover": image["is_cover"],
+                "duplicate_of": image["duplicate_of"]["id"] if image["duplicate_of"] else None
+            } for image in self.images],
+            "chapters": [chapter_state(chapter) for chapter in self.chapter_tree.top_level]
+        }
+
     def add_file(self, *path: str):
-        self.zip.write(TEMPLATE_DIR.joinpath(*path), os.path.join(*path))
+        self.copy_entry(TEMPLATE_DIR.joinpath(*path), os.path.join(*path))
+
+    def zip_entry(self, name, compress_type=ZIP_DEFLATED):
+        entry = ZipInfo(name, date_time=ZIP_DATE_TIME)
+        entry.compress_type = compress_type
+        entry.external_attr = ZIP_PERMISSIONS << 16
+        return entry
+
+    def write_entry(self, name, data, compress_type=ZIP_DEFLATED):
+        self.zip.writestr(self.zip_entry(name, compress_type), data)
+
+    def copy_entry(self, source, name):
+        with open(source, "rb") as source_file, self.zip.open(self.zip_entry(name), "w") as entry_file:
+            shutil.copyfileobj(source_file, entry_file)
 
     def make_tree(self):
         root = Path(self.dir)
@@ -132,7 +307,7 @@ class EPubMaker(threading.Thread):
             dir_names.sort(key=natural_keys)
             images = self.get_images(filenames, dir_path)
             dir_path = Path(dir_path)
-            chapter = Chapter(dir_path, dir_path.name, images[0] if images else None)
+            chapter = Chapter(dir_path, dir_path.name, images[0] if images else None, images)
             chapter_shortcuts[dir_path.parent].children.append(chapter)
             chapter_shortcuts[dir_path] = chapter
 
@@ -150,40 +325,227 @@ class EPubMaker(threading.Thread):
         return result
 
     def add_image(self, source, file_type, extension):
-        data = {"extension": extension, "type": file_type, "source": source, "is_cover": False}
+        data = {"extension": extension, "type": file_type, "source": source, "is_cover": False, "duplicate_of": None, "crop": None}
         self.images.append(data)
         return data
 
-    def assign_image_ids(self):
+    def deduplicate_images(self):
+        if self.dedup not in ["exact", "perceptual"] or not self.images:
+            return
+
+        if not self.cover:
+            self.cover = self.images[0]
+            self.cover["is_cover"] = True
+
+        for image in self.images:
+            image["size"] = os.path.getsize(image["source"])
+
+        self.find_identical_images()
+
+        dropped = []
+        if self.dedup == "perceptual":
+            dropped = self.drop_lookalike_images()
+
+        duplicates = [image for image in self.images if image.get("duplicate_of")]
+        self.deduplicated_images = len(duplicates)
+        self.dropped_images = len(dropped)
+        self.bytes_saved = sum(image["size"] for image in duplicates + dropped)
+
+        if duplicates or dropped:
+            Log.info(f"{len(duplicates)} identical images stored once and {len(dropped)} lookalike pages dropped "
+                     f"in {os.path.basename(self.file)} ({self.bytes_saved} bytes saved)")
+            # A master shows its own status
+            if self.master is None:
+                print(f"Deduplicated {len(duplicates) + len(dropped)} pages ({self.bytes_saved / 1024 / 1024:.1f} MiB saved)")
+
+    def find_identical_images(self):
+        # Only files sharing their size with another one can be identical, no need to hash the others
+        images_by_size = {}
+        for image in self.images:
+            images_by_size.setdefault(image["size"], []).append(image)
+
+        originals = {}
+        for image in self.images:
+            if len(images_by_size[image["size"]]) < 2:
+                continue
+
+            with open(image["source"], "rb") as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+
+            original = originals.setdefault(digest, image)
+            if original is not image:
+                # Still a page of its own, but showing the image stored for the first occurrence
+                image["duplicate_of"] = original
+
+    def drop_lookalike_images(self):
+        # Pages too close to a page of a previous chapter are dropped, the cover is always kept
+        kept_hashes = []
+        dropped = set()
+
+        for chapter in self.chapter_tree.walk():
+            chapter_hashes = []
+
+            for image in chapter.images:
+                if image["duplicate_of"]:
+                    continue
+
+                try:
+                    image_hash = perceptual_hash(image["source"])
+                except Exception:
+                    Log.warning(f"Could not compute perceptual hash of {image['source']}, keeping it")
+                    continue
+
+                if not image["is_cover"] and any(bin(image_hash ^ kept_hash).count("1") <= PERCEPTUAL_HASH_MAX_DISTANCE for kept_hash in kept_hashes):
+                    Log.debug(f"Dropping {image['source']} which looks like a page from a previous chapter")
+                    dropped.add(id(image))
+                else:
+                    chapter_hashes.append(image_hash)
+
+            # Only compared to the pages of the other chapters
+            kept_hashes.extend(chapter_hashes)
+
+        return self.remove_images(dropped)
+
+    def cleanup_pages(self):
+        # Trims the white margins of the pages and removes the blank ones.
+        # Bounding boxes and amounts of ink are computed for whole batches of thumbnails at once.
+        if not self.cleanup or not self.images:
+            return
+
+        if numpy is None:
+            Log.warning("Page cleanup needs numpy (pip install numpy), skipping it")
+            return
+
+        if not self.cover:
+            self.cover = self.images[0]
+            self.cover["is_cover"] = True
+
+        images = [image for image in self.images if not image["duplicate_of"]]
+        blank = set()
+
+        for batch_start in range(0, len(images), CLEANUP_BATCH_SIZE):
+            batch = images[batch_start:batch_start + CLEANUP_BATCH_SIZE]
+            ink = numpy.stack([self.load_thumbnail(image) for image in batch]) < CLEANUP_PAPER_LEVEL
+            self.check_is_stopped()
+
+            ink_ratio = ink.mean(axis=(1, 2))
+            rows = ink.mean(axis=2) > CLEANUP_LINE_MIN_INK
+            columns = ink.mean(axis=1) > CLEANUP_LINE_MIN_INK
+            height, width = rows.shape[1], columns.shape[1]
+
+            # First and last rows / columns with content, as fractions of the page
+            top = rows.argmax(axis=1) / height - CLEANUP_PADDING
+            bottom = (height - rows[:, ::-1].argmax(axis=1)) / height + CLEANUP_PADDING
+            left = columns.argmax(axis=1) / width - CLEANUP_PADDING
+            right = (width - columns[:, ::-1].argmax(axis=1)) / width + CLEANUP_PADDING
+            has_content = rows.any(axis=1) & columns.any(axis=1)
+
+            for idx, image in enumerate(batch):
+                if ink_ratio[idx] < CLEANUP_BLANK_MAX_INK:
+                    if not image["is_cover"]:
+                        Log.debug(f"Removing blank page {image['source']}")
+                        blank.add(id(image))
+                    continue
+
+                box = (max(left[idx], 0), max(top[idx], 0), min(right[idx], 1), min(bottom[idx], 1))
+                if has_content[idx] and (1 - (box[2] - box[0]) >= CLEANUP_MIN_TRIM or 1 - (box[3] - box[1]) >= CLEANUP_MIN_TRIM):
+                    image["crop"] = (int(box[0] * image["width"]), int(box[1] * image["height"]), round(box[2] * image["width"]), round(box[3] * image["height"]))
+                    self.trimmed_pages += 1
+
+        self.blank_pages = len(self.remove_images(blank))
+
+        if self.trimmed_pages or self.blank_pages:
+            Log.info(f"Trimmed the margins of {self.trimmed_pages} pages and removed {self.blank_pages} blank pages in {os.path.basename(self.file)}")
+            if self.master is None:
+                print(f"Trimmed the margins of {self.trimmed_pages} pages and removed {self.blank_pages} blank pages")
+
+    def load_thumbnail(self, image):
+        with PIL.Image.open(image["source"]) as image_data:
+            image["width"], image["height"] = image_data.size
+            image["type"] = image_data.get_format_mimetype()
+
+            # JPEG pages are decoded straight at a fraction of their size
+            image_data.draft("L", CLEANUP_ANALYSIS_SIZE)
+            return numpy.asarray(image_data.convert("L").resize(CLEANUP_ANALYSIS_SIZE))
+
+    def remove_images(self, removed: set):
+        # Removes the images whose id() is in removed, along with their identical copies.
+        # The last remaining page of a chapter is always kept, chapters then start at their first remaining page.
+        for image in self.images:
+            if id(image["duplicate_of"]) in removed:
+                removed.add(id(image))
+
+        for chapter in self.chapter_tree.walk():
+            if chapter.images:
+                kept_images = [image for image in chapter.images if id(image) not in removed] or [chapter.images[0]]
+                removed.discard(id(kept_images[0]))
+                chapter.start = kept_images[0]
+
+        for image in self.images:
+            # Kept copies of a removed image have to be stored after all
+            if id(image) not in removed and id(image["duplicate_of"]) in removed:
+                image["duplicate_of"] = None
+
+        removed_images = [image for image in self.images if id(image) in removed]
+        self.images = [image for image in self.images if id(image) not in removed]
+        return removed_images
+
+    def assign_image_ids(self, first_count=0, padding_width=None):
         if not self.cover and self.images:
             cover = self.images[0]
             cover["is_cover"] = True
             self.cover = cover
-        padding_width = len(str(len(self.images)))
-        for count, image in enumerate(self.images):
+        padding_width = padding_width or len(str(first_count + len(self.images)))
+        for count, image in enumerate(self.images, start=first_count):
             image["id"] = f"image_{count:0{padding_width}}"
             image["filename"] = image["id"] + image["extension"]
+            if image.get("duplicate_of"):
+                image["filename"] = image["duplicate_of"]["filename"]
 
+    @Profiler.profiled("write_images")
     def write_images(self):
         template = self.template_env.get_template("page.xhtml.jinja2")
 
-        with Progress() as progress:
+        with contextlib.nullcontext(self.progress) if self.progress else Progress() as progress:
 
             progress_bar_length = len(self.images) * 100
             task = progress.add_task(f"[red]Creating {os.path.basename(self.file)}...", total=progress_bar_length)
 
-            for idx, image in enumerate(self.images):
+            for image in self.images:
                 output = os.path.join('images', image["filename"])
-                image_data: PIL.Image.Image = PIL.Image.open(image["source"])
-                image["width"], image["height"] = image_data.size
-                image["type"] = image_data.get_format_mimetype()
+
+                # Identical images are only stored once, the first time they show up
+                if image.get("duplicate_of"):
+                    for key in ["width", "height", "type"]:
+                        image[key] = image["duplicate_of"][key]
+                    if self.wrap_pages:
+                        self.write_page(template, image)
+                    progress.advance(task, advance=100)
+                    self.check_is_stopped()
+                    continue
+
+                image_data: Optional[PIL.Image.Image] = None
+                dimensions = self.known_dimensions.get(os.path.normpath(image["source"]))
+                # Grayscale conversion needs the image mode anyway
+                if dimensions and not self.grayscale and not image["crop"]:
+                    image["width"], image["height"] = dimensions
+                else:
+                    image_data = self.open_image(image)
+                    image_format = image_data.format
+                    save_options = self.save_options(image_data)
+                    if image["crop"]:
+                        image_data = image_data.crop(image["crop"])
+                        image["width"], image["height"] = image_data.size
                 should_resize = (self.max_width and self.max_width < image["width"]) or (
                             self.max_height and self.max_height < image["height"])
                 should_grayscale = self.grayscale and image_data.mode != "L"
-                if not should_grayscale and not should_resize:
-                    self.zip.write(image["source"], output)
+                if not should_grayscale and not should_resize and not image["crop"]:
+                    self.copy_entry(image["source"], output)
                 else:
-                    image_format = image_data.format
+                    if image_data is None:
+                        image_data = self.open_image(image)
+                        image_format = image_data.format
+                        save_options = self.save_options(image_data)
                     if should_resize:
                         width_scale = image["width"] / self.max_width if self.max_width else 1.0
                         height_scale = image["height"] / self.max_height if self.max_height else 1.0
@@ -192,22 +554,38 @@ class EPubMaker(threading.Thread):
                         image["width"], image["height"] = image_data.size
                     if should_grayscale:
                         image_data = image_data.convert("L")
-                    with self.zip.open(output, "w") as image_file:
-                        image_data.save(image_file, format=image_format)
+                    with self.zip.open(self.zip_entry(output), "w") as image_file:
+                        image_data.save(image_file, format=image_format, **save_options)
 
                 if self.wrap_pages:
-                    self.zip.writestr(os.path.join("pages", image["id"] + ".xhtml"), template.render(image))
+                    self.write_page(template, image)
 
-                progress.advance(task, advance=idx * 100)
+                progress.advance(task, advance=100)
                 self.check_is_stopped()
 
+    def write_page(self, template, image):
+        # Titled after the image path in input_dir, whatever directory it was built in
+        self.write_entry(os.path.join("pages", image["id"] + ".xhtml"), template.render({**image, "source": os.path.relpath(image["source"], self.dir)}))
+
+    def open_image(self, image):
+        image_data: PIL.Image.Image = PIL.Image.open(image["source"])
+        image["width"], image["height"] = image_data.size
+        image["type"] = image_data.get_format_mimetype()
+        return image_data
+
+    def save_options(self, image_data):
+        # JPEG pages encoded again keep their original quantization tables, so they keep their quality and size
+        if image_data.format == "JPEG" and getattr(image_data, "quantization", None):
+            return {"qtables": image_data.quantization}
+        return {}
+
     def write_template(self, name, *, out=None, data=None):
         out = out or name
         data = data or {
             "name": self.name, "uuid": self.uuid, "cover": self.cover, "chapter_tree": self.chapter_tree,
             "images": self.images, "wrap_pages": self.wrap_pages, "author": self.author
         }
-        self.zip.writestr(out, self.template_env.get_template(name + '.jinja2').render(data))
+        self.write_entry(out, self.template_env.get_template(name + '.jinja2').render(data))
 
     def stop(self):
         self.stop_event = True
@@ -0,0 +1,124 @@
+import hashlib
+import posixpath
+import re
+from urllib.parse import unquote, urlsplit
+
+from ebooklib import epub, ITEM_IMAGE, ITEM_COVER, ITEM_FONT, ITEM_STYLE
+from lxml import etree
+
+from utils.log import Log
+
+# Where each kind of resource is stored in the merged EPUB
+RESOURCE_DIRS = {ITEM_IMAGE: "images", ITEM_COVER: "images", ITEM_FONT: "fonts", ITEM_STYLE: "styles"}
+
+CSS_REFERENCE = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)|@import\s+(['"])([^'"]+)\3""")
+REFERENCE_ATTRIBUTES = ["src", "href", "{http://www.w3.org/1999/xlink}href"]
+
+class EpubResources:
+    # Images, fonts and stylesheets of several EPUBs merged into a single one.
+    # Each distinct file (by content hash) is stored once, whatever the number of source EPUBs embedding it,
+    # and the references of the documents and stylesheets are rewritten to point to it.
+    # Only the resources actually referenced by the documents we keep are stored.
+
+    def __init__(self, book: epub.EpubBook):
+        self.book = book
+        self.stored = {}  # sha256 => file name in the merged EPUB
+        self.source_items = {}
+        self.source_names = {}  # file name in the current source EPUB => file name in the merged EPUB
+        self.duplicates = 0
+        self.bytes_saved = 0
+
+    def add_source(self, source: epub.EpubBook):
+        # Following calls resolve references against this source EPUB
+        self.source_items = {item.get_name(): item for item in source.get_items() if item.get_type() in RESOURCE_DIRS}
+        self.source_names = {}
+
+    def rewrite_document(self, item: epub.EpubItem):
+        # Returns the content of the document with its references rewritten, and the stylesheets it links to
+        # (ebooklib rebuilds the head of the documents, they have to be added back with add_link).
+        # Works on the raw document, get_content() would already have dropped the head.
+        name = item.get_name()
+        content = item.content
+
+        try:
+            root = etree.fromstring(content, etree.XMLParser(recover=True, resolve_entities=False))
+        except Exception:
+            root = None
+        if root is None:
+            Log.warning(f"Could not parse {name}, its images and stylesheets won't be kept")
+            return content, []
+
+        stylesheets = []
+        for element in root.iter():
+            if not isinstance(element.tag, str):
+                continue
+
+            if etree.QName(element).localname == "link":
+                if "stylesheet" in (element.get("rel") or "").split():
+                    stored_name = self.resolve(name, element.get("href") or "")
+                    if stored_name:
+                        stylesheets.append(stored_name)
+                continue
+
+            for attribute in REFERENCE_ATTRIBUTES:
+                reference = element.get(attribute)
+                stored_name = self.resolve(name, reference) if reference else None
+                if stored_name:
+                    element.set(attribute, self.relative_reference(stored_name, name, reference))
+
+        return etree.tostring(root, xml_declaration=True, encoding="utf-8"), stylesheets
+
+    def resolve(self, base_name: str, reference: str):
+        # File name in the merged EPUB of what reference (found in base_name) points to, None if it isn't a resource
+        parts = urlsplit(reference)
+        if parts.scheme or parts.netloc or not parts.path:
+            return None
+
+        name = posixpath.normpath(posixpath.join(posixpath.dirname(base_name), unquote(parts.path)))
+        return self.store(name)
+
+    def store(self, name: str):
+        if name in self.source_names:
+            return self.source_names[name]
+
+        item = self.source_items.get(name)
+        if item is None:
+            return None
+
+        # Guards against stylesheets importing each other
+        self.source_names[name] = None
+
+        content = item.get_content()
+        if item.get_type() == ITEM_STYLE:
+            content = self.rewrite_stylesheet(name, content)
+
+        digest = hashlib.sha256(content).hexdigest()
+        if digest in self.stored:
+            self.duplicates += 1
+            self.bytes_saved += len(content)
+        else:
+            directory = RESOURCE_DIRS[item.get_type()]
+            stored_name = f"{directory}/{digest[:16]}{posixpath.splitext(name)[1]}"
+            self.book.add_item(epub.EpubItem(uid=f"{directory}_{len(self.stored)}", file_name=stored_name, media_type=item.media_type, content=content))
+            self.stored[digest] = stored_name
+
+        self.source_names[name] = self.stored[digest]
+        return self.stored[digest]
+
+    def rewrite_stylesheet(self, name: str, content: bytes):
+        # Stylesheets end up in their own directory, url() and @import references are made relative to it
+        stylesheet_name = f"{RESOURCE_DIRS[ITEM_STYLE]}/stylesheet.css"
+
+        def rewrite(match):
+            reference = match.group(2) or match.group(4)
+            stored_name = self.resolve(name, reference)
+            if not stored_name:
+                return match.group(0)
+            return match.group(0).replace(reference, self.relative_reference(stored_name, stylesheet_name, reference))
+
+        return CSS_REFERENCE.sub(rewrite, content.decode("utf-8", errors="replace")).encode("utf-8")
+
+    def relative_reference(self, stored_name: str, base_name: str, reference: str):
+        fragment = urlsplit(reference).fragment
+        relative_name = posixpath.relpath(stored_name, posixpath.dirname(base_name) or ".")
+        return relative_name + (f"#{fragment}" if fragment else "")
@@ -1,5 +1,6 @@
 from typing import List
 import re
+import time
 
 class Manga():
     title: str
@@ -7,13 +8,18 @@ class Manga():
     chapters: List[str]
     last_read_chapter: int
     missing: bool
+    last_new_chapter_at: float
+    last_synced_at: float
 
-    def __init__(self, title, source, chapters=[], last_read_chapter=0):
+    def __init__(self, title, source, chapters=[], last_read_chapter=0, last_new_chapter_at=None, last_synced_at=None):
         self.title = title
         self.source = source
         self.chapters = chapters
         self.last_read_chapter = last_read_chapter
         self.missing = False
+        # Timestamps, None when it never happened (see SyncSchedule)
+        self.last_new_chapter_at = last_new_chapter_at
+        self.last_synced_at = last_synced_at
 
     def update_chapters(self, up_to_date_chapters: List[str]):
         # Track the chapter at the current last_read_chapter index
@@ -33,4 +39,9 @@ class Manga():
         # Update last_read_chapter to point to the new index of the previous last_read_chapter
         self.last_read_chapter = self.chapters.index(current_last_read_chapter) + 1 if current_last_read_chapter != 0 else 0
 
+        # up_to_date_chapters always comes straight from the media server
+        self.last_synced_at = time.time()
+        if new_chapters:
+            self.last_new_chapter_at = self.last_synced_at
+
         return new_chapters
\ No newline at end of file
@@ -0,0 +1,95 @@
+import hashlib
+import json
+import os
+import shutil
+import traceback
+from typing import List
+
+from utils.log import Log
+
+from config import READY_DIR
+
+READY_INDEX_FILENAME = "ready.json"
+
+class ReadyCache:
+    # Books built ahead of time by the daemon, ready to be uploaded.
+    # Each title gets a directory per list of chapters : READY_DIR/<kind>/<title>/<chapters digest>/ holds the EPUBs,
+    # and READY_INDEX_FILENAME once they are all built. The daemon and the CLI are different processes,
+    # so the index is written last and atomically : an entry without it is still being built.
+
+    @classmethod
+    def title_directory(self, kind: str, title: str):
+        return os.path.join(READY_DIR, kind, title.replace(" ","_"))
+
+    @classmethod
+    def build_directory(self, kind: str, title: str, chapters: List[str]):
+        digest = hashlib.sha256("\n".join(chapters).encode("utf-8")).hexdigest()[:16]
+        directory = os.path.join(self.title_directory(kind, title), digest)
+
+        # Leftovers of an interrupted build
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+        return directory
+
+    @classmethod
+    def store(self, directory: str, chapters: List[str], volumes: List[dict]):
+        # volumes are {"title", "file", "chapters"} in reading order, their files being in directory
+        entry = {
+            "chapters": chapters,
+            "volumes": [{"title": volume["title"], "file": os.path.basename(volume["file"]), "chapters": volume["chapters"]} for volume in volumes]
+        }
+
+        index_file = os.path.join(directory, READY_INDEX_FILENAME)
+        with open(index_file + ".tmp", "w") as f:
+            json.dump(entry, f)
+        os.replace(index_file + ".tmp", index_file)
+
+    @classmethod
+    def entries(self, kind: str, title: str):
+        # (directory, entry) of every finished entry of title, volume files as full paths
+        title_directory = self.title_directory(kind, title)
+        if not os.path.isdir(title_directory):
+            return
+
+        for name in os.listdir(title_directory):
+            directory = os.path.join(title_directory, name)
+            index_file = os.path.join(directory, READY_INDEX_FILENAME)
+            if not os.path.isfile(index_file):
+                continue
+
+            try:
+                with open(index_file, "r") as f:
+                    entry = json.load(f)
+            except Exception:
+                Log.error(f"Failed to read {index_file}, ignoring it", traceback.format_exc())
+                continue
+
+            for volume in entry["volumes"]:
+                volume["file"] = os.path.join(directory, volume["file"])
+            yield directory, entry
+
+    @classmethod
+    def find(self, kind: str, title: str, unread_chapters: List[str]):
+        # The entry built for the first unread chapters (with its directory), None if there is none
+        for directory, entry in self.entries(kind, title):
+            chapters = entry["chapters"]
+            if chapters and chapters == unread_chapters[:len(chapters)] and all(os.path.isfile(volume["file"]) for volume in entry["volumes"]):
+                return {**entry, "directory": directory}
+        return None
+
+    @classmethod
+    def remove(self, directory: str):
+        shutil.rmtree(directory, ignore_errors=True)
+
+    @classmethod
+    def discard(self, kind: str, title: str, keep: str = None):
+        # Removes every entry of title (finished or not) but the keep directory
+        title_directory = self.title_directory(kind, title)
+        if not os.path.isdir(title_directory):
+            return
+
+        for name in os.listdir(title_directory):
+            directory = os.path.join(title_directory, name)
+            if directory != keep:
+                Log.debug(f"Discarding {directory}")
+                self.remove(directory)
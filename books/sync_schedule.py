@@ -0,0 +1,22 @@
+import time
+from typing import Union
+
+from books.models.manga import Manga
+from books.models.lightnovel import Lightnovel
+
+from config import HOT_TITLE_PERIOD, COLD_SYNC_INTERVAL
+
+class SyncSchedule:
+    # Most tracked titles are finished or dormant : listing their chapters at every launch is what makes syncing slow.
+    # Hot titles, which got new chapters in the last HOT_TITLE_PERIOD, are synced every time.
+    # Cold ones only once COLD_SYNC_INTERVAL went by since their last sync, unless everything is synced on demand
+    # or they are opened (see MangaManager.refresh).
+
+    @classmethod
+    def is_hot(self, book: Union[Manga, Lightnovel]):
+        return book.last_new_chapter_at is not None and time.time() - book.last_new_chapter_at < HOT_TITLE_PERIOD
+
+    @classmethod
+    def is_due(self, book: Union[Manga, Lightnovel]):
+        # Titles never synced (e.g. tracked before the schedule existed) are due
+        return book.last_synced_at is None or self.is_hot(book) or time.time() - book.last_synced_at >= COLD_SYNC_INTERVAL
@@ -0,0 +1,66 @@
+import json
+import os
+import shutil
+import traceback
+from typing import List
+
+from books.models.manga import Manga
+from utils.log import Log
+
+from config import VOLUMES_DIR
+
+VOLUME_INDEX_FILENAME = "volume.json"
+
+class VolumeStore:
+    # Last volume sent of each manga, kept when incremental_volumes is on : the next chapters are appended to it
+    # (see EPubMaker.append_to_epub) and it is sent again under the same title, overwriting the previous one on the reader.
+    # VOLUMES_DIR/<title>/ holds the EPUB and VOLUME_INDEX_FILENAME, written last and atomically.
+
+    @classmethod
+    def title_directory(self, title: str):
+        return os.path.join(VOLUMES_DIR, title.replace(" ","_"))
+
+    @classmethod
+    def find(self, manga: Manga, chapters: List[str]):
+        # The kept volume of manga when chapters come right after its own ones, None otherwise
+        index_file = os.path.join(self.title_directory(manga.title), VOLUME_INDEX_FILENAME)
+        if not chapters or not os.path.isfile(index_file):
+            return None
+
+        try:
+            with open(index_file, "r") as f:
+                volume = json.load(f)
+        except Exception:
+            Log.error(f"Failed to read {index_file}, ignoring it", traceback.format_exc())
+            return None
+
+        volume["file"] = os.path.join(self.title_directory(manga.title), volume["file"])
+        if not os.path.isfile(volume["file"]) or chapters[0] not in manga.chapters:
+            return None
+
+        first_chapter = manga.chapters.index(chapters[0])
+        if manga.chapters[max(first_chapter - len(volume["chapters"]), 0):first_chapter] != volume["chapters"]:
+            Log.debug(f"Kept volume of {manga.title} doesn't end right before {chapters[0]}, building a new one")
+            return None
+
+        return volume
+
+    @classmethod
+    def keep(self, manga: Manga, volume: dict):
+        # volume is {"title", "file", "number", "chapters", "pages", "size", "author", "epub"}, "epub" being the
+        # EPubMaker.snapshot() of its file. The file is moved into the store, replacing the previous kept volume.
+        directory = self.title_directory(manga.title)
+        os.makedirs(directory, exist_ok=True)
+
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+
+        epub_file = os.path.join(directory, os.path.basename(volume["file"]))
+        shutil.move(volume["file"], epub_file)
+
+        index_file = os.path.join(directory, VOLUME_INDEX_FILENAME)
+        with open(index_file + ".tmp", "w") as f:
+            json.dump({**volume, "file": os.path.basename(epub_file)}, f)
+        os.replace(index_file + ".tmp", index_file)
+
+        Log.debug(f"Kept {epub_file} ({len(volume['chapters'])} chapters) to append the next chapters of {manga.title} to it")
@@ -55,6 +55,13 @@ class Cli:
 
         return choice
 
+    @classmethod
+    def select_multiple(self, question: str, choices: List[str], ticked_indices: List[int] = None, return_indices: bool = False, tick_style: str = "pink1", cursor_style: str = "pink1", pagination: bool = False, page_size: int = 5, newline_after_question: bool = False):
+        self.prettyfy()
+
+        Console().print(question) if not newline_after_question else Console().print(question + "\n")
+        return beaupy.select_multiple(choices, ticked_indices=ticked_indices, return_indices=return_indices, tick_style=tick_style, cursor_style=cursor_style, pagination=pagination, page_size=page_size)
+
     @classmethod
     def print(self, text: str, end='\n'):
         self.prettyfy()
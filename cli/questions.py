@@ -1,5 +1,6 @@
 from typing import List, Union
 import os
+import time
 
 from books.models.manga import Manga
 from books.models.lightnovel import Lightnovel
@@ -7,24 +8,59 @@ from books.models.ebook import Ebook
 from cli import Cli, Separator
 from config import SUPPORTED_EBOOK_FORMATS, LOCAL_UPLOADS_DIR
 
-def main_menu():
+def main_menu(running_jobs_count: int = 0, syncing: List[str] = []):
     question = "Which type of books do you want to see ?"
     choices = [
         "Mangas",
         "Lightnovels",
         "Ebooks",
         Separator(),
+        "Background jobs" + (f" ({running_jobs_count} running)" if running_jobs_count else ""),
+        "Sync all titles",
+        Separator(),
         "Quit CoverTheAir"
     ]
 
+    # The menus show what was synced so far
+    if syncing:
+        question += "\n\n" + f"Still syncing {', '.join(syncing)} in the background..."
+        choices.insert(-2, "Refresh")
+
     return Cli.select(question, choices, newline_after_question=True)
 
+def last_synced(book: Union[Manga, Lightnovel]):
+    # Cold titles aren't synced at every launch (see SyncSchedule)
+    if book.last_synced_at is None:
+        return "never synced"
+
+    elapsed = int(time.time() - book.last_synced_at)
+    if elapsed < 60:
+        return "synced just now"
+    elif elapsed < 3600:
+        return f"synced {elapsed // 60} min ago"
+    elif elapsed < 24 * 3600:
+        return f"synced {elapsed // 3600} h ago"
+    else:
+        return f"synced {elapsed // (24 * 3600)} days ago"
+
+def choose_background_job(statuses: List[str]):
+    # Choosing a running job offers to cancel it
+    question = "==== BACKGROUND JOBS ===="
+    choices = list(statuses)
+
+    if not choices:
+        question += "\n\n" + "Nothing running in the background"
+
+    choices.extend([Separator(), "Refresh", "Back"])
+
+    return Cli.select(question, choices, newline_after_question=True, pagination=True, page_size=20)
+
 def choose_manga(mangas: List[Manga]):
     question = "==== MANGAS ===="
     choices = []
 
     for manga in mangas:
-        entry = "{0:60.60}".format(manga.title) + 5 * " " + f"{manga.last_read_chapter}/{len(manga.chapters)}"
+        entry = "{0:60.60}".format(manga.title) + 5 * " " + "{0:12}".format(f"{manga.last_read_chapter}/{len(manga.chapters)}") + last_synced(manga)
         choices.append(entry)
 
     if not choices:
@@ -39,7 +75,7 @@ def choose_lightnovel(lightnovels: List[Lightnovel]):
     choices = []
 
     for lightnovel in lightnovels:
-        entry = "{0:60.60}".format(lightnovel.title) + 5 * " " + f"{lightnovel.last_read_chapter}/{len(lightnovel.chapters)}"
+        entry = "{0:60.60}".format(lightnovel.title) + 5 * " " + "{0:12}".format(f"{lightnovel.last_read_chapter}/{len(lightnovel.chapters)}") + last_synced(lightnovel)
         choices.append(entry)
 
     if not choices:
@@ -82,11 +118,29 @@ def choose_ebook(serie: str, ebooks: List[Ebook]):
 
     if not choices:
         question += "\n\n" + "No ebook found :("
+    else:
+        choices.extend([Separator(), "Send several books to Ebook Reader"])
 
     choices.extend([Separator(), "Back"])
 
     return Cli.select(question, choices, newline_after_question=True, pagination=True, page_size=20)
 
+def choose_ebooks_to_send(serie: str, ebooks: List[Ebook]):
+    question = f"==== {serie.upper()} ====\nWhich books should be sent to the Ebook Reader ? (unread ones are already selected)"
+    choices = []
+    ticked_indices = []
+
+    for idx, ebook in enumerate(ebooks):
+        read_status = "[READ]" if ebook.read else "[NOT READ]"
+        entry = "{0:60.60}".format(ebook.title) + 5 * " " + f"{read_status}"
+        choices.append(entry)
+
+        if not ebook.read:
+            ticked_indices.append(idx)
+
+    selected_indices = Cli.select_multiple(question, choices, ticked_indices=ticked_indices, return_indices=True, pagination=True, page_size=20, newline_after_question=True)
+    return [ebooks[idx] for idx in selected_indices] if selected_indices else []
+
 def choose_action_for_manga_or_lightnovel():
     question = "What do you want to do ?"
     choices = [
@@ -131,7 +185,8 @@ def modify_read_status(book: Ebook):
     question = f"Have you finished reading {book.title} ?"
     return Cli.confirm(question)
 
-def get_chapters_download_count(book: Union[Manga, Lightnovel]):
+def get_chapters_download_count(book: Union[Manga, Lightnovel], ready_count: int = None):
+    # ready_count : how many of the next chapters the daemon already prepared, they only need to be uploaded
     if book.last_read_chapter == len(book.chapters):
         return Cli.select("You have already read every chapter !", ["Back"], newline_after_question=True)
     
@@ -144,6 +199,8 @@ def get_chapters_download_count(book: Union[Manga, Lightnovel]):
     for choice in possible_choices:
         if choice < unread_chapters_count:
             choices.append(choice)
-    choices = [str(choice) for choice in sorted(choices)] + [Separator(), "Back"]
+    if ready_count and ready_count not in choices:
+        choices.append(ready_count)
+    choices = [f"{choice} (ready to send)" if choice == ready_count else str(choice) for choice in sorted(choices)] + [Separator(), "Back"]
 
     return Cli.select(question, choices, newline_after_question=True)
\ No newline at end of file
@@ -1,7 +1,8 @@
 import configparser
 import os
 
-CONFIG_FILE = os.path.join(os.path.dirname(__file__), "cota.cfg")
+# COTA_CONFIG allows running against another configuration (e.g. the benchmarks)
+CONFIG_FILE = os.environ.get("COTA_CONFIG", os.path.join(os.path.dirname(__file__), "cota.cfg"))
 
 def store_in_data_folder(filename: str):
     return os.path.join(os.path.dirname(__file__), "data", filename)
@@ -15,24 +16,64 @@ DOWNLOADS_DIR = store_in_data_folder(settings.get("general", "downloads_dir"))
 LOCAL_UPLOADS_DIR = settings.get("general", "local_uploads_dir")
 LOGFILE = store_in_data_folder(settings.get("general", "logfile"))
 LOG_LEVEL = settings.get("general", "log_level")
+LOG_MAX_SIZE = int(settings.getfloat("general", "log_max_size", fallback=10) * 1024 * 1024)
+LOG_BACKUPS = settings.getint("general", "log_backups", fallback=3)
+PROFILE = settings.getboolean("general", "profile", fallback=False)
+PROFILES_DIR = store_in_data_folder("profiles")
+IMAGE_DEDUP = settings.get("general", "image_dedup", fallback="exact")
+PAGE_CLEANUP = settings.getboolean("general", "page_cleanup", fallback=False)
+PREFETCH_CHAPTERS = settings.getint("general", "prefetch_chapters", fallback=10)
+VOLUME_MAX_PAGES = settings.getint("general", "volume_max_pages", fallback=0)
+VOLUME_MAX_SIZE = int(settings.getfloat("general", "volume_max_size", fallback=0) * 1024 * 1024)
+INCREMENTAL_VOLUMES = settings.getboolean("general", "incremental_volumes", fallback=False)
+VOLUMES_DIR = store_in_data_folder(settings.get("general", "volumes_dir", fallback="volumes"))
+COMICINFO_CACHE_FILE = store_in_data_folder(settings.get("general", "comicinfo_cache", fallback="comicinfo.json"))
+READER_TUNING_FILE = store_in_data_folder(settings.get("general", "reader_tuning", fallback="reader_tuning.json"))
 
 SUPPORTED_EBOOK_FORMATS = ["epub", "pdf"]
 
+# DAEMON
+DAEMON_INTERVAL = int(settings.getfloat("daemon", "interval", fallback=30) * 60)
+DAEMON_PREFETCH_CHAPTERS = settings.getint("daemon", "prefetch_chapters", fallback=10)
+DAEMON_MAX_DOWNLOAD_SPEED = int(settings.getfloat("daemon", "max_download_speed", fallback=0) * 1024)
+DAEMON_BUILD_WORKERS = settings.getint("daemon", "build_workers", fallback=1)
+DAEMON_NICE = settings.getint("daemon", "nice", fallback=10)
+READY_DIR = store_in_data_folder(settings.get("daemon", "ready_dir", fallback="ready"))
+DAEMON_LOGFILE = store_in_data_folder(settings.get("daemon", "logfile", fallback="daemon.log"))
+
 # TRACKED BOOKS
 TRACKED_MANGAS_FILE = store_in_data_folder(settings.get("tracked_books", "manga"))
 TRACKED_LIGHTNOVELS_FILE = store_in_data_folder(settings.get("tracked_books", "lightnovel"))
 TRACKED_EBOOKS_FILE = store_in_data_folder(settings.get("tracked_books", "ebook"))
+HOT_TITLE_PERIOD = int(settings.getfloat("tracked_books", "hot_days", fallback=30) * 24 * 3600)
+COLD_SYNC_INTERVAL = int(settings.getfloat("tracked_books", "cold_sync_interval", fallback=7) * 24 * 3600)
+SYNC_BUDGET = settings.getfloat("tracked_books", "sync_budget", fallback=10)
 
 # MEDIA SERVER
+MEDIA_SERVER_BACKEND = settings.get("media_server", "backend", fallback="sftp")
+MEDIA_SERVER_LOCAL_FETCH = settings.get("media_server", "local_fetch", fallback="auto")
 MEDIA_SERVER_IP = settings.get("media_server", "ip")
-MEDIA_SERVER_PORT = int(settings.get("media_server", "port"))
+MEDIA_SERVER_PORT = int(settings.get("media_server", "port") or 22)
 MEDIA_SERVER_USERNAME = settings.get("media_server", "username")
 MEDIA_SERVER_PASSWORD = settings.get("media_server", "password")
 MEDIA_SERVER_PATH_TO_MANGAS = settings.get("media_server", "path_to_mangas")
 MEDIA_SERVER_PATH_TO_LIGHTNOVELS = settings.get("media_server", "path_to_lightnovels")
 MEDIA_SERVER_PATH_TO_EBOOKS = settings.get("media_server", "path_to_ebooks")
 
-# EBOOK READER
+# EBOOK READERS
+# [ebook_reader] is the main one, books are also sent to every other reader declared in an [ebook_reader.<name>] section
+def read_ebook_reader_settings(section: str):
+    return {
+        "name": settings.get(section, "name", fallback=section.partition(".")[2] or "Ebook Reader"),
+        "ip": settings.get(section, "ip"),
+        "port": int(settings.get(section, "port")),
+        "username": settings.get(section, "username"),
+        "pkey": settings.get(section, "pkey"),
+        "base_path": settings.get(section, "base_path")
+    }
+
+EBOOK_READERS = [read_ebook_reader_settings(section) for section in settings.sections() if section == "ebook_reader" or section.startswith("ebook_reader.")]
+
 EBOOK_READER_IP = settings.get("ebook_reader", "ip")
 EBOOK_READER_PORT = int(settings.get("ebook_reader", "port"))
 EBOOK_READER_USERNAME = settings.get("ebook_reader", "username")
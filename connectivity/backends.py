@@ -0,0 +1,271 @@
+import copy
+import errno
+import os
+from typing import Callable, List
+
+import paramiko
+
+from utils.log import Log
+
+# Linux ioctl cloning a whole file (copy-on-write) on filesystems supporting it (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+LOCAL_FETCH_METHODS = ["reflink", "hardlink", "sendfile", "copy"]
+# Copies report their progress (and can be cancelled from the callback) after each chunk, like SFTP transfers
+LOCAL_COPY_CHUNK_SIZE = 1024 * 1024
+
+def prefer(preferred: List[str], available: tuple):
+    # available with the preferred ones first, those unknown to it being ignored
+    preferred = [name for name in preferred or [] if name in available]
+    return tuple(preferred + [name for name in available if name not in preferred])
+
+
+class StorageBackend:
+    # Where MediaServer reads and writes books, paths are always "/" separated
+
+    description: str = ""
+
+    def connect(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def is_connected(self) -> bool:
+        return True
+
+    def open_session(self) -> "StorageBackend":
+        # A handle which can be used concurrently with the other sessions of the same backend
+        return self
+
+    def close_session(self):
+        pass
+
+    def listdir(self, path: str) -> List[str]:
+        raise NotImplementedError
+
+    def stat(self, path: str):
+        raise NotImplementedError
+
+    def get(self, source_path: str, target_path: str, callback: Callable = None, prefetch: bool = True):
+        # Without prefetch, the next chunk is only requested once callback returned for the previous one
+        raise NotImplementedError
+
+    def put(self, source_path: str, target_path: str, callback: Callable = None):
+        raise NotImplementedError
+
+    def mkdir(self, path: str):
+        raise NotImplementedError
+
+    def remove(self, path: str):
+        raise NotImplementedError
+
+    def rename(self, source_path: str, target_path: str):
+        # Replaces target_path if it exists
+        raise NotImplementedError
+
+    def open(self, path: str, mode: str = "r"):
+        raise NotImplementedError
+
+    def execute(self, command: str):
+        # (exit status, output) of a shell command run where the files are, when the backend allows it
+        raise NotImplementedError
+
+
+class SftpBackend(StorageBackend):
+
+    transport: paramiko.Transport = None
+    sftp: paramiko.SFTPClient = None
+
+    # Preferred ciphers and MACs (e.g. from ReaderTuning), the other ones paramiko supports are still allowed after them
+    ciphers: List[str] = None
+    macs: List[str] = None
+    compression: bool = False
+
+    def __init__(self, ip: str, port: int, username: str, password: str = None, pkey: paramiko.PKey = None, disabled_algorithms: dict = None):
+        self.ip = ip
+        self.port = port
+        self.username = username
+        self.password = password
+        self.pkey = pkey
+        self.disabled_algorithms = disabled_algorithms
+        self.description = f"{username}@{ip}:{port}"
+
+    def connect(self):
+        self.transport = paramiko.Transport((self.ip, self.port), disabled_algorithms=self.disabled_algorithms)
+
+        security_options = self.transport.get_security_options()
+        security_options.ciphers = prefer(self.ciphers, security_options.ciphers)
+        security_options.digests = prefer(self.macs, security_options.digests)
+        self.transport.use_compression(self.compression)
+
+        self.transport.connect(username=self.username, password=self.password, pkey=self.pkey)
+        self.sftp = paramiko.SFTPClient.from_transport(self.transport)
+
+    def disconnect(self):
+        if self.sftp:
+            self.sftp = self.sftp.close()
+        if self.transport:
+            self.transport = self.transport.close()
+
+    def is_connected(self):
+        return self.sftp is not None and self.transport is not None and self.transport.is_active()
+
+    def open_session(self):
+        # Same SSH connection, but its own SFTP channel so that requests don't wait for each other
+        session = copy.copy(self)
+        session.sftp = paramiko.SFTPClient.from_transport(self.transport)
+        return session
+
+    def close_session(self):
+        if self.sftp:
+            self.sftp = self.sftp.close()
+
+    def listdir(self, path: str):
+        return self.sftp.listdir(path)
+
+    def stat(self, path: str):
+        return self.sftp.stat(path)
+
+    def get(self, source_path: str, target_path: str, callback: Callable = None, prefetch: bool = True):
+        self.sftp.get(source_path, target_path, callback=callback, prefetch=prefetch)
+
+    def put(self, source_path: str, target_path: str, callback: Callable = None):
+        self.sftp.put(source_path, target_path, callback=callback)
+
+    def mkdir(self, path: str):
+        self.sftp.mkdir(path)
+
+    def remove(self, path: str):
+        self.sftp.remove(path)
+
+    def rename(self, source_path: str, target_path: str):
+        # Plain SFTP renames refuse to replace a file, the OpenSSH extension does it atomically
+        try:
+            self.sftp.posix_rename(source_path, target_path)
+        except IOError:
+            try:
+                self.sftp.remove(target_path)
+            except IOError:
+                pass
+            self.sftp.rename(source_path, target_path)
+
+    def open(self, path: str, mode: str = "r"):
+        return self.sftp.open(path, mode)
+
+    def execute(self, command: str):
+        # Fails when the server only allows SFTP
+        channel = self.transport.open_session()
+        try:
+            channel.exec_command(command)
+            output = channel.makefile("rb").read().decode("utf-8", errors="replace")
+            return channel.recv_exit_status(), output
+        finally:
+            channel.close()
+
+
+class LocalBackend(StorageBackend):
+    # For when the library lives on this machine : no SSH at all, and "downloads" avoid copying bytes whenever possible
+
+    def __init__(self, fetch_method: str = "auto"):
+        self.fetch_methods = LOCAL_FETCH_METHODS if fetch_method == "auto" else [fetch_method, "copy"]
+        self.description = "local filesystem"
+
+    def listdir(self, path: str):
+        with os.scandir(path) as entries:
+            return [entry.name for entry in entries]
+
+    def stat(self, path: str):
+        return os.stat(path)
+
+    def get(self, source_path: str, target_path: str, callback: Callable = None, prefetch: bool = True):
+        self._fetch(source_path, target_path, callback=callback)
+
+    def put(self, source_path: str, target_path: str, callback: Callable = None):
+        # Uploaded files stay editable where they come from, so they never share their inode with the library
+        self._fetch(source_path, target_path, [method for method in self.fetch_methods if method != "hardlink"], callback=callback)
+
+    def mkdir(self, path: str):
+        os.mkdir(path)
+
+    def remove(self, path: str):
+        os.remove(path)
+
+    def rename(self, source_path: str, target_path: str):
+        os.replace(source_path, target_path)
+
+    def open(self, path: str, mode: str = "r"):
+        # Binary like SFTP files
+        return open(path, mode if "b" in mode else mode + "b")
+
+    def _fetch(self, source_path: str, target_path: str, methods: List[str] = None, callback: Callable = None):
+        # callback(transferred, total) is called as the file is copied, once at the end for reflinks and hardlinks
+        if os.path.lexists(target_path):
+            os.unlink(target_path)
+
+        for method in methods or self.fetch_methods:
+            try:
+                getattr(self, f"_fetch_with_{method}")(source_path, target_path, callback)
+                Log.debug(f"Fetched {source_path} => {target_path} with {method}")
+                return
+            except OSError as e:
+                # Not supported by the filesystem / OS, or source and target are not on the same device : we try the next method
+                if method == "copy" or e.errno not in (errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS, errno.EMLINK, errno.EACCES):
+                    raise
+                if os.path.lexists(target_path):
+                    os.unlink(target_path)
+            except (AttributeError, ImportError):
+                # Method not available on this platform
+                pass
+
+    def _fetch_with_reflink(self, source_path: str, target_path: str, callback: Callable = None):
+        import fcntl
+
+        with open(source_path, "rb") as source, open(target_path, "wb") as target:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+            size = os.fstat(source.fileno()).st_size
+
+        if callback:
+            callback(size, size)
+
+    def _fetch_with_hardlink(self, source_path: str, target_path: str, callback: Callable = None):
+        # Downloaded files are only ever read or deleted, so sharing the inode with the library is safe
+        os.link(source_path, target_path)
+
+        if callback:
+            size = os.path.getsize(target_path)
+            callback(size, size)
+
+    def _fetch_with_sendfile(self, source_path: str, target_path: str, callback: Callable = None):
+        # In-kernel copy, bytes never go through user space
+        with open(source_path, "rb") as source, open(target_path, "wb") as target:
+            size = os.fstat(source.fileno()).st_size
+            offset = 0
+            while offset < size:
+                sent = os.sendfile(target.fileno(), source.fileno(), offset, min(LOCAL_COPY_CHUNK_SIZE, size - offset))
+                if sent == 0:
+                    break
+                offset += sent
+                if callback:
+                    callback(offset, size)
+
+        # Empty files too
+        if callback and size == 0:
+            callback(0, 0)
+
+    def _fetch_with_copy(self, source_path: str, target_path: str, callback: Callable = None):
+        with open(source_path, "rb") as source, open(target_path, "wb") as target:
+            size = os.fstat(source.fileno()).st_size
+            copied = 0
+            while True:
+                chunk = source.read(LOCAL_COPY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                target.write(chunk)
+                copied += len(chunk)
+                if callback:
+                    callback(copied, size)
+
+        # Empty files too
+        if callback and size == 0:
+            callback(0, 0)
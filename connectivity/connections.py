@@ -0,0 +1,88 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List
+import threading
+import traceback
+
+from connectivity.backends import StorageBackend
+from utils.log import Log
+
+POOL_MAX_IDLE = 2  # Connections kept open per key once released
+
+class ConnectionPool:
+    # Connections opened in the background at launch (see warm_up), so that the first MediaServer or EbookReader
+    # connecting doesn't wait for the handshake, and kept open once released for the next ones.
+    # Keys tell what they connect to and with which settings. Only warmed up keys are pooled : the daemon doesn't use it.
+    # A connection which failed to open in the background isn't handed over : the host may be reachable by the time someone
+    # acquires it (e.g. the reader was asleep at launch), so they connect again themselves.
+
+    pending: Dict[str, List[Future]] = {}
+    idle: Dict[str, List[StorageBackend]] = {}
+    lock = threading.Lock()
+    executor: ThreadPoolExecutor = None
+
+    @classmethod
+    def warm_up(self, key: str, backend: StorageBackend, open_connection: Callable):
+        # open_connection() connects backend, it runs in the background
+        def warm_up_in_thread():
+            Log.debug(f"Opening {key} connection in the background")
+            open_connection()
+            Log.debug(f"{key} connection is ready")
+            return backend
+
+        with self.lock:
+            if self.executor is None:
+                ConnectionPool.executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="connections")
+            self.pending.setdefault(key, []).append(self.executor.submit(warm_up_in_thread))
+            self.idle.setdefault(key, [])
+
+    @classmethod
+    def acquire(self, key: str):
+        # A connected backend for key (waiting for it if it is still opening), None if there is none to take over
+        with self.lock:
+            future = self.pending[key].pop(0) if self.pending.get(key) else None
+
+            backend = None
+            while future is None and self.idle.get(key):
+                backend = self.idle[key].pop()
+                if backend.is_connected():
+                    break
+                # Closed by the other end while nobody was using it
+                backend = None
+
+        if future:
+            try:
+                backend = future.result()
+            except Exception:
+                Log.debug("%s connection failed to open in the background, connecting again\n\n%s", key, traceback.format_exc())
+
+        return backend
+
+    @classmethod
+    def release(self, key: str, backend: StorageBackend):
+        # Whether backend is kept open for the next one to acquire key : it must not be used anymore then
+        with self.lock:
+            if key not in self.idle or not backend.is_connected() or len(self.idle[key]) >= POOL_MAX_IDLE:
+                return False
+
+            self.idle[key].append(backend)
+            return True
+
+    @classmethod
+    def close_all(self):
+        with self.lock:
+            backends = [backend for backends in self.idle.values() for backend in backends]
+            for futures in self.pending.values():
+                for future in futures:
+                    try:
+                        backends.append(future.result())
+                    except Exception:
+                        pass
+
+            ConnectionPool.pending = {}
+            ConnectionPool.idle = {}
+
+        for backend in backends:
+            try:
+                backend.disconnect()
+            except Exception:
+                Log.error("Failed to close pooled connection", traceback.format_exc())
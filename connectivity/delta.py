@@ -0,0 +1,95 @@
+import hashlib
+import shlex
+import traceback
+from typing import List, Tuple
+
+from connectivity.backends import StorageBackend
+from utils.log import Log
+
+DELTA_BLOCK_SIZE = 1024 * 1024
+DELTA_CHUNK_SIZE = 256 * 1024
+
+# md5 of each block of a file, one per line : readers only have busybox, but that's always in it
+REMOTE_HASH_COMMAND = (
+    'f={path}; n=$(( ($(wc -c < "$f") + {block_size} - 1) / {block_size} )); i=0; '
+    'while [ $i -lt $n ]; do dd if="$f" bs={block_size} skip=$i count=1 2>/dev/null | md5sum; i=$((i + 1)); done'
+)
+
+class BlockHasher:
+    # sha256 of a whole file along with the md5 of each of its blocks, fed chunk by chunk (e.g. while relaying it).
+    # Blocks only tell where two versions of a book differ, md5 is more than enough for that.
+
+    def __init__(self, block_size: int = DELTA_BLOCK_SIZE):
+        self.block_size = block_size
+        self.sha256 = hashlib.sha256()
+        self.blocks: List[str] = []
+        self.block = hashlib.md5()
+        self.block_length = 0
+        self.size = 0
+
+    def update(self, data: bytes):
+        self.sha256.update(data)
+        self.size += len(data)
+
+        while data:
+            taken = data[:self.block_size - self.block_length]
+            self.block.update(taken)
+            self.block_length += len(taken)
+            data = data[len(taken):]
+
+            if self.block_length == self.block_size:
+                self.blocks.append(self.block.hexdigest())
+                self.block = hashlib.md5()
+                self.block_length = 0
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+    def digests(self):
+        # Including the last partial block
+        return self.blocks + ([self.block.hexdigest()] if self.block_length else [])
+
+
+def file_blocks(path: str):
+    # (size, sha256, block digests) of a local file
+    hasher = BlockHasher()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(DELTA_CHUNK_SIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return hasher.size, hasher.hexdigest(), hasher.digests()
+
+
+def remote_blocks(backend: StorageBackend, path: str, size: int):
+    # Block digests of a file of the given size, computed where it is. None when the backend can't run commands.
+    try:
+        exit_status, output = backend.execute(REMOTE_HASH_COMMAND.format(path=shlex.quote(path), block_size=DELTA_BLOCK_SIZE))
+    except NotImplementedError:
+        return None
+    except Exception:
+        Log.debug(f"Could not hash {path} remotely : {traceback.format_exc()}")
+        return None
+
+    blocks = [line.split()[0] for line in output.splitlines() if line.strip()]
+    if exit_status != 0 or len(blocks) != -(-size // DELTA_BLOCK_SIZE):
+        Log.debug(f"Could not hash {path} remotely (exit status {exit_status}, {len(blocks)} blocks)")
+        return None
+    return blocks
+
+
+def changed_ranges(local_blocks: List[str], remote_blocks: List[str], size: int) -> List[Tuple[int, int]]:
+    # (offset, length) of the parts of the local file to write over the remote one, consecutive blocks being merged
+    ranges = []
+    for index, digest in enumerate(local_blocks):
+        if index < len(remote_blocks) and remote_blocks[index] == digest:
+            continue
+
+        offset = index * DELTA_BLOCK_SIZE
+        length = min(DELTA_BLOCK_SIZE, size - offset)
+        if ranges and ranges[-1][0] + ranges[-1][1] == offset:
+            ranges[-1] = (ranges[-1][0], ranges[-1][1] + length)
+        else:
+            ranges.append((offset, length))
+    return ranges
@@ -1,38 +1,119 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
+import asyncio
+import contextlib
+import threading
 import traceback
 import paramiko
 import os
 from rich.progress import Progress
 
-from config import EBOOK_READER_IP, EBOOK_READER_PORT, EBOOK_READER_PKEY_FILE, EBOOK_READER_USERNAME, EBOOK_READER_BASE_PATH
+from config import EBOOK_READERS
+from connectivity.backends import StorageBackend, SftpBackend
+from connectivity.connections import ConnectionPool
+from connectivity.delta import BlockHasher, DELTA_BLOCK_SIZE, DELTA_CHUNK_SIZE, changed_ranges, file_blocks, remote_blocks
+from connectivity.manifest import ReaderManifest, file_fingerprint
+from connectivity.relay import relay_stream
+from connectivity.transport import AsyncTransport, DEFAULT_MAX_WORKERS
+from connectivity.tuning import ReaderTuning
 from utils.log import Log
 
+PARTIAL_SUFFIX = ".part"  # Books being sent, see EbookReaderGroup.send
+
 class EbookReader:
 
-    transport = None
-    sftp = None
+    backend: SftpBackend = None
+    async_transport: AsyncTransport = None
+    manifest: ReaderManifest = None
+    bytes_saved: int = 0
+
+    def __init__(self, target: dict = None, book_kind: str = None):
+        # Main reader of cota.cfg unless another one of EBOOK_READERS is given.
+        # book_kind is what is about to be sent (e.g. "lightnovel"), it may get other SSH settings (see ReaderTuning).
+        target = target or EBOOK_READERS[0]
+        self.target = target
+        self.name = target["name"]
+        self.pkey_file = target["pkey"]
+        self.base_path = target["base_path"]
+        self.book_kind = book_kind
+
+        self.backend = self.new_backend()
+        self.manifest = ReaderManifest(self.backend, self.base_path)
+        # Connections with other SSH settings can't be swapped
+        self.pool_key = f"ebook_reader:{self.name}:{'compressed' if self.backend.compression else 'plain'}"
+        # aio() is called from several threads at once (e.g. relay_books), only one transport is opened
+        self.aio_lock = threading.Lock()
+
+    def new_backend(self):
+        backend = SftpBackend(self.target["ip"], self.target["port"], self.target["username"], disabled_algorithms={'pubkeys':['rsa-sha2-512', 'rsa-sha2-256']})
+        ReaderTuning.apply(self.name, backend, self.book_kind)
+        return backend
+
+    def use_backend(self, backend: SftpBackend):
+        self.backend = backend
+        self.manifest.backend = backend
+
+    def warm_up(self):
+        # Loads the key and connects in the background at launch, the first reader connecting takes it over (see ConnectionPool)
+        ConnectionPool.warm_up(self.pool_key, self.backend, self.open_connection)
+
+    def open_connection(self):
+        self.backend.pkey = paramiko.RSAKey.from_private_key_file(self.pkey_file)
+        self.backend.connect()
 
     def connect(self):
         try:
-            Log.info(f"Connecting to ebook reader: {EBOOK_READER_USERNAME}@{EBOOK_READER_IP}:{EBOOK_READER_PORT} with key {EBOOK_READER_PKEY_FILE}")
+            Log.info(f"Connecting to ebook reader {self.name}: {self.backend.description} with key {self.pkey_file}")
 
-            self.transport = paramiko.Transport((EBOOK_READER_IP,EBOOK_READER_PORT), disabled_algorithms={'pubkeys':['rsa-sha2-512', 'rsa-sha2-256']})
-            self.transport.connect(username=EBOOK_READER_USERNAME, pkey=paramiko.RSAKey.from_private_key_file(EBOOK_READER_PKEY_FILE))
-            self.sftp = paramiko.SFTPClient.from_transport(self.transport)
+            backend = ConnectionPool.acquire(self.pool_key)
+            if backend:
+                self.use_backend(backend)
+            else:
+                self.open_connection()
 
             Log.info("Connection successful")
         except:
-            Log.error("Failed to connect to ebook reader", traceback.format_exc())
+            Log.error(f"Failed to connect to ebook reader {self.name}", traceback.format_exc())
+
+    def calibrate(self):
+        # Finds out the fastest SSH settings for this reader, they are used from the next connection on
+        try:
+            self.backend.pkey = paramiko.RSAKey.from_private_key_file(self.pkey_file)
+            tuning = ReaderTuning.calibrate(self.name, self.backend, self.base_path)
+        except Exception:
+            Log.error(f"Failed to calibrate ebook reader {self.name}", traceback.format_exc())
+            tuning = None
+
+        if tuning:
+            print(f"=> {self.name} : {tuning['cipher']} / {tuning['mac']}, compression for {', '.join(tuning['compression']) or 'nothing'}")
+        else:
+            print(f"\n[-] Something went wrong when calibrating {self.name} !")
+        return tuning
 
     def disconnect(self):
         try:
-            Log.info(f"Disconnecting from ebook reader : {EBOOK_READER_USERNAME}@{EBOOK_READER_IP}:{EBOOK_READER_PORT}")
+            Log.info(f"Disconnecting from ebook reader {self.name} : {self.backend.description}")
+
+            with self.aio_lock:
+                if self.async_transport:
+                    self.async_transport = self.async_transport.close()
 
-            self.sftp = self.sftp.close()
-            self.transport = self.transport.close()
+            if ConnectionPool.release(self.pool_key, self.backend):
+                # Someone else may take it over from now on
+                self.use_backend(self.new_backend())
+            else:
+                self.backend.disconnect()
 
             Log.info("Disconnection successful")
         except:
-            Log.error("Failed to disconnect from ebook reader", traceback.format_exc())
+            Log.error(f"Failed to disconnect from ebook reader {self.name}", traceback.format_exc())
+
+    def aio(self):
+        # Async API (list / get / put / stat) running on separate SFTP channels of this connection
+        with self.aio_lock:
+            if not self.async_transport:
+                self.async_transport = AsyncTransport(self.backend, name="ebook-reader")
+            return self.async_transport
 
     def put(self, source_path: str, target_path: str):
         try:
@@ -44,7 +125,7 @@ class EbookReader:
                 def progress_callback(transferred, total):
                     progress.update(task, completed=transferred)
 
-                self.sftp.put(source_path, target_path, callback=progress_callback)
+                self.backend.put(source_path, target_path, callback=progress_callback)
                 Log.debug(f"SFTP PUT {source_path} (HOST) => {target_path} (SERVER)")
                 return True
         except Exception:
@@ -54,36 +135,296 @@ class EbookReader:
     def get(self, source_path: str, target_path: str):
         try:
             with Progress() as progress:
-                progress_bar_length = self.sftp.stat(source_path).st_size
+                progress_bar_length = self.backend.stat(source_path).st_size
                 task = progress.add_task(f"[red]Downloading {source_path} from Ebook Reader", total=progress_bar_length)
 
                 # Define a callback for updating progress
                 def progress_callback(transferred, total):
                     progress.update(task, completed=transferred)
 
-                self.sftp.get(source_path, target_path, callback=progress_callback)
+                self.backend.get(source_path, target_path, callback=progress_callback)
                 Log.debug(f"SFTP GET {source_path} (SERVER) => {target_path} (HOST)")
                 return True
         except Exception:
             Log.error(f"SFTP GET {source_path} (SERVER) => {target_path} (HOST)", traceback.format_exc())
             return False
 
+    @classmethod
+    def book_filename(self, book_title: str):
+        return book_title.replace(" ","_") + ".epub"
+
     def upload_book(self, book_title: str, source_path: str):
         upload_success = False
 
-        if self.sftp:
-            target_path = EBOOK_READER_BASE_PATH + "/" + book_title.replace(" ","_") + ".epub"
+        if self.backend.is_connected():
+            filename = self.book_filename(book_title)
+            target_path = self.base_path + "/" + filename
+
+            # No need to send the book again if the very same file is already on the reader
+            size, sha256 = file_fingerprint(source_path)
+            if self.manifest.is_up_to_date(filename, size, sha256, target_path):
+                self.bytes_saved += size
+                Log.info(f"{filename} is already up to date on ebook reader, skipped upload ({size} bytes saved)")
+                print(f"{filename} is already on the Ebook Reader, skipped upload ({size / 1024 / 1024:.1f} MiB saved)")
+                return True
+
             upload_success = self.put(source_path, target_path)
 
+            if upload_success:
+                self.manifest.record(filename, size, sha256, target_path)
+            else:
+                self.manifest.forget(filename)
+
         return upload_success
 
+    def update_book(self, filename: str, source_path: str, size: int, sha256: str, blocks: List[str], target_path: str, progress: Progress = None):
+        # Only writes the blocks of source_path which differ from the book already on the reader, in place.
+        # The digests of the book on the reader are the ones recorded when uploading it, or else computed on the reader.
+        # Returns the number of bytes written, None when the whole book has to be sent instead.
+        try:
+            remote_size = self.backend.stat(target_path).st_size
+        except IOError:
+            return None
+
+        # Writing in place can't make it smaller
+        if remote_size > size:
+            return None
+
+        reader_blocks = self.manifest.tracked_blocks(filename, target_path, DELTA_BLOCK_SIZE)
+        if reader_blocks is None:
+            reader_blocks = remote_blocks(self.backend, target_path, remote_size)
+        if reader_blocks is None:
+            Log.debug(f"No block digests for {target_path} on ebook reader {self.name}, sending the whole book")
+            return None
+
+        ranges = changed_ranges(blocks, reader_blocks, size)
+        written = sum(length for _, length in ranges)
+        Log.debug(f"Updating {target_path} on ebook reader {self.name} : {len(ranges)} ranges, {written} bytes out of {size}")
+
+        # It doesn't match the manifest anymore until it is recorded again
+        self.manifest.forget(filename)
+
+        try:
+            with contextlib.nullcontext(progress) if progress else Progress() as progress:
+                task = progress.add_task(f"[red]Updating {filename} on {self.name}", total=written)
+
+                with open(source_path, "rb") as source_file, self.backend.open(target_path, "r+b") as target_file:
+                    # SFTP files can send writes without waiting for each acknowledgement
+                    if hasattr(target_file, "set_pipelined"):
+                        target_file.set_pipelined(True)
+
+                    for offset, length in ranges:
+                        source_file.seek(offset)
+                        target_file.seek(offset)
+
+                        while length > 0:
+                            chunk = source_file.read(min(DELTA_CHUNK_SIZE, length))
+                            if not chunk:
+                                raise IOError(f"{source_path} is shorter than {size} bytes")
+                            target_file.write(chunk)
+                            length -= len(chunk)
+                            progress.advance(task, len(chunk))
+        except Exception:
+            Log.error(f"Failed to update {target_path} on ebook reader {self.name}", traceback.format_exc())
+            return None
+
+        self.manifest.record(filename, size, sha256, target_path, blocks=blocks, block_size=DELTA_BLOCK_SIZE)
+        return written
+
+    def has_book(self, filename: str):
+        try:
+            self.backend.stat(self.base_path + "/" + filename)
+            return True
+        except IOError:
+            return False
+
     def retrieve_book(self, book_title: str, target_path: str):
         retrieval_success = False
 
-        if self.sftp:
-            source_path = EBOOK_READER_BASE_PATH + "/" + book_title.replace(" ","_") + ".epub"
+        if self.backend.is_connected():
+            source_path = self.base_path + "/" + self.book_filename(book_title)
             retrieval_success = self.get(source_path, target_path)
 
         return retrieval_success
     
 
+
+class EbookReaderGroup:
+    # Every ebook reader configured in cota.cfg : each book is read once and streamed to all of them at the same time.
+    # A book counts as sent as soon as one reader has it, the status of each one is shown once the transfer is over.
+
+    readers: List[EbookReader] = []
+
+    def __init__(self, book_kind: str = None):
+        self.readers = [EbookReader(target, book_kind) for target in EBOOK_READERS]
+
+    def connect(self):
+        # Handshakes and key loading would add up otherwise
+        with ThreadPoolExecutor(max_workers=len(self.readers)) as executor:
+            list(executor.map(lambda reader: reader.connect(), self.readers))
+
+    def disconnect(self):
+        with ThreadPoolExecutor(max_workers=len(self.readers)) as executor:
+            list(executor.map(lambda reader: reader.disconnect(), self.readers))
+
+    def warm_up(self):
+        for reader in self.readers:
+            reader.warm_up()
+
+    def calibrate(self):
+        # One reader after the other, they would slow each other down otherwise
+        for reader in self.readers:
+            print(f"Calibrating SSH settings for {reader.name}, this takes a while...")
+            reader.calibrate()
+
+    def upload_book(self, book_title: str, source_path: str, progress: Progress = None, quiet: bool = False):
+        filename = EbookReader.book_filename(book_title)
+        size = os.path.getsize(source_path)
+
+        # Hashing reads the whole file once more, only worth it when a reader may already have this book :
+        # either the very same file, or a previous version of it which only needs updating
+        sha256, blocks = None, None
+        if any(reader.manifest.get(filename) or reader.has_book(filename) for reader in self.readers if reader.backend.is_connected()):
+            size, sha256, blocks = file_blocks(source_path)
+
+        def is_up_to_date(reader: EbookReader, target_path: str):
+            return sha256 is not None and reader.manifest.is_up_to_date(filename, size, sha256, target_path)
+
+        def update(reader: EbookReader, target_path: str, progress: Progress):
+            written = reader.update_book(filename, source_path, size, sha256, blocks, target_path, progress) if blocks is not None else None
+            if written is None:
+                return None
+
+            reader.bytes_saved += size - written
+            return f"updated ({written / 1024 / 1024:.1f} MiB sent, {(size - written) / 1024 / 1024:.1f} MiB saved)"
+
+        with open(source_path, "rb") as source_file:
+            # Digests of what is sent, so that the next version of the book only needs updating
+            return self.send(filename, source_file, size, is_up_to_date, update=update, hasher=BlockHasher(), progress=progress, quiet=quiet)
+
+    def relay_book(self, book_title: str, source_file, source_stat, origin: str, sessions: Dict[str, StorageBackend] = None, progress: Progress = None):
+        # Streams an already opened remote file (e.g. from the media server) straight to the readers, without local staging.
+        # origin identifies the source file so that the manifests can tell whether this exact file was already relayed.
+        filename = EbookReader.book_filename(book_title)
+        size = source_stat.st_size
+        origin = f"{origin}:{size}:{int(source_stat.st_mtime)}"
+
+        def is_up_to_date(reader: EbookReader, target_path: str):
+            entry = reader.manifest.get(filename)
+            return entry is not None and entry.get("origin") == origin and reader.manifest.is_up_to_date(filename, size, entry["sha256"], target_path)
+
+        return self.send(filename, source_file, size, is_up_to_date, sessions=sessions, progress=progress, origin=origin)
+
+    async def relay_books(self, books: List[Tuple[str, str, Callable]], on_relayed: Callable = None):
+        # Relays several books at the same time, each one on its own SFTP channel to every reader.
+        # books are (book_title, origin, open_source) tuples, open_source() returning the opened source file and its stat.
+        # It is called from the worker thread doing the relay, so it can use a session of its own too.
+        # on_relayed(book_title, success) is called as soon as each book is done.
+        loop = asyncio.get_running_loop()
+
+        with ThreadPoolExecutor(max_workers=DEFAULT_MAX_WORKERS, thread_name_prefix="ebook-readers") as executor, Progress() as progress:
+            async def relay(book_title: str, origin: str, open_source: Callable):
+                def relay_in_thread():
+                    sessions = {reader.name: reader.aio().session() for reader in self.readers if reader.backend.is_connected()}
+                    source_file, source_stat = open_source()
+                    with source_file:
+                        return self.relay_book(book_title, source_file, source_stat, origin, sessions=sessions, progress=progress)
+
+                try:
+                    success = await loop.run_in_executor(executor, relay_in_thread)
+                except Exception:
+                    Log.error(f"Failed to relay {book_title} to ebook readers", traceback.format_exc())
+                    success = False
+
+                if on_relayed:
+                    on_relayed(book_title, success)
+                return success
+
+            return await asyncio.gather(*[relay(*book) for book in books])
+
+    def send(self, filename: str, source_file, size: int, is_up_to_date: Callable, sessions: Dict[str, StorageBackend] = None, progress: Progress = None, quiet: bool = False,
+             update: Callable = None, hasher: BlockHasher = None, **extra):
+        # quiet : the status of each reader is only logged (e.g. when sending in the background)
+        # update(reader, target_path, progress) writes only what changed in the book already on the reader,
+        # it returns its status or None when the whole book has to be sent. hasher records the block digests of what is sent.
+        # Books are streamed to PARTIAL_SUFFIX files, only renamed once complete : a failed transfer doesn't leave
+        # a truncated book that the reader would list and the next syncs would take for the real one.
+        statuses = {}
+        target_paths = {}
+        target_files = {}
+        target_sessions = {}
+
+        for reader in self.readers:
+            target_path = reader.base_path + "/" + filename
+
+            if not reader.backend.is_connected():
+                statuses[reader.name] = "offline"
+
+            # No need to send the book again if the very same file is already on the reader
+            elif is_up_to_date(reader, target_path):
+                reader.bytes_saved += size
+                Log.info(f"{filename} is already up to date on ebook reader {reader.name}, skipped upload ({size} bytes saved)")
+                statuses[reader.name] = f"already there ({size / 1024 / 1024:.1f} MiB saved)"
+
+            else:
+                status = update(reader, target_path, progress) if update else None
+                if status:
+                    statuses[reader.name] = status
+                    continue
+
+                try:
+                    target_sessions[reader.name] = (sessions or {}).get(reader.name, reader.backend)
+                    target_files[reader.name] = target_sessions[reader.name].open(target_path + PARTIAL_SUFFIX, "wb")
+                    target_paths[reader.name] = target_path
+                except Exception:
+                    Log.error(f"Failed to open {target_path} on ebook reader {reader.name}", traceback.format_exc())
+                    statuses[reader.name] = "failed"
+
+        if target_files:
+            with contextlib.nullcontext(progress) if progress else Progress() as progress:
+                callbacks = {}
+                for name in target_files:
+                    task = progress.add_task(f"[red]Uploading {filename} to {name}", total=size)
+                    callbacks[name] = lambda transferred, total, task=task: progress.update(task, completed=transferred)
+
+                try:
+                    sha256, errors = relay_stream(source_file, target_files, size, callbacks=callbacks, hasher=hasher)
+                except Exception as e:
+                    sha256, errors = None, {name: e for name in target_files}
+
+                for name, target_file in target_files.items():
+                    # Pipelined writes are only acknowledged when closing
+                    try:
+                        target_file.close()
+                    except Exception as e:
+                        errors.setdefault(name, e)
+
+                    partial_path = target_paths[name] + PARTIAL_SUFFIX
+                    try:
+                        if name in errors:
+                            target_sessions[name].remove(partial_path)
+                        else:
+                            target_sessions[name].rename(partial_path, target_paths[name])
+                    except Exception as e:
+                        errors.setdefault(name, e)
+
+            for reader in self.readers:
+                if reader.name not in target_files:
+                    continue
+
+                if reader.name in errors:
+                    Log.error(f"Failed to upload {filename} to ebook reader {reader.name}", "".join(traceback.format_exception(errors[reader.name])))
+                    reader.manifest.forget(filename)
+                    statuses[reader.name] = "failed"
+                else:
+                    Log.debug(f"PUT {filename} => {target_paths[reader.name]} ({reader.name})")
+                    blocks = {"blocks": hasher.digests(), "block_size": hasher.block_size} if hasher else {}
+                    reader.manifest.record(filename, size, sha256, target_paths[reader.name], **extra, **blocks)
+                    statuses[reader.name] = "sent"
+
+        for name, status in statuses.items():
+            Log.debug(f"{filename} on ebook reader {name} : {status}")
+            if not quiet:
+                print(f"- {name} : {filename} {status}")
+
+        return any(status != "offline" and status != "failed" for status in statuses.values())
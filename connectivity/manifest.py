@@ -0,0 +1,103 @@
+import hashlib
+import json
+import threading
+import time
+import traceback
+
+from connectivity.backends import StorageBackend
+from utils.log import Log
+
+MANIFEST_FILENAME = ".covertheair_manifest.json"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def file_fingerprint(path: str):
+    # (size, sha256) of a local file
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            sha256.update(chunk)
+            size += len(chunk)
+    return size, sha256.hexdigest()
+
+
+class ReaderManifest:
+    # Kept on the ebook reader next to the books : what we uploaded there (size, hash and the remote mtime after upload).
+    # A book is only considered already uploaded if the remote file still has the size and mtime we recorded.
+
+    def __init__(self, backend: StorageBackend, base_path: str):
+        self.backend = backend
+        self.path = base_path + "/" + MANIFEST_FILENAME
+        self.entries = None
+        # Books can be uploaded concurrently, they all share this manifest and the main connection to update it
+        self.lock = threading.RLock()
+
+    def load(self):
+        with self.lock:
+            if self.entries is not None:
+                return self.entries
+
+            try:
+                with self.backend.open(self.path, "r") as f:
+                    self.entries = json.loads(f.read()).get("files", {})
+            except IOError:
+                Log.debug(f"No manifest found on ebook reader ({self.path})")
+                self.entries = {}
+            except Exception:
+                Log.error(f"Failed to read manifest from ebook reader ({self.path}), ignoring it", traceback.format_exc())
+                self.entries = {}
+
+            return self.entries
+
+    def save(self):
+        with self.lock:
+            try:
+                with self.backend.open(self.path, "w") as f:
+                    f.write(json.dumps({"files": self.load()}).encode("utf-8"))
+            except Exception:
+                Log.error(f"Failed to write manifest to ebook reader ({self.path})", traceback.format_exc())
+
+    def get(self, filename: str):
+        return self.load().get(filename)
+
+    def is_up_to_date(self, filename: str, size: int, sha256: str, remote_path: str):
+        entry = self.get(filename)
+        if not entry or entry["size"] != size or entry["sha256"] != sha256:
+            return False
+
+        return self.is_unchanged(entry, remote_path)
+
+    def tracked_blocks(self, filename: str, remote_path: str, block_size: int):
+        # Block digests recorded when uploading the file (see connectivity.delta), if it wasn't modified since
+        entry = self.get(filename)
+        if not entry or entry.get("block_size") != block_size or not self.is_unchanged(entry, remote_path):
+            return None
+        return entry["blocks"]
+
+    def is_unchanged(self, entry: dict, remote_path: str):
+        try:
+            with self.lock:
+                remote_stat = self.backend.stat(remote_path)
+        except IOError:
+            return False
+
+        return remote_stat.st_size == entry["size"] and int(remote_stat.st_mtime) == entry["mtime"]
+
+    def record(self, filename: str, size: int, sha256: str, remote_path: str, **extra):
+        with self.lock:
+            try:
+                mtime = int(self.backend.stat(remote_path).st_mtime)
+            except IOError:
+                Log.warning(f"Could not stat {remote_path} after upload, not recording it in the manifest")
+                return
+
+            self.load()[filename] = {"size": size, "sha256": sha256, "mtime": mtime, "uploaded_at": int(time.time()), **extra}
+            self.save()
+
+    def forget(self, filename: str):
+        with self.lock:
+            if self.load().pop(filename, None) is not None:
+                self.save()
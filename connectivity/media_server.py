@@ -1,25 +1,52 @@
-import paramiko
+from typing import Callable, List
+import asyncio
+import threading
 import traceback
 import os
 
 from config import (
-    MEDIA_SERVER_IP, MEDIA_SERVER_PORT, MEDIA_SERVER_USERNAME, MEDIA_SERVER_PASSWORD, 
+    MEDIA_SERVER_BACKEND, MEDIA_SERVER_LOCAL_FETCH, MEDIA_SERVER_IP, MEDIA_SERVER_PORT, MEDIA_SERVER_USERNAME, MEDIA_SERVER_PASSWORD,
     MEDIA_SERVER_PATH_TO_MANGAS, MEDIA_SERVER_PATH_TO_LIGHTNOVELS, MEDIA_SERVER_PATH_TO_EBOOKS,
     SUPPORTED_EBOOK_FORMATS)
+from connectivity.backends import StorageBackend, SftpBackend, LocalBackend
+from connectivity.connections import ConnectionPool
+from connectivity.transport import AsyncTransport
 from utils.log import Log
+from utils.throttle import BandwidthLimiter
 
 class MediaServer:
 
-    transport = None
-    sftp = None
+    backend: StorageBackend = None
+    async_transport: AsyncTransport = None
+
+    pool_key = "media_server"
+
+    def __init__(self):
+        self.backend = self.new_backend()
+        # aio() is called from several threads at once (e.g. EbookReaderGroup.relay_books), only one transport is opened
+        self.aio_lock = threading.Lock()
+
+    def new_backend(self):
+        if MEDIA_SERVER_BACKEND == "local":
+            return LocalBackend(MEDIA_SERVER_LOCAL_FETCH)
+        return SftpBackend(MEDIA_SERVER_IP, MEDIA_SERVER_PORT, MEDIA_SERVER_USERNAME, password=MEDIA_SERVER_PASSWORD)
+
+    @classmethod
+    def warm_up(self):
+        # Connects in the background at launch, the first MediaServer connecting takes it over (see ConnectionPool)
+        if MEDIA_SERVER_BACKEND != "local":
+            backend = MediaServer().backend
+            ConnectionPool.warm_up(self.pool_key, backend, backend.connect)
 
     def connect(self):
         try:
-            Log.debug(f"Connecting to media server : {MEDIA_SERVER_USERNAME}@{MEDIA_SERVER_IP}:{MEDIA_SERVER_PORT}")
+            Log.debug(f"Connecting to media server : {self.backend.description}")
 
-            self.transport = paramiko.Transport((MEDIA_SERVER_IP,MEDIA_SERVER_PORT))
-            self.transport.connect(username=MEDIA_SERVER_USERNAME, password=MEDIA_SERVER_PASSWORD)
-            self.sftp = paramiko.SFTPClient.from_transport(self.transport)
+            backend = ConnectionPool.acquire(self.pool_key)
+            if backend:
+                self.backend = backend
+            else:
+                self.backend.connect()
 
             Log.debug("Connection successful")
         except:
@@ -27,41 +54,64 @@ class MediaServer:
 
     def disconnect(self):
         try:
-            if self.sftp and self.transport:
-                Log.debug(f"Disconnecting from media server : {MEDIA_SERVER_USERNAME}@{MEDIA_SERVER_IP}:{MEDIA_SERVER_PORT}")
+            if self.backend.is_connected():
+                Log.debug(f"Disconnecting from media server : {self.backend.description}")
+
+                with self.aio_lock:
+                    if self.async_transport:
+                        self.async_transport = self.async_transport.close()
 
-                self.sftp = self.sftp.close()
-                self.transport = self.transport.close()
+                if ConnectionPool.release(self.pool_key, self.backend):
+                    # Someone else may take it over from now on
+                    self.backend = self.new_backend()
+                else:
+                    self.backend.disconnect()
 
                 Log.debug("Disconnection successful")
         except:
             Log.error("Failed to disconnect from media server", traceback.format_exc())
 
+    def aio(self):
+        # Async API (list / get / put / stat) running on separate sessions of this connection
+        with self.aio_lock:
+            if not self.async_transport:
+                self.async_transport = AsyncTransport(self.backend, name="media-server")
+            return self.async_transport
+
+    async def async_get(self, source_path: str, target_path: str, callback: Callable = None, limiter: BandwidthLimiter = None):
+        try:
+            await self.aio().get(source_path, target_path, callback=callback, limiter=limiter)
+            Log.debug(f"GET {source_path} (SERVER) => {target_path} (HOST)")
+            return True
+        except Exception:
+            Log.error(f"GET {source_path} (SERVER) => {target_path} (HOST)", traceback.format_exc())
+            return False
+
     def put(self, source_path: str, target_path: str):
         try:
-            self.sftp.put(source_path, target_path)
-            Log.debug(f"SFTP PUT {source_path} (HOST) => {target_path} (SERVER)")
+            self.backend.put(source_path, target_path)
+            Log.debug(f"PUT {source_path} (HOST) => {target_path} (SERVER)")
             return True
         except Exception:
-            Log.error(f"SFTP PUT {source_path} (HOST) => {target_path} (SERVER)", traceback.format_exc())
+            Log.error(f"PUT {source_path} (HOST) => {target_path} (SERVER)", traceback.format_exc())
             return False
 
     def get(self, source_path: str, target_path: str):
         try:
-            self.sftp.get(source_path, target_path)
-            Log.debug(f"SFTP GET {source_path} (SERVER) => {target_path} (HOST)")
+            self.backend.get(source_path, target_path)
+            Log.debug(f"GET {source_path} (SERVER) => {target_path} (HOST)")
             return True
         except Exception:
-            Log.error(f"SFTP GET {source_path} (SERVER) => {target_path} (HOST)", traceback.format_exc())
+            Log.error(f"GET {source_path} (SERVER) => {target_path} (HOST)", traceback.format_exc())
             return False
         
     def mkdir(self, path: str):
         try:
-            self.sftp.mkdir(path)
-            Log.debug(f"SFTP MKDIR {path}")
+            self.backend.mkdir(path)
+            Log.debug(f"MKDIR {path}")
             return True
         except Exception:
-            Log.error(f"SFTP MKDIR {path}", traceback.format_exc())
+            Log.error(f"MKDIR {path}", traceback.format_exc())
             return False
 
     ######### MANGAS #########
@@ -70,25 +120,27 @@ class MediaServer:
         Log.info("Retrieving mangas from media server")
 
         mangas_in_media_server = []
-        sources = self.sftp.listdir(MEDIA_SERVER_PATH_TO_MANGAS)
+        sources = self.backend.listdir(MEDIA_SERVER_PATH_TO_MANGAS)
 
-        Log.debug("Found sources : " + ", ".join(sources))
+        if Log.debug_enabled():
+            Log.debug("Found sources : %s", ", ".join(sources))
         
         for source in sources:
-            downloaded_mangas = self.sftp.listdir(MEDIA_SERVER_PATH_TO_MANGAS + "/" + source)
+            downloaded_mangas = self.backend.listdir(MEDIA_SERVER_PATH_TO_MANGAS + "/" + source)
             for downloaded_manga in downloaded_mangas:
                 mangas_in_media_server.append({"title": downloaded_manga, "source": source})
 
-        Log.debug("Found mangas : " + ", ".join([manga["title"] for manga in mangas_in_media_server]))
+        if Log.debug_enabled():
+            Log.debug("Found mangas : %s", ", ".join([manga["title"] for manga in mangas_in_media_server]))
         
         return mangas_in_media_server
 
     def list_manga_chapters(self, manga_title: str, manga_source: str):
-        Log.debug(f"Retrieving chapters from {manga_title} [{manga_source}]")
+        Log.debug("Retrieving chapters from %s [%s]", manga_title, manga_source)
         
-        chapters = [file for file in self.sftp.listdir(MEDIA_SERVER_PATH_TO_MANGAS + "/" + manga_source + "/" + manga_title) if file.endswith(".cbz")]
+        chapters = [file for file in self.backend.listdir(MEDIA_SERVER_PATH_TO_MANGAS + "/" + manga_source + "/" + manga_title) if file.endswith(".cbz")]
         
-        Log.debug(f"Found {len(chapters)} chapters for {manga_title}")
+        Log.debug("Found %d chapters for %s", len(chapters), manga_title)
         
         return chapters
     
@@ -99,23 +151,37 @@ class MediaServer:
         target_path = target_dir + "/" + chapter_name
         self.get(source_path, target_path)
 
+    async def download_manga_chapters(self, manga_title: str, manga_source: str, chapter_names: List[str], target_dir: str, on_downloaded: Callable = None, callback: Callable = None, limiter: BandwidthLimiter = None):
+        # Downloads chapters concurrently, on_downloaded(chapter_name, success) is called as each one finishes
+        # and callback(transferred, total) as each one progresses. limiter keeps them under its speed altogether.
+        async def download(chapter_name: str):
+            Log.debug(f"Downloading {chapter_name} for {manga_title} [target_dir = {target_dir}]")
+            source_path = MEDIA_SERVER_PATH_TO_MANGAS + "/" + manga_source + "/" + manga_title + "/" + chapter_name
+            success = await self.async_get(source_path, target_dir + "/" + chapter_name, callback=callback, limiter=limiter)
+            if on_downloaded:
+                on_downloaded(chapter_name, success)
+            return success
+
+        return await asyncio.gather(*[download(chapter_name) for chapter_name in chapter_names])
+
     ######### LIGHTNOVELS #########
 
     def list_lightnovels(self):
         Log.info("Retrieving lightnovels from media server")
 
-        lightnovels_in_media_server = [{"title": directory_name} for directory_name in self.sftp.listdir(MEDIA_SERVER_PATH_TO_LIGHTNOVELS)]
+        lightnovels_in_media_server = [{"title": directory_name} for directory_name in self.backend.listdir(MEDIA_SERVER_PATH_TO_LIGHTNOVELS)]
 
-        Log.debug("Found lightnovels : " + ", ".join([lightnovel["title"] for lightnovel in lightnovels_in_media_server]))
+        if Log.debug_enabled():
+            Log.debug("Found lightnovels : %s", ", ".join([lightnovel["title"] for lightnovel in lightnovels_in_media_server]))
 
         return lightnovels_in_media_server
 
     def list_lightnovel_chapters(self, lightnovel_title: str):
-        Log.debug(f"Retrieving chapters from {lightnovel_title}")
+        Log.debug("Retrieving chapters from %s", lightnovel_title)
         
-        chapters = [file for file in self.sftp.listdir(MEDIA_SERVER_PATH_TO_LIGHTNOVELS + "/" + lightnovel_title) if file.endswith(".epub")]
+        chapters = [file for file in self.backend.listdir(MEDIA_SERVER_PATH_TO_LIGHTNOVELS + "/" + lightnovel_title) if file.endswith(".epub")]
         
-        Log.debug(f"Found {len(chapters)} chapters for {lightnovel_title}")
+        Log.debug("Found %d chapters for %s", len(chapters), lightnovel_title)
 
         return chapters
 
@@ -126,6 +192,19 @@ class MediaServer:
         target_path = target_dir + "/" + chapter_name
         self.get(source_path, target_path)
 
+    async def download_lightnovel_chapters(self, lightnovel_title: str, chapter_names: List[str], target_dir: str, on_downloaded: Callable = None, callback: Callable = None, limiter: BandwidthLimiter = None):
+        # Downloads chapters concurrently, on_downloaded(chapter_name, success) is called as each one finishes
+        # and callback(transferred, total) as each one progresses. limiter keeps them under its speed altogether.
+        async def download(chapter_name: str):
+            Log.debug(f"Downloading {chapter_name} for {lightnovel_title} [target_dir = {target_dir}]")
+            source_path = MEDIA_SERVER_PATH_TO_LIGHTNOVELS + "/" + lightnovel_title + "/" + chapter_name
+            success = await self.async_get(source_path, target_dir + "/" + chapter_name, callback=callback, limiter=limiter)
+            if on_downloaded:
+                on_downloaded(chapter_name, success)
+            return success
+
+        return await asyncio.gather(*[download(chapter_name) for chapter_name in chapter_names])
+
     ######### EBOOKS #########
 
     def list_ebooks(self):
@@ -133,17 +212,19 @@ class MediaServer:
 
         ebooks = []
 
-        series_found_in_media_server = self.sftp.listdir(MEDIA_SERVER_PATH_TO_EBOOKS)
-        Log.debug("Found series : " + ", ".join(series_found_in_media_server))
+        series_found_in_media_server = self.backend.listdir(MEDIA_SERVER_PATH_TO_EBOOKS)
+        if Log.debug_enabled():
+            Log.debug("Found series : %s", ", ".join(series_found_in_media_server))
 
         for series in series_found_in_media_server:
-            ebook_files = [file for file in self.sftp.listdir(MEDIA_SERVER_PATH_TO_EBOOKS + "/" + series) if file.split(".")[-1] in SUPPORTED_EBOOK_FORMATS]
+            ebook_files = [file for file in self.backend.listdir(MEDIA_SERVER_PATH_TO_EBOOKS + "/" + series) if file.split(".")[-1] in SUPPORTED_EBOOK_FORMATS]
             for ebook_file in ebook_files:
                 ebook_title = ".".join(ebook_file.split(".")[0:-1])
                 ebook_filetype = ebook_file.split(".")[-1]
                 ebooks.append({"title": ebook_title, "series": series, "filetype": ebook_filetype})
 
-            Log.debug("Found ebooks : " + ", ".join([ebook["title"] for ebook in ebooks]))
+        if Log.debug_enabled():
+            Log.debug("Found ebooks : %s", ", ".join([ebook["title"] for ebook in ebooks]))
 
         return ebooks
 
@@ -156,6 +237,16 @@ class MediaServer:
         self.mkdir(MEDIA_SERVER_PATH_TO_EBOOKS + "/" + series)
         self.put(source_path, target_path)
 
+    def open_ebook(self, ebook_title: str, ebook_filetype: str, ebook_series: str, session: StorageBackend = None):
+        # Returns the opened remote file with its stat, to stream it somewhere else without local staging.
+        # A session (see aio().session()) can be given to read several ebooks at the same time.
+        source_path = MEDIA_SERVER_PATH_TO_EBOOKS + "/" + ebook_series + "/" + f"{ebook_title}.{ebook_filetype}"
+        Log.debug(f"Opening {source_path}")
+
+        backend = session or self.backend
+        source_stat = backend.stat(source_path)
+        return backend.open(source_path, "rb"), source_stat
+
     def download_ebook(self, ebook_title: str, ebook_filetype: str, ebook_series: str, target_dir: str):
         Log.debug(f"Downloading {ebook_title} [target_dir = {target_dir}]")
 
@@ -0,0 +1,93 @@
+from typing import Callable, List
+import asyncio
+import os
+import shutil
+import threading
+import traceback
+
+from connectivity.media_server import MediaServer
+from utils.log import Log
+
+class ChapterPrefetcher:
+    # Downloads chapters in the background, on its own media server connection, before we know whether they are wanted.
+    # take() hands over the wanted ones and cancels the others, cancel() drops everything : transfers still running
+    # stop at their next chunk (see AsyncTransport) and nothing is left behind in directory.
+    # download(media_server, chapter_names, target_dir) is the media server coroutine downloading chapters of the title.
+
+    def __init__(self, chapters: List[str], directory: str, download: Callable):
+        self.chapters = chapters
+        self.directory = directory
+        self.download = download
+
+        self.downloaded = set()
+        self.unwanted = set()
+        self.tasks = {}
+        self.loop = None
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name="prefetch", daemon=True)
+
+    def start(self):
+        Log.debug(f"Prefetching {', '.join(self.chapters)} into {self.directory}")
+        os.makedirs(self.directory, exist_ok=True)
+        self.thread.start()
+        return self
+
+    def run(self):
+        media_server = MediaServer()
+        try:
+            media_server.connect()
+            asyncio.run(self.download_all(media_server))
+        except Exception:
+            Log.error(f"Failed to prefetch chapters into {self.directory}", traceback.format_exc())
+
+        media_server.disconnect()
+
+    async def download_all(self, media_server: MediaServer):
+        async def download_chapter(chapter_name: str):
+            results = await self.download(media_server, [chapter_name], self.directory)
+            if all(results):
+                self.downloaded.add(chapter_name)
+
+        with self.lock:
+            self.loop = asyncio.get_running_loop()
+            # One task per chapter, so that the unwanted ones can be cancelled on their own
+            self.tasks = {chapter_name: asyncio.ensure_future(download_chapter(chapter_name)) for chapter_name in self.chapters if chapter_name not in self.unwanted}
+
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+
+    def cancel_chapters(self, chapter_names: set):
+        def cancel_tasks():
+            for chapter_name, task in self.tasks.items():
+                if chapter_name in chapter_names:
+                    task.cancel()
+
+        with self.lock:
+            self.unwanted |= chapter_names
+            if self.loop and not self.loop.is_closed():
+                try:
+                    self.loop.call_soon_threadsafe(cancel_tasks)
+                except RuntimeError:
+                    # The loop closed in the meantime, every download is already over
+                    pass
+
+    def take(self, chapter_names: List[str], target_dir: str):
+        # Waits for the wanted chapters still downloading and moves them to target_dir, the others are cancelled.
+        # Returns the chapters moved, the remaining ones have to be downloaded as usual.
+        self.cancel_chapters(set(self.chapters) - set(chapter_names))
+        self.thread.join()
+
+        taken = []
+        for chapter_name in chapter_names:
+            if chapter_name in self.downloaded:
+                os.replace(os.path.join(self.directory, chapter_name), os.path.join(target_dir, chapter_name))
+                taken.append(chapter_name)
+
+        Log.debug(f"{len(taken)} chapters out of {len(chapter_names)} were already prefetched")
+        self.cancel()
+        return taken
+
+    def cancel(self):
+        self.cancel_chapters(set(self.chapters))
+        if self.thread.is_alive():
+            self.thread.join()
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,96 @@
+import hashlib
+import queue
+import threading
+from typing import Callable, Dict
+
+RELAY_CHUNK_SIZE = 256 * 1024
+RELAY_BUFFER_CHUNKS = 16  # At most 4 MiB in memory per target
+
+class RelayError(Exception):
+    pass
+
+
+def relay_stream(source, targets: Dict[str, object], size: int, callbacks: Dict[str, Callable] = None, hasher=None):
+    # Streams size bytes from the source file object to every target file object at once.
+    # The source is read only once : each target is written by its own thread from its own bounded buffer,
+    # so reading overlaps with writing and a slow target only holds back the reading, not the other targets.
+    # A failing target is dropped without stopping the others.
+    # Returns the sha256 of the relayed bytes and the error of each failed target.
+    # hasher replaces the sha256 computed along the way, to get more out of the bytes read (e.g. a delta.BlockHasher).
+    callbacks = callbacks or {}
+    buffers = {name: queue.Queue(maxsize=RELAY_BUFFER_CHUNKS) for name in targets}
+    errors = {}
+    stop_event = threading.Event()
+    end_of_stream = object()
+
+    def write_target(name: str):
+        target = targets[name]
+        transferred = 0
+
+        try:
+            # SFTP files can send writes without waiting for each acknowledgement
+            if hasattr(target, "set_pipelined"):
+                target.set_pipelined(True)
+
+            while True:
+                try:
+                    chunk = buffers[name].get(timeout=0.5)
+                except queue.Empty:
+                    if stop_event.is_set():
+                        raise RelayError("Relay stopped before the end of the stream")
+                    continue
+
+                if chunk is end_of_stream:
+                    break
+
+                target.write(chunk)
+                transferred += len(chunk)
+                if name in callbacks:
+                    callbacks[name](transferred, size)
+        except Exception as e:
+            errors[name] = e
+
+    def put(name: str, item):
+        # Gives up as soon as the target failed, it doesn't read its buffer anymore
+        while name not in errors and not stop_event.is_set():
+            try:
+                buffers[name].put(item, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+
+    writers = [threading.Thread(target=write_target, args=(name,), daemon=True) for name in targets]
+    for writer in writers:
+        writer.start()
+
+    sha256 = hasher or hashlib.sha256()
+    read = 0
+
+    try:
+        # SFTP files can request the whole file ahead of time instead of waiting for each chunk
+        if hasattr(source, "prefetch"):
+            source.prefetch(size)
+
+        while len(errors) < len(targets):
+            chunk = source.read(RELAY_CHUNK_SIZE)
+            if not chunk:
+                break
+
+            sha256.update(chunk)
+            read += len(chunk)
+            for name in targets:
+                put(name, chunk)
+
+        if len(errors) < len(targets) and read != size:
+            raise RelayError(f"Read {read} bytes out of {size}")
+
+        for name in targets:
+            put(name, end_of_stream)
+    except Exception as e:
+        stop_event.set()
+        raise RelayError("Failed to read from source") from e
+    finally:
+        for writer in writers:
+            writer.join()
+
+    return sha256.hexdigest(), errors
@@ -0,0 +1,117 @@
+import asyncio
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List
+
+from connectivity.backends import StorageBackend
+from utils.log import Log
+from utils.throttle import BandwidthLimiter
+
+DEFAULT_MAX_WORKERS = 4
+
+class TransferCancelled(Exception):
+    def __str__(self):
+        return "Transfer has been cancelled!"
+
+
+class AsyncTransport:
+    # asyncio API on top of a StorageBackend shared by MediaServer and EbookReader.
+    # The blocking work runs in a dedicated executor, each worker thread using its own session (SFTP channel),
+    # so several operations can run at the same time. Cancelling the awaiting task aborts a running transfer
+    # at its next chunk and removes the partially written file.
+
+    def __init__(self, backend: StorageBackend, max_workers: int = DEFAULT_MAX_WORKERS, name: str = "transport"):
+        self.backend = backend
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self.local = threading.local()
+        self.sessions = []
+        self.sessions_lock = threading.Lock()
+
+    async def list(self, path: str) -> List[str]:
+        return await self._run(lambda session, cancel_event: session.listdir(path))
+
+    async def stat(self, path: str):
+        return await self._run(lambda session, cancel_event: session.stat(path))
+
+    async def get(self, source_path: str, target_path: str, callback: Callable = None, limiter: BandwidthLimiter = None):
+        # With a limiter, chunks are requested one after the other as it lets them through : prefetching would download
+        # the whole file at full speed whatever the limiter does
+        if limiter and not limiter.is_limiting():
+            limiter = None
+
+        return await self._run(lambda session, cancel_event: self._transfer(functools.partial(session.get, prefetch=limiter is None), source_path, target_path, callback, cancel_event, local_target=True, limiter=limiter))
+
+    async def put(self, source_path: str, target_path: str, callback: Callable = None):
+        return await self._run(lambda session, cancel_event: self._transfer(session.put, source_path, target_path, callback, cancel_event, local_target=False))
+
+    async def run(self, function: Callable):
+        # Runs function(session) in the executor, for operations the API above doesn't cover
+        return await self._run(lambda session, cancel_event: function(session))
+
+    def session(self):
+        # Session of the calling thread, opened on first use and closed with the transport.
+        # Lets a job running in another transport's executor use this connection on its own channel too.
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = self.backend.open_session()
+            self.local.session = session
+            with self.sessions_lock:
+                self.sessions.append(session)
+        return session
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        with self.sessions_lock:
+            for session in self.sessions:
+                try:
+                    session.close_session()
+                except Exception:
+                    pass
+            self.sessions = []
+
+    async def _run(self, function: Callable):
+        cancel_event = threading.Event()
+        future = asyncio.get_running_loop().run_in_executor(self.executor, self._call_in_session, function, cancel_event)
+        try:
+            return await future
+        except asyncio.CancelledError:
+            # The worker thread can't be interrupted, it will stop by itself at the next progress callback
+            cancel_event.set()
+            raise
+
+    def _call_in_session(self, function: Callable, cancel_event: threading.Event):
+        if cancel_event.is_set():
+            raise TransferCancelled()
+        return function(self.session(), cancel_event)
+
+    def _transfer(self, transfer: Callable, source_path: str, target_path: str, callback: Callable, cancel_event: threading.Event, local_target: bool, limiter: BandwidthLimiter = None):
+        def progress_callback(transferred, total):
+            if cancel_event.is_set():
+                raise TransferCancelled()
+            if limiter:
+                limiter.progress_callback(transferred, total)
+            if callback:
+                callback(transferred, total)
+
+        try:
+            transfer(source_path, target_path, callback=progress_callback)
+        except TransferCancelled:
+            Log.debug(f"Transfer of {source_path} => {target_path} cancelled")
+            self._remove_partial_file(target_path, local_target)
+            raise
+        finally:
+            # What this file went through doesn't count for the next one of this thread
+            if limiter:
+                limiter.reset()
+
+    def _remove_partial_file(self, path: str, local: bool):
+        try:
+            if local:
+                if os.path.lexists(path):
+                    os.unlink(path)
+            else:
+                self.session().remove(path)
+        except Exception:
+            Log.warning(f"Could not remove partially transferred {path}")
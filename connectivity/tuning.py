@@ -0,0 +1,170 @@
+import io
+import json
+import os
+import random
+import statistics
+import time
+import traceback
+import zipfile
+from typing import List
+
+import paramiko
+
+from connectivity.backends import SftpBackend
+from utils.log import Log
+
+from config import READER_TUNING_FILE
+
+CALIBRATION_SAMPLE_SIZE = 4 * 1024 * 1024
+CALIBRATION_CHUNK_SIZE = 256 * 1024
+CALIBRATION_RUNS = 5  # Uploads of the sample per setting, the median one counts
+CALIBRATION_FILENAME = ".covertheair_calibration"
+
+# Book kinds worth trying SSH compression for : manga pages are JPEG / PNG, there is nothing left to compress
+COMPRESSIBLE_BOOK_KINDS = ["lightnovel"]
+
+class ReaderTuning:
+    # SSH settings measured as the fastest for each ebook reader (by name) by covertheair.py calibrate,
+    # kept in READER_TUNING_FILE : {"cipher", "mac", "compression": [book kinds], "throughputs": {setting: bytes/s}}.
+    # E-readers have weak CPUs, the cipher and MAC make most of the upload speed.
+
+    tunings: dict = None
+
+    @classmethod
+    def load(self):
+        if self.tunings is None:
+            ReaderTuning.tunings = {}
+            if os.path.isfile(READER_TUNING_FILE):
+                try:
+                    with open(READER_TUNING_FILE, "r") as f:
+                        ReaderTuning.tunings = json.load(f)
+                except Exception:
+                    Log.error(f"Failed to read {READER_TUNING_FILE}, using default SSH settings", traceback.format_exc())
+        return self.tunings
+
+    @classmethod
+    def save(self):
+        with open(READER_TUNING_FILE + ".tmp", "w") as f:
+            json.dump(self.load(), f, indent=4)
+        os.replace(READER_TUNING_FILE + ".tmp", READER_TUNING_FILE)
+
+    @classmethod
+    def get(self, reader_name: str):
+        return self.load().get(reader_name)
+
+    @classmethod
+    def apply(self, reader_name: str, backend: SftpBackend, book_kind: str = None):
+        tuning = self.get(reader_name)
+        if not tuning:
+            return
+
+        backend.ciphers = [tuning["cipher"]]
+        backend.macs = [tuning["mac"]]
+        backend.compression = book_kind in tuning["compression"]
+        Log.debug(f"Using {tuning['cipher']} / {tuning['mac']}{' with compression' if backend.compression else ''} for ebook reader {reader_name}")
+
+    @classmethod
+    def calibrate(self, reader_name: str, backend: SftpBackend, base_path: str):
+        # Uploads samples (CALIBRATION_RUNS times) with each cipher, then each MAC with the fastest cipher, then with and without compression
+        # for the COMPRESSIBLE_BOOK_KINDS. Settings the reader refuses are skipped. Returns the tuning, None if nothing worked.
+        Log.info(f"Calibrating SSH settings for ebook reader {reader_name}")
+        target_path = base_path + "/" + CALIBRATION_FILENAME
+        throughputs = {}
+
+        def measure(sample: bytes, label: str, **settings):
+            throughput = self.measure_upload(backend, target_path, sample, **settings)
+            if throughput:
+                throughputs[label] = throughput
+                print(f"- {label} : {throughput / 1024 / 1024:.1f} MiB/s")
+            else:
+                print(f"- {label} : not supported")
+            return throughput or 0
+
+        # Just like book pages : random bytes don't compress
+        sample = random.Random(0).randbytes(CALIBRATION_SAMPLE_SIZE)
+
+        offered_ciphers, offered_macs = self.offered_algorithms(backend)
+
+        ciphers = {cipher: measure(sample, cipher, ciphers=[cipher]) for cipher in offered_ciphers}
+        cipher = max(ciphers, key=ciphers.get)
+        if not ciphers[cipher]:
+            return None
+
+        macs = {mac: measure(sample, f"{cipher} / {mac}", ciphers=[cipher], macs=[mac]) for mac in offered_macs}
+        mac = max(macs, key=macs.get)
+        if not macs[mac]:
+            return None
+
+        compression = []
+        text_sample = self.text_book_sample()
+        for book_kind in COMPRESSIBLE_BOOK_KINDS:
+            plain = measure(text_sample, f"{book_kind} without compression", ciphers=[cipher], macs=[mac])
+            compressed = measure(text_sample, f"{book_kind} with compression", ciphers=[cipher], macs=[mac], compression=True)
+            if compressed > plain:
+                compression.append(book_kind)
+
+        tuning = {"cipher": cipher, "mac": mac, "compression": compression, "throughputs": throughputs}
+        self.load()[reader_name] = tuning
+        self.save()
+
+        Log.info(f"Calibrated ebook reader {reader_name} : {tuning}")
+        return tuning
+
+    @classmethod
+    def offered_algorithms(self, backend: SftpBackend):
+        # Ciphers and MACs paramiko offers to the reader (without the disabled ones), in its order of preference
+        transport = paramiko.Transport((backend.ip, backend.port), disabled_algorithms=backend.disabled_algorithms)
+        try:
+            security_options = transport.get_security_options()
+            return list(security_options.ciphers), list(security_options.digests)
+        finally:
+            transport.close()
+
+    @classmethod
+    def measure_upload(self, backend: SftpBackend, target_path: str, sample: bytes, ciphers: List[str] = None, macs: List[str] = None, compression: bool = False):
+        # Median upload throughput in bytes/s over CALIBRATION_RUNS uploads on a new connection with these settings
+        # (handshake not included), None if it failed
+        session = SftpBackend(backend.ip, backend.port, backend.username, backend.password, backend.pkey, backend.disabled_algorithms)
+        session.ciphers = ciphers
+        session.macs = macs
+        session.compression = compression
+
+        try:
+            session.connect()
+
+            # Anything the reader refuses is silently replaced by another setting it supports
+            transport = session.transport
+            if (ciphers and transport.local_cipher not in ciphers) or (macs and transport.local_mac not in macs) or (compression and transport.local_compression == "none"):
+                return None
+
+            throughputs = []
+            for _ in range(CALIBRATION_RUNS):
+                start = time.perf_counter()
+                with session.open(target_path, "wb") as f:
+                    f.set_pipelined(True)
+                    for offset in range(0, len(sample), CALIBRATION_CHUNK_SIZE):
+                        f.write(sample[offset:offset + CALIBRATION_CHUNK_SIZE])
+                throughputs.append(len(sample) / (time.perf_counter() - start))
+
+            session.remove(target_path)
+            return statistics.median(throughputs)
+        except Exception:
+            Log.debug(f"Calibration upload failed ({ciphers}, {macs}, compression {compression}) : {traceback.format_exc()}")
+            return None
+        finally:
+            session.disconnect()
+
+    @classmethod
+    def text_book_sample(self):
+        # Like a lightnovel EPUB : XHTML chapters in a deflated zip, about CALIBRATION_SAMPLE_SIZE big
+        rng = random.Random(0)
+        words = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(2, 9))) for _ in range(2000)]
+
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
+            chapter = 0
+            while buffer.tell() < CALIBRATION_SAMPLE_SIZE:
+                paragraphs = "\n".join(f"<p>{' '.join(rng.choices(words, k=80))}</p>" for _ in range(200))
+                zip_file.writestr(f"chapter_{chapter}.xhtml", f"<html><body>{paragraphs}</body></html>")
+                chapter += 1
+        return buffer.getvalue()
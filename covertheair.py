@@ -1,15 +1,24 @@
+from concurrent.futures import Future, wait
+from typing import Callable
 import os
 import sys
+import threading
 import traceback
 import shutil
 
 from cli import Cli
-from cli.questions import main_menu
+from cli.questions import main_menu, choose_background_job
 from managers.manga import MangaManager
 from managers.lightnovel import LightnovelManager
 from managers.ebook import EbookManager
+from managers.daemon import Daemon
+from managers.conversion_jobs import ConversionJobs
+from connectivity.connections import ConnectionPool
+from connectivity.ebook_reader import EbookReaderGroup
+from connectivity.media_server import MediaServer
 from utils.log import Log
-from config import APPLICATION_NAME, DOWNLOADS_DIR
+from utils.profiler import Profiler
+from config import APPLICATION_NAME, DOWNLOADS_DIR, SYNC_BUDGET, DAEMON_LOGFILE
 
 class CoverTheAir:
 
@@ -18,23 +27,75 @@ class CoverTheAir:
         self.lightnovel_manager = LightnovelManager()
         self.ebook_manager = EbookManager()
 
+        # Syncs of each type of books, by name (see update_books)
+        self.syncs = {}
+        self.sync_in_background = threading.Event()
+
         # We need to make sure we got our downloads/ directory
         if not os.path.isdir(DOWNLOADS_DIR):
             Log.debug(f"Creating {DOWNLOADS_DIR}")
             os.mkdir(DOWNLOADS_DIR)
 
-    def update_books(self):
+    def update_books(self, full: bool = False):
         # First we need to make sure everything source of books from the Media Server is up to date
+        # Cold titles are only synced when full (see SyncSchedule)
+        # Each type of books syncs on its own : what isn't synced after SYNC_BUDGET seconds keeps syncing in the background
+        # and shows up in the menus as it arrives, instead of an unreachable share holding everything up.
+        # Types of books still syncing from the previous time aren't synced again, they are waited for like the others.
+        still_syncing = self.syncing()
+        if still_syncing:
+            Log.info(f"{', '.join(still_syncing)} still syncing from the previous time")
+
         Cli.print("Syncing databases with media server, please wait...")
-        Log.info("Syncing books info with media server")
-        
-        self.manga_manager.update()
-        self.lightnovel_manager.update()
-        self.ebook_manager.update()
-        
+        Log.info("Syncing books info with media server" + (" (all titles)" if full else ""))
+
+        # Printing from the background would mess the menus up, it is only logged then
+        self.sync_in_background.clear()
+        def report(text: str):
+            if not self.sync_in_background.is_set():
+                print(text)
+
+        updates = {
+            "mangas": (self.manga_manager.update, full, report),
+            "lightnovels": (self.lightnovel_manager.update, full, report),
+            "ebooks": (self.ebook_manager.update, report)
+        }
+        for name, (update, *args) in updates.items():
+            if name not in still_syncing:
+                self.syncs[name] = self.start_sync(name, update, *args)
+
+        wait(self.syncs.values(), timeout=SYNC_BUDGET or None)
+        self.sync_in_background.set()
+
+        if self.syncing():
+            Log.info(f"Syncing {', '.join(self.syncing())} in the background")
+            print(f"\nStill syncing {', '.join(self.syncing())}, they will show up in the menus as they arrive")
+
         print("")
         input("Press Enter to continue...")
 
+    def start_sync(self, name: str, update: Callable, *args):
+        # Daemon threads rather than an executor, whose threads are joined on exit : a sync stuck on an unreachable share
+        # mustn't keep us from quitting. Profiling only sees the thread it runs in, each sync gets its own stage.
+        future = Future()
+
+        def sync():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                with Profiler.stage(f"update_books.{name}"):
+                    update(*args)
+                future.set_result(None)
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=sync, name=f"sync-{name}", daemon=True).start()
+        return future
+
+    def syncing(self):
+        # Names of the types of books still syncing
+        return [name for name, sync in self.syncs.items() if not sync.done()]
+
     def go_to_book_choice_menu(self, book_type: str):
         if book_type.lower() == "mangas":
             self.manga_manager.book_choice_menu()
@@ -43,7 +104,35 @@ class CoverTheAir:
         else:
             self.ebook_manager.book_choice_menu()
 
+    def background_jobs_menu(self):
+        stay_in_menu = True
+
+        while stay_in_menu:
+            jobs = list(ConversionJobs.jobs)
+            statuses = [job.status() for job in jobs]
+            chosen_job = choose_background_job(statuses)
+
+            if chosen_job == "Back":
+                stay_in_menu = False
+
+            elif chosen_job in statuses:
+                job = jobs[statuses.index(chosen_job)]
+                if job.is_active() and Cli.confirm(f"Cancel sending {job.manga.title} ?"):
+                    job.cancel()
+
     def handle_exiting(self, failure=False):
+        # Background jobs and syncs update what we are about to save
+        if ConversionJobs.active():
+            Cli.print("Waiting for background jobs to finish...")
+            ConversionJobs.wait()
+
+        # Syncs get SYNC_BUDGET seconds to finish, the titles they didn't get to are saved as they were
+        if self.syncing():
+            Cli.print("Waiting for the sync to finish...")
+            wait(self.syncs.values(), timeout=SYNC_BUDGET or None)
+            if self.syncing():
+                Log.warning(f"Exiting while still syncing {', '.join(self.syncing())}")
+
         # Saving data
         self.manga_manager.save_data()
         self.lightnovel_manager.save_data()
@@ -57,10 +146,34 @@ class CoverTheAir:
             elif os.path.isdir(item_path):
                 shutil.rmtree(item_path)
 
+        ConnectionPool.close_all()
+
         Cli.print(f"Thanks for using {APPLICATION_NAME}, see you soon !") if not failure else Cli.print("Something went wrong, exiting :(")
 
 
 def main():
+    # Profiling can be enabled from cota.cfg or just for this run
+    if "--profile" in sys.argv[1:]:
+        Profiler.enable()
+
+    # Prepares the next chapters in the background instead (see Daemon), until interrupted
+    if "daemon" in sys.argv[1:]:
+        Log.use_logfile(DAEMON_LOGFILE)
+        try:
+            Daemon().run()
+        except KeyboardInterrupt:
+            Log.info("Daemon stopped")
+            sys.exit(0)
+
+    # Measures the fastest SSH settings of each ebook reader, used by every later connection
+    if "calibrate" in sys.argv[1:]:
+        EbookReaderGroup().calibrate()
+        sys.exit(0)
+
+    # Handshakes (and loading the reader keys) run while the tracked books are loaded, connecting is then immediate
+    MediaServer.warm_up()
+    EbookReaderGroup().warm_up()
+
     covertheair = CoverTheAir()
 
     try:
@@ -71,14 +184,21 @@ def main():
         while keep_going:
 
             # We display the main menu where the user can choose which types of media he wants to look at
-            chosen_option = main_menu()
+            chosen_option = main_menu(len(ConversionJobs.active()), covertheair.syncing())
 
             if chosen_option == "Quit CoverTheAir":
                 keep_going = False
+            elif chosen_option == "Refresh":
+                pass
+            elif chosen_option.startswith("Background jobs"):
+                covertheair.background_jobs_menu()
+            elif chosen_option == "Sync all titles":
+                covertheair.update_books(full=True)
             else:
                 covertheair.go_to_book_choice_menu(chosen_option)
 
     except KeyboardInterrupt:
+        ConversionJobs.cancel_all()
         covertheair.handle_exiting()
         sys.exit(-1)
     except Exception:
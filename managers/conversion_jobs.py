@@ -0,0 +1,303 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List
+import os
+import queue
+import shutil
+import threading
+import traceback
+from rich.progress import Progress
+
+from books.models.manga import Manga
+from books.converter import Converter, VOLUME_BUILD_WORKERS
+from books.volume_store import VolumeStore
+from connectivity.ebook_reader import EbookReaderGroup
+from utils.log import Log
+
+from config import VOLUME_MAX_PAGES, VOLUME_MAX_SIZE, INCREMENTAL_VOLUMES
+
+class VolumeBuild:
+    # Master of the EPubMaker building one volume of a job : just like a GUI would, it gets the EPubMaker callbacks
+    # (stop(1) once built, showerror() on failure) through generic_queue, they are run by the ConversionJobs dispatcher.
+    # A cancelled EPubMaker doesn't report back, it only removes its file.
+    # With a base (the kept volume of the manga, see VolumeStore), the chapters are appended to it.
+
+    def __init__(self, job, index: int, chapters: List[dict], base: dict = None):
+        self.job = job
+        self.index = index
+        self.chapters = chapters
+        self.base = base
+        self.generic_queue = ConversionJobs.generic_queue
+        self.epub_maker = None
+        self.title = None
+        self.epub_file = None
+        self.state = "queued"  # queued, building, built, uploading, sent, failed or cancelled
+
+    def start(self):
+        self.title, volume_directory = Converter.volume_location(self.job.manga, self.job.directory, self.index, len(self.job.volumes), self.job.first_number)
+        if self.base:
+            self.title = self.base["title"]
+        self.state = "building"
+
+        try:
+            self.epub_maker = Converter.prepare_volume(self.title, self.chapters, volume_directory, self.job.directory, master=self, progress=self.job.progress, base=self.base)
+            self.epub_maker.start()
+        except Exception:
+            self.showerror("Error encountered", "Could not start building the volume", traceback.format_exc())
+
+    def is_running(self):
+        return self.epub_maker is not None and self.epub_maker.is_alive()
+
+    def stop(self, status: int):
+        if self.state == "building":
+            self.state = "built"
+            self.epub_file = self.epub_maker.file
+            self.job.on_volume_built(self)
+
+    def showerror(self, title: str, message: str, stacktrace: str = ""):
+        Log.error(f"Failed to build {self.title} : {message}", stacktrace)
+        if self.state == "building":
+            self.state = "failed"
+            self.job.on_volume_failed(self)
+
+
+class ConversionJob:
+    # Converts the chapters of a manga downloaded into directory and sends them to the ebook readers, in the background.
+    # Volumes are uploaded one after the other as soon as they are built. Once everything is over,
+    # on_done(sent_chapters_count) is called with the chapters of the volumes sent before the first one that failed.
+
+    def __init__(self, manga: Manga, directory: str, on_done: Callable = None):
+        self.manga = manga
+        self.directory = directory
+        self.on_done = on_done
+        self.state = "queued"  # queued, running, cancelling, then done, failed or cancelled
+        self.sent_chapters_count = 0
+        self.failed = False
+        self.lock = threading.RLock()
+        self.done_event = threading.Event()
+        self.readers: EbookReaderGroup = None
+
+        # Never displayed : it keeps track of the builds and uploads, for status()
+        self.progress = Progress()
+
+        chapters = Converter.read_cbz_chapters(directory)
+        kept = VolumeStore.find(manga, [os.path.basename(chapter["cbz"].path) for chapter in chapters]) if INCREMENTAL_VOLUMES else None
+        self.first_number = 1
+
+        if kept:
+            # The first chapters go to the kept volume as long as it doesn't go over the limits
+            volumes = Converter.split_into_volumes(chapters, VOLUME_MAX_PAGES, VOLUME_MAX_SIZE, kept["pages"], kept["size"])
+            self.first_number = kept["number"]
+            if not volumes[0]:
+                Log.debug(f"Kept volume of {manga.title} is full, starting a new one")
+                volumes.pop(0)
+                self.first_number += 1
+                kept = None
+        else:
+            volumes = Converter.split_into_volumes(chapters, VOLUME_MAX_PAGES, VOLUME_MAX_SIZE)
+
+        self.volumes = [VolumeBuild(self, index, volume_chapters, kept if index == 0 else None) for index, volume_chapters in enumerate(volumes)]
+
+    def is_active(self):
+        return not self.done_event.is_set()
+
+    def status(self):
+        # Building and uploading each volume count as much
+        progress = sum(task.percentage for task in self.progress.tasks) / (2 * len(self.volumes)) if self.volumes else 100
+        sent_count = sum(1 for volume in self.volumes if volume.state == "sent")
+        return "{0:40.40}".format(self.manga.title) + f"  {self.state:10.10} {sent_count}/{len(self.volumes)} volumes sent  {min(progress, 100):3.0f}%"
+
+    def cancel(self):
+        with self.lock:
+            if self.state not in ["queued", "running"]:
+                return
+
+            Log.info(f"Cancelling background conversion of {self.manga.title}")
+            self.state = "cancelling"
+            self.stop_volumes()
+
+        self.check_done()
+
+    def stop_volumes(self):
+        # Builds are stopped through EPubMaker.stop(), an upload already running is left to finish
+        for volume in self.volumes:
+            if volume.state in ["queued", "built"]:
+                volume.state = "cancelled"
+            elif volume.state == "building":
+                volume.state = "cancelled"
+                volume.epub_maker.stop()
+
+    def on_volume_built(self, volume: VolumeBuild):
+        Log.info(f"Built {volume.epub_file} in the background")
+        ConversionJobs.uploader.submit(self.upload, volume)
+
+    def on_volume_failed(self, volume: VolumeBuild):
+        # The following volumes couldn't be counted as read anyway
+        with self.lock:
+            self.failed = True
+            if self.state == "running":
+                self.state = "cancelling"
+                self.stop_volumes()
+
+        self.check_done()
+
+    def upload(self, volume: VolumeBuild):
+        with self.lock:
+            if volume.state != "built":
+                return
+            volume.state = "uploading"
+
+        try:
+            if self.readers is None:
+                self.readers = EbookReaderGroup()
+                self.readers.connect()
+
+            Log.info(f"Uploading {volume.epub_file} to Ebook Reader")
+            success = self.readers.upload_book(volume.title, volume.epub_file, progress=self.progress, quiet=True)
+        except Exception:
+            Log.error(f"Failed to upload {volume.epub_file} to Ebook Reader", traceback.format_exc())
+            success = False
+
+        volume.state = "sent" if success else "failed"
+        if not success:
+            self.on_volume_failed(volume)
+        self.check_done()
+
+    def check_done(self):
+        with self.lock:
+            if self.state in ["done", "failed", "cancelled"]:
+                return
+
+            # Stopped builds may still be writing into directory
+            settled = all(volume.state in ["sent", "failed", "cancelled"] and not volume.is_running() for volume in self.volumes)
+            if not settled:
+                return
+
+            last_sent_volume = None
+            for volume in self.volumes:
+                if volume.state != "sent":
+                    break
+                self.sent_chapters_count += len(volume.chapters)
+                last_sent_volume = volume
+
+            if self.failed:
+                self.state = "failed"
+            elif self.state == "cancelling":
+                self.state = "cancelled"
+            else:
+                self.state = "done"
+
+        Log.info(f"Background conversion of {self.manga.title} {self.state} ({self.sent_chapters_count} chapters sent)")
+
+        if self.readers:
+            self.readers.disconnect()
+        if INCREMENTAL_VOLUMES and last_sent_volume:
+            self.keep_volume(last_sent_volume)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+        if self.on_done:
+            try:
+                self.on_done(self.sent_chapters_count)
+            except Exception:
+                Log.error(f"Failed to complete background conversion of {self.manga.title}", traceback.format_exc())
+
+        self.done_event.set()
+
+    def keep_volume(self, volume: VolumeBuild):
+        # The next chapters will be appended to it
+        chapters = [os.path.basename(chapter["cbz"].path) for chapter in volume.chapters]
+        pages = sum(chapter["pages"] for chapter in volume.chapters)
+        size = sum(chapter["size"] for chapter in volume.chapters)
+        if volume.base:
+            chapters = volume.base["chapters"] + chapters
+            pages += volume.base["pages"]
+            size += volume.base["size"]
+
+        try:
+            VolumeStore.keep(self.manga, {
+                "title": volume.title, "file": volume.epub_file, "number": self.first_number + volume.index,
+                "chapters": chapters, "pages": pages, "size": size,
+                "author": volume.epub_maker.author, "epub": volume.epub_maker.snapshot()
+            })
+        except Exception:
+            Log.error(f"Failed to keep {volume.epub_file}, the next chapters of {self.manga.title} will get a new volume", traceback.format_exc())
+
+
+class ConversionJobs:
+    # Conversions running in the background while the user keeps browsing : jobs are queued and their volumes
+    # built by EPubMaker threads, at most VOLUME_BUILD_WORKERS at a time whatever the job.
+    # The EPubMaker callbacks are run by the dispatcher thread, uploads by the uploader thread.
+
+    jobs: List[ConversionJob] = []
+    generic_queue: queue.Queue = queue.Queue()
+    dispatcher: threading.Thread = None
+    uploader: ThreadPoolExecutor = None
+    lock = threading.Lock()
+
+    @classmethod
+    def submit(self, manga: Manga, directory: str, on_done: Callable = None):
+        job = ConversionJob(manga, directory, on_done)
+        Log.info(f"Queued background conversion of {manga.title} ({len(job.volumes)} volumes)")
+
+        with self.lock:
+            self.jobs.append(job)
+
+            if self.dispatcher is None:
+                ConversionJobs.uploader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="conversion-uploads")
+                ConversionJobs.dispatcher = threading.Thread(target=self.dispatch, name="conversion-jobs", daemon=True)
+                self.dispatcher.start()
+
+        self.generic_queue.put(self.schedule)
+        return job
+
+    @classmethod
+    def dispatch(self):
+        while True:
+            try:
+                event = self.generic_queue.get(timeout=0.5)
+            except queue.Empty:
+                # Stopped builds don't report back, they free their slot when their thread is over
+                event = self.schedule
+
+            try:
+                event()
+            except Exception:
+                Log.error("Failed to handle background conversion event", traceback.format_exc())
+
+    @classmethod
+    def schedule(self):
+        for job in self.active():
+            job.check_done()
+
+        running_count = sum(1 for job in self.jobs for volume in job.volumes if volume.is_running())
+
+        for job in self.active():
+            for volume in job.volumes:
+                if running_count >= VOLUME_BUILD_WORKERS:
+                    return
+
+                with job.lock:
+                    if job.state not in ["queued", "running"] or volume.state != "queued":
+                        continue
+                    job.state = "running"
+
+                volume.start()
+                running_count += 1
+
+    @classmethod
+    def active(self):
+        with self.lock:
+            return [job for job in self.jobs if job.is_active()]
+
+    @classmethod
+    def find(self, title: str):
+        return next((job for job in self.active() if job.manga.title == title), None)
+
+    @classmethod
+    def cancel_all(self):
+        for job in self.active():
+            job.cancel()
+
+    @classmethod
+    def wait(self):
+        for job in self.active():
+            job.done_event.wait()
@@ -0,0 +1,67 @@
+import os
+import time
+import traceback
+
+from managers.manga import MangaManager
+from managers.lightnovel import LightnovelManager
+from utils.log import Log
+from utils.throttle import BandwidthLimiter
+
+from config import DAEMON_INTERVAL, DAEMON_PREFETCH_CHAPTERS, DAEMON_MAX_DOWNLOAD_SPEED, DAEMON_BUILD_WORKERS, DAEMON_NICE
+
+class Daemon:
+    # covertheair.py daemon : periodically syncs with the media server and keeps the next unread chapters of every manga
+    # and lightnovel downloaded and converted in the ReadyCache, so that sending them from the CLI only takes the upload.
+    # Tracked books are only read : the CLI stays the only one saving them, right after sending chapters so that the daemon
+    # doesn't prepare them again at its next check.
+
+    def __init__(self):
+        self.manga_manager = MangaManager()
+        self.lightnovel_manager = LightnovelManager()
+        # Shared by every download, whatever the title
+        self.limiter = BandwidthLimiter(DAEMON_MAX_DOWNLOAD_SPEED)
+
+    def run(self):
+        # Conversions are CPU heavy, the daemon gives way to whatever else is running
+        if DAEMON_NICE and hasattr(os, "nice"):
+            os.nice(DAEMON_NICE)
+
+        Log.info(f"Starting daemon (every {DAEMON_INTERVAL} seconds, {DAEMON_PREFETCH_CHAPTERS} chapters ahead)")
+
+        while True:
+            try:
+                self.prepare_next_chapters()
+            except Exception:
+                Log.error("Failed to prepare the next chapters", traceback.format_exc())
+
+            print(f"Next check in {DAEMON_INTERVAL // 60} minutes")
+            time.sleep(DAEMON_INTERVAL)
+
+    def prepare_next_chapters(self):
+        # Catching up with what the CLI sent or modified since the last time, with what we had otherwise
+        for manager in [self.manga_manager, self.lightnovel_manager]:
+            try:
+                manager.load_data()
+            except Exception:
+                Log.error(f"Failed to reload tracked books, keeping the previous ones ({type(manager).__name__})", traceback.format_exc())
+
+        # Sync times are never saved by the daemon : every title is synced each time, it runs in the background anyway
+        self.manga_manager.update(full=True)
+        self.lightnovel_manager.update(full=True)
+
+        ready_count = 0
+
+        for manga in self.manga_manager.tracked_mangas:
+            try:
+                ready_count += self.manga_manager.prepare_next_chapters(manga, DAEMON_PREFETCH_CHAPTERS, self.limiter, DAEMON_BUILD_WORKERS)
+            except Exception:
+                Log.error(f"Failed to prepare chapters for {manga.title}", traceback.format_exc())
+
+        for lightnovel in self.lightnovel_manager.tracked_lightnovels:
+            try:
+                ready_count += self.lightnovel_manager.prepare_next_chapters(lightnovel, DAEMON_PREFETCH_CHAPTERS, self.limiter)
+            except Exception:
+                Log.error(f"Failed to prepare chapters for {lightnovel.title}", traceback.format_exc())
+
+        Log.info(f"{ready_count} titles have their next chapters ready")
+        print(f"{ready_count} titles have their next chapters ready to send")
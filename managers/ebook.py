@@ -1,14 +1,16 @@
 from rich.progress import Progress
-from typing import List
+from typing import Callable, List
+import asyncio
 import traceback
 import json
 import os
+import threading
 
 from books.models.ebook import Ebook
 from connectivity.media_server import MediaServer
-from connectivity.ebook_reader import EbookReader
+from connectivity.ebook_reader import EbookReaderGroup
 from cli import Cli
-from cli.questions import choose_ebook, choose_action_for_ebook, choose_local_ebook_to_upload, modify_read_status, input_serie, choose_series
+from cli.questions import choose_ebook, choose_ebooks_to_send, choose_action_for_ebook, choose_local_ebook_to_upload, modify_read_status, input_serie, choose_series
 from utils.log import Log
 
 from config import TRACKED_EBOOKS_FILE, DOWNLOADS_DIR
@@ -18,6 +20,9 @@ class EbookManager:
     tracked_ebooks: List[Ebook] = []
 
     def __init__(self):
+        # Syncs may go on in the background (see CoverTheAir.update_books) : tracked_ebooks is only changed while holding it
+        self.lock = threading.RLock()
+
         if not os.path.isfile(TRACKED_EBOOKS_FILE):
             Log.debug(f"Creating {TRACKED_EBOOKS_FILE}")
             with open(TRACKED_EBOOKS_FILE, "w"): pass
@@ -31,7 +36,8 @@ class EbookManager:
                     self.tracked_ebooks.append(ebook)
                     self.tracked_ebooks = sorted(self.tracked_ebooks, key=lambda ebook: ebook.title)
 
-    def update(self):
+    def update(self, report: Callable = print):
+        # report() shows what changed, it doesn't print once the sync went on in the background (see CoverTheAir.update_books)
         media_server = MediaServer()
         media_server.connect()
         
@@ -39,28 +45,30 @@ class EbookManager:
             Log.info("Updating ebooks info")
             ebooks_in_media_server = media_server.list_ebooks()
 
-             # We compare whether ebooks are both tracked and downloaded on the media server or not
-            ebooks_in_media_server_titles = [ebook["title"] for ebook in ebooks_in_media_server]
-            tracked_ebooks_titles = [ebook.title for ebook in self.tracked_ebooks]
-
-            for tracked_ebook in self.tracked_ebooks:
-                # First we handle the ebooks that are already in our list but are not on the media server anymore
-                if tracked_ebook.title not in ebooks_in_media_server_titles:
-                    tracked_ebook.missing = True
-                    Log.debug(f"{tracked_ebook.title} does not exist in media server anymore")
-
-            # Finally we handle the ebooks that we don't have in our list
-            for downloaded_ebook in ebooks_in_media_server:
-                if downloaded_ebook["title"] not in tracked_ebooks_titles:
-                    new_tracked_ebook = Ebook(
-                        title=downloaded_ebook["title"],
-                        series=downloaded_ebook["series"],
-                        filetype=downloaded_ebook["filetype"]
-                    )
-                    self.tracked_ebooks.append(new_tracked_ebook)
-
-                    Log.info(f"Added new tracked ebook : {new_tracked_ebook.title}")
-                    print(f"- {new_tracked_ebook.title} => **NEW**")
+            # The upload menu syncs too, maybe while the launch sync is still going on in the background
+            with self.lock:
+                # We compare whether ebooks are both tracked and downloaded on the media server or not
+                ebooks_in_media_server_titles = [ebook["title"] for ebook in ebooks_in_media_server]
+                tracked_ebooks_titles = [ebook.title for ebook in self.tracked_ebooks]
+
+                for tracked_ebook in self.tracked_ebooks:
+                    # First we handle the ebooks that are already in our list but are not on the media server anymore
+                    if tracked_ebook.title not in ebooks_in_media_server_titles:
+                        tracked_ebook.missing = True
+                        Log.debug(f"{tracked_ebook.title} does not exist in media server anymore")
+
+                # Finally we handle the ebooks that we don't have in our list
+                for downloaded_ebook in ebooks_in_media_server:
+                    if downloaded_ebook["title"] not in tracked_ebooks_titles:
+                        new_tracked_ebook = Ebook(
+                            title=downloaded_ebook["title"],
+                            series=downloaded_ebook["series"],
+                            filetype=downloaded_ebook["filetype"]
+                        )
+                        self.tracked_ebooks.append(new_tracked_ebook)
+
+                        Log.info(f"Added new tracked ebook : {new_tracked_ebook.title}")
+                        report(f"- {new_tracked_ebook.title} => **NEW**")
         except Exception:
             Log.error("Failed to sync ebooks", traceback.format_exc())
 
@@ -112,12 +120,12 @@ class EbookManager:
         media_server.disconnect()
 
     def upload_to_reader(self, ebook: Ebook, source_path: str):
-        reader = EbookReader()
+        readers = EbookReaderGroup()
         try:
             Log.info(f"Uploading {source_path} to Ebook Reader")
 
-            reader.connect()
-            success = reader.upload_book(ebook.title, source_path)
+            readers.connect()
+            success = readers.upload_book(ebook.title, source_path)
 
         except Exception:
             Log.error(f"Failed to upload {source_path} to Ebook Reader", traceback.format_exc())
@@ -125,24 +133,102 @@ class EbookManager:
         
         print(" ") if success else print("\n[-] Something went wrong when uploading to Ebook Reader !")
 
-        reader.disconnect()
+        readers.disconnect()
         return success
 
+    def relay_to_reader(self, ebook: Ebook):
+        # Ebooks don't need any conversion, so they go straight from the Media Server to the Ebook Reader
+        if ebook.missing:
+            input(f"{ebook.title} is missing from Media Server ! Press Enter to abort...")
+            return False
+
+        media_server = MediaServer()
+        readers = EbookReaderGroup()
+        source_file = None
+
+        try:
+            Log.info(f"Relaying {ebook.title} from Media Server to Ebook Reader")
+
+            media_server.connect()
+            readers.connect()
+
+            source_file, source_stat = media_server.open_ebook(ebook.title, ebook.filetype, ebook.series)
+            success = readers.relay_book(ebook.title, source_file, source_stat, origin=f"{ebook.series}/{ebook.title}.{ebook.filetype}")
+
+        except Exception:
+            Log.error(f"Failed to relay {ebook.title} to Ebook Reader", traceback.format_exc())
+            success = False
+
+        if source_file:
+            source_file.close()
+
+        print(" ") if success else print("\n[-] Something went wrong when sending ebook to Ebook Reader !")
+
+        readers.disconnect()
+        media_server.disconnect()
+        return success
+
+    def relay_several_to_reader(self, ebooks: List[Ebook]):
+        # Same as relay_to_reader but for several ebooks at once, over a single connection to each end.
+        # Every ebook successfully sent is marked as read right away, so an interrupted batch is not lost.
+        for ebook in ebooks:
+            if ebook.missing:
+                Log.warning(f"{ebook.title} is missing from Media Server, skipping it")
+                print(f"{ebook.title} is missing from Media Server, skipping it")
+        ebooks = [ebook for ebook in ebooks if not ebook.missing]
+
+        media_server = MediaServer()
+        readers = EbookReaderGroup()
+        results = []
+
+        def open_source(ebook: Ebook):
+            return lambda: media_server.open_ebook(ebook.title, ebook.filetype, ebook.series, session=media_server.aio().session())
+
+        def on_relayed(book_title: str, success: bool):
+            if success:
+                ebook = next(ebook for ebook in ebooks if ebook.title == book_title)
+                ebook.read = True
+                Log.debug(f"Marked {book_title} as read")
+
+        try:
+            Log.info(f"Relaying {len(ebooks)} ebooks from Media Server to Ebook Reader")
+
+            media_server.connect()
+            readers.connect()
+
+            books = [(ebook.title, f"{ebook.series}/{ebook.title}.{ebook.filetype}", open_source(ebook)) for ebook in ebooks]
+            results = asyncio.run(readers.relay_books(books, on_relayed=on_relayed))
+
+        except Exception:
+            Log.error("Failed to relay ebooks to Ebook Reader", traceback.format_exc())
+
+        sent_count = sum(1 for success in results if success)
+        print(" ") if sent_count == len(ebooks) else print(f"\n[-] Something went wrong when sending ebooks to Ebook Reader ! ({sent_count}/{len(ebooks)} sent)")
+
+        readers.disconnect()
+        media_server.disconnect()
+        return sent_count
+
     def save_data(self):
         Log.info(f"Saving ebooks to {TRACKED_EBOOKS_FILE}")
 
         data = {"ebooks": []}
-        for ebook in self.tracked_ebooks:
-            entry = {
-                "title": ebook.title,
-                "series": ebook.series,
-                "read": ebook.read,
-                "filetype": ebook.filetype,
-                "missing": ebook.missing
-            }
-            data["ebooks"].append(entry)
-
-        json.dump(data, open(TRACKED_EBOOKS_FILE, "w"))
+        # Titles being synced are saved either before or after their sync, not halfway through.
+        # The file is written aside then moved over it, so that it is never half written
+        with self.lock:
+            for ebook in self.tracked_ebooks:
+                entry = {
+                    "title": ebook.title,
+                    "series": ebook.series,
+                    "read": ebook.read,
+                    "filetype": ebook.filetype,
+                    "missing": ebook.missing
+                }
+                data["ebooks"].append(entry)
+
+            with open(TRACKED_EBOOKS_FILE + ".tmp", "w") as f:
+                json.dump(data, f)
+            os.replace(TRACKED_EBOOKS_FILE + ".tmp", TRACKED_EBOOKS_FILE)
 
 
     #### MENUS ####
@@ -153,7 +239,9 @@ class EbookManager:
         while stay_in_series_menu:
 
             # User chooses an ebook in the list of displayed tracked ebooks
-            available_series, chosen_series = choose_series(self.tracked_ebooks)
+            with self.lock:
+                tracked_ebooks = list(self.tracked_ebooks)
+            available_series, chosen_series = choose_series(tracked_ebooks)
 
             if chosen_series == "Back":
                 stay_in_series_menu = False
@@ -176,9 +264,12 @@ class EbookManager:
                     if chosen_ebook == "Back":
                         stay_in_book_menu = False
 
+                    elif chosen_ebook == "Send several books to Ebook Reader":
+                        self.batch_download_menu(series_to_browse, available_series[series_to_browse])
+
                     else:
                         ebook_title = chosen_ebook[0:60].strip()
-                        ebook = next((tracked_ebook for tracked_ebook in self.tracked_ebooks if tracked_ebook.title == ebook_title), None)
+                        ebook = next((tracked_ebook for tracked_ebook in tracked_ebooks if tracked_ebook.title == ebook_title), None)
             
                         if not ebook:
                             Log.warning(f"Could not find {ebook_title}")
@@ -200,13 +291,18 @@ class EbookManager:
     def download_menu(self, ebook: Ebook):
         Cli.print("") # Just to get a clean page
 
-        downloaded_file = self.download_from_media_server(ebook)
+        success = self.relay_to_reader(ebook)
 
-        if downloaded_file:
-            success = self.upload_to_reader(ebook, downloaded_file)
-
-            if success:
-                ebook.read = True
+        if success:
+            ebook.read = True
 
         input("Press enter to continue...")
 
+    def batch_download_menu(self, series: str, ebooks: List[Ebook]):
+        chosen_ebooks = choose_ebooks_to_send(series, ebooks)
+
+        if chosen_ebooks:
+            Cli.print("") # Just to get a clean page
+            self.relay_several_to_reader(chosen_ebooks)
+            input("Press enter to continue...")
+
@@ -1,16 +1,21 @@
 from rich.progress import Progress
-from typing import List
+from typing import Callable, List
+import asyncio
 import traceback
 import json
 import os
+import threading
 
 from books.models.lightnovel import Lightnovel
+from books.sync_schedule import SyncSchedule
 from books.converter import Converter
+from books.ready_cache import ReadyCache
 from connectivity.media_server import MediaServer
-from connectivity.ebook_reader import EbookReader
+from connectivity.ebook_reader import EbookReaderGroup
 from cli import Cli
 from cli.questions import choose_lightnovel, choose_action_for_manga_or_lightnovel, modify_last_chapter_read, get_chapters_download_count
 from utils.log import Log
+from utils.throttle import BandwidthLimiter
 
 from config import TRACKED_LIGHTNOVELS_FILE, DOWNLOADS_DIR
 
@@ -19,22 +24,38 @@ class LightnovelManager:
     tracked_lightnovels: List[Lightnovel] = []
 
     def __init__(self):
+        # Syncs may go on in the background (see CoverTheAir.update_books) : tracked_lightnovels and their chapters
+        # are only changed while holding it
+        self.lock = threading.RLock()
+
         if not os.path.isfile(TRACKED_LIGHTNOVELS_FILE):
             Log.debug(f"Creating {TRACKED_LIGHTNOVELS_FILE}")
             with open(TRACKED_LIGHTNOVELS_FILE, "w"): pass
 
+        self.load_data()
+
+    def load_data(self):
+        # Also used by the daemon to catch up with what the CLI saved in the meantime : if reading fails,
+        # what was loaded before is kept
+        tracked_lightnovels = []
+
         # First we read tracked lightnovels from the associated JSON file
         if os.stat(TRACKED_LIGHTNOVELS_FILE).st_size != 0:
-            data = json.load(open(TRACKED_LIGHTNOVELS_FILE, "r"))
+            with open(TRACKED_LIGHTNOVELS_FILE, "r") as f:
+                data = json.load(f)
             for entry in data["lightnovels"]:
                 if not entry["missing"]:
-                    lightnovel = Lightnovel(entry["title"], entry["chapters"], entry["last_read_chapter"])
-                    self.tracked_lightnovels.append(lightnovel)
-                    self.tracked_lightnovels = sorted(self.tracked_lightnovels, key=lambda lightnovel: lightnovel.title)
+                    lightnovel = Lightnovel(entry["title"], entry["chapters"], entry["last_read_chapter"], entry.get("last_new_chapter_at"), entry.get("last_synced_at"))
+                    tracked_lightnovels.append(lightnovel)
+
+        with self.lock:
+            self.tracked_lightnovels = sorted(tracked_lightnovels, key=lambda lightnovel: lightnovel.title)
 
     #### ACTIONS ####
 
-    def update(self):
+    def update(self, full: bool = False, report: Callable = print):
+        # Cold titles are skipped until they are due (see SyncSchedule), unless full
+        # report() shows what changed, it doesn't print once the sync went on in the background (see CoverTheAir.update_books)
         media_server = MediaServer()
         media_server.connect()
 
@@ -45,17 +66,25 @@ class LightnovelManager:
 
             # We compare whether lightnovels are both tracked and downloaded on the media server or not
             lightnovels_in_media_server_titles = [lightnovel["title"] for lightnovel in lightnovels_in_media_server]
-            tracked_lightnovels_titles = [lightnovel.title for lightnovel in self.tracked_lightnovels]
+            with self.lock:
+                tracked_lightnovels = list(self.tracked_lightnovels)
+            tracked_lightnovels_titles = [lightnovel.title for lightnovel in tracked_lightnovels]
+            cold_count = 0
 
-            for tracked_lightnovel in self.tracked_lightnovels:
+            for tracked_lightnovel in tracked_lightnovels:
                 # First we handle the lightnovels that are already in our list and are on the media server
                 if tracked_lightnovel.title in lightnovels_in_media_server_titles:
+                    if not full and not SyncSchedule.is_due(tracked_lightnovel):
+                        cold_count += 1
+                        continue
+
                     chapters = media_server.list_lightnovel_chapters(tracked_lightnovel.title)
-                    new_chapters = tracked_lightnovel.update_chapters(chapters)
+                    with self.lock:
+                        new_chapters = tracked_lightnovel.update_chapters(chapters)
 
                     if len(new_chapters) != 0:
                         Log.info(f"New chapters for {tracked_lightnovel.title} : {', '.join(new_chapters)}")
-                        print(f"- {tracked_lightnovel.title} => {len(new_chapters)} new chapters")
+                        report(f"- {tracked_lightnovel.title} => {len(new_chapters)} new chapters")
                 
                 # Then we handle the lightnovels that we have in our list but are not on the media server anymore
                 else:
@@ -69,15 +98,45 @@ class LightnovelManager:
                         title=downloaded_lightnovel["title"]
                     )
                     new_tracked_lightnovel.update_chapters(media_server.list_lightnovel_chapters(downloaded_lightnovel["title"]))
-                    self.tracked_lightnovels.append(new_tracked_lightnovel)
+                    with self.lock:
+                        self.tracked_lightnovels.append(new_tracked_lightnovel)
 
                     Log.info(f"Added new tracked lightnovel : {new_tracked_lightnovel.title}")
-                    print(f"- {new_tracked_lightnovel.title} => **NEW**")
+                    report(f"- {new_tracked_lightnovel.title} => **NEW**")
+
+            if cold_count:
+                Log.info(f"Skipped {cold_count} cold lightnovels, not due for a sync yet")
         except Exception:
             Log.error("Failed to sync lightnovels", traceback.format_exc())
 
         media_server.disconnect()
 
+    def refresh(self, lightnovel: Lightnovel):
+        # Opened titles are synced right away, cold or not. When the background sync is on it too, whichever
+        # comes second waits for the other one to be done with it.
+        if lightnovel.missing:
+            return
+
+        media_server = MediaServer()
+        media_server.connect()
+
+        try:
+            chapters = media_server.list_lightnovel_chapters(lightnovel.title)
+            with self.lock:
+                new_chapters = lightnovel.update_chapters(chapters)
+            if len(new_chapters) != 0:
+                Log.info(f"New chapters for {lightnovel.title} : {', '.join(new_chapters)}")
+        except Exception:
+            Log.error(f"Failed to sync {lightnovel.title}", traceback.format_exc())
+
+        media_server.disconnect()
+
+    def next_chapters(self, lightnovel: Lightnovel, chapters_count: int = None):
+        # The next unread chapters (all of them by default), a sync could reorder them in the meantime otherwise
+        with self.lock:
+            last_chapter = lightnovel.last_read_chapter + chapters_count if chapters_count is not None else None
+            return lightnovel.chapters[lightnovel.last_read_chapter:last_chapter]
+
     def download_chapters_from_media_server(self, lightnovel: Lightnovel, chapters_count: int):
         if lightnovel.missing:
             input(f"{lightnovel.title} is missing from Media Server ! Press Enter to abort...")
@@ -92,11 +151,7 @@ class LightnovelManager:
             if not os.path.isdir(target_dir):
                 os.mkdir(target_dir)
 
-            chapters_to_download = []
-            for i in range(chapters_count):
-                chapter_id = lightnovel.last_read_chapter + i
-                chapter_name = lightnovel.chapters[chapter_id]
-                chapters_to_download.append(chapter_name)
+            chapters_to_download = self.next_chapters(lightnovel, chapters_count)
 
             Log.info(f"Downloading following chapters for {lightnovel.title} : {', '.join(chapters_to_download)}")
 
@@ -104,9 +159,11 @@ class LightnovelManager:
                 progress_bar_length = max(1000, len(chapters_to_download))
                 task = progress.add_task(f"[red]Downloading {len(chapters_to_download)} chapters for {lightnovel.title}...", total=progress_bar_length)
 
-                for chapter in chapters_to_download:
-                    media_server.download_lightnovel_chapter(lightnovel.title, chapter, target_dir)
-                    progress.update(task, advance=progress_bar_length / len(chapters_to_download))
+                # Chapters are downloaded concurrently, each on its own SFTP channel
+                asyncio.run(media_server.download_lightnovel_chapters(
+                    lightnovel.title, chapters_to_download, target_dir,
+                    on_downloaded=lambda chapter, success: progress.update(task, advance=progress_bar_length / len(chapters_to_download))
+                ))
 
         except:
             Log.error(f"Failed to download chapters for {lightnovel.title}", traceback.format_exc())
@@ -118,12 +175,13 @@ class LightnovelManager:
         return target_dir
     
     def upload_to_reader(self, lightnovel: Lightnovel, source_path: str):
-        reader = EbookReader()
+        # Text may be sent with SSH compression (see ReaderTuning)
+        readers = EbookReaderGroup("lightnovel")
         try:
             Log.info(f"Uploading {source_path} to Ebook Reader")
 
-            reader.connect()
-            success = reader.upload_book(lightnovel.title, source_path)
+            readers.connect()
+            success = readers.upload_book(lightnovel.title, source_path)
 
         except Exception:
             Log.error(f"Failed to upload {source_path} to Ebook Reader", traceback.format_exc())
@@ -131,23 +189,82 @@ class LightnovelManager:
         
         print(" ") if success else print("\n[-] Something went wrong when uploading to Ebook Reader !")
 
-        reader.disconnect()
+        readers.disconnect()
         return success
     
+    def prepare_next_chapters(self, lightnovel: Lightnovel, chapters_count: int, limiter: BandwidthLimiter = None):
+        # Downloads and merges the next unread chapters into the ReadyCache, so that sending them only takes the upload.
+        # Returns whether they are ready.
+        chapters = self.next_chapters(lightnovel, chapters_count)
+        if lightnovel.missing or not chapters:
+            ReadyCache.discard("lightnovel", lightnovel.title)
+            return False
+
+        ready = ReadyCache.find("lightnovel", lightnovel.title, chapters)
+        if ready and ready["chapters"] == chapters:
+            ReadyCache.discard("lightnovel", lightnovel.title, keep=ready["directory"])
+            return True
+
+        ReadyCache.discard("lightnovel", lightnovel.title)
+        directory = ReadyCache.build_directory("lightnovel", lightnovel.title, chapters)
+
+        media_server = MediaServer()
+        media_server.connect()
+
+        try:
+            Log.info(f"Preparing following chapters for {lightnovel.title} : {', '.join(chapters)}")
+            print(f"- {lightnovel.title} => preparing {len(chapters)} chapters")
+
+            downloaded = asyncio.run(media_server.download_lightnovel_chapters(
+                lightnovel.title, chapters, directory,
+                limiter=limiter
+            ))
+            # Not needed while converting
+            media_server.disconnect()
+
+            if not all(downloaded):
+                raise IOError(f"Could only download {sum(downloaded)} chapters out of {len(chapters)}")
+
+            epub_file = Converter.merge_epubs_to_epub(lightnovel, directory)
+            if not epub_file:
+                raise IOError(f"Could not merge chapters for {lightnovel.title}")
+
+            # Only the merged EPUB is kept
+            for chapter in chapters:
+                os.unlink(os.path.join(directory, chapter))
+
+            ReadyCache.store(directory, chapters, [{"title": lightnovel.title, "file": epub_file, "chapters": chapters}])
+            success = True
+
+        except Exception:
+            Log.error(f"Failed to prepare chapters for {lightnovel.title}", traceback.format_exc())
+            ReadyCache.remove(directory)
+            success = False
+
+        media_server.disconnect()
+        return success
+
     def save_data(self):
         Log.info(f"Saving lightnovels to {TRACKED_LIGHTNOVELS_FILE}")
 
         data = {"lightnovels": []}
-        for lightnovel in self.tracked_lightnovels:
-            entry = {
-                "title": lightnovel.title,
-                "chapters": lightnovel.chapters,
-                "last_read_chapter": lightnovel.last_read_chapter,
-                "missing": lightnovel.missing
-            }
-            data["lightnovels"].append(entry)
-        
-        json.dump(data, open(TRACKED_LIGHTNOVELS_FILE, "w"))
+        # Titles being synced are saved either before or after their sync, not halfway through.
+        # The file is written aside then moved over it, the daemon may read it at any time (see Daemon).
+        with self.lock:
+            for lightnovel in self.tracked_lightnovels:
+                entry = {
+                    "title": lightnovel.title,
+                    "chapters": lightnovel.chapters,
+                    "last_read_chapter": lightnovel.last_read_chapter,
+                    "missing": lightnovel.missing,
+                    "last_new_chapter_at": lightnovel.last_new_chapter_at,
+                    "last_synced_at": lightnovel.last_synced_at
+                }
+                data["lightnovels"].append(entry)
+
+            with open(TRACKED_LIGHTNOVELS_FILE + ".tmp", "w") as f:
+                json.dump(data, f)
+            os.replace(TRACKED_LIGHTNOVELS_FILE + ".tmp", TRACKED_LIGHTNOVELS_FILE)
 
     
     #### MENUS ####
@@ -158,14 +275,16 @@ class LightnovelManager:
         while stay_in_menu:
 
             # User chooses a lightnovel in the list of displayed tracked lightnovels
-            chosen_lightnovel = choose_lightnovel(self.tracked_lightnovels)
+            with self.lock:
+                tracked_lightnovels = list(self.tracked_lightnovels)
+            chosen_lightnovel = choose_lightnovel(tracked_lightnovels)
 
             if chosen_lightnovel == "Back":
                 stay_in_menu = False
 
             else:
                 lightnovel_title = chosen_lightnovel[0:60].strip()
-                lightnovel = next((tracked_lightnovel for tracked_lightnovel in self.tracked_lightnovels if tracked_lightnovel.title == lightnovel_title), None)
+                lightnovel = next((tracked_lightnovel for tracked_lightnovel in tracked_lightnovels if tracked_lightnovel.title == lightnovel_title), None)
     
                 if not lightnovel:
                     Log.warning(f"Could not find {lightnovel_title}")
@@ -176,24 +295,39 @@ class LightnovelManager:
                     self.book_action_menu(lightnovel)
 
     def book_action_menu(self, lightnovel: Lightnovel):
+        self.refresh(lightnovel)
         action = choose_action_for_manga_or_lightnovel()
         
         if action == "Modify last chapter read":
             last_read_chapter = modify_last_chapter_read(lightnovel)
             if last_read_chapter is not None:
-                lightnovel.last_read_chapter = last_read_chapter
+                with self.lock:
+                    lightnovel.last_read_chapter = last_read_chapter
                 Log.debug(f"Modified {lightnovel.title} last read chapter to {last_read_chapter}")
+                self.save_data()
 
         elif action == "Upload new chapters to Ebook Reader":
             self.chapters_download_menu(lightnovel)
 
     def chapters_download_menu(self, lightnovel: Lightnovel):
-        answer = get_chapters_download_count(lightnovel)
+        # The daemon may have already merged the next chapters
+        ready = ReadyCache.find("lightnovel", lightnovel.title, self.next_chapters(lightnovel))
+        answer = get_chapters_download_count(lightnovel, ready_count=len(ready["chapters"]) if ready else None)
                                         
         if answer != "Back":
             Cli.print("") # Just to get a clean page
 
-            chapters_to_download_count = int(answer)
+            chapters_to_download_count = int(answer.split()[0])
+
+            if ready and chapters_to_download_count == len(ready["chapters"]):
+                if self.upload_to_reader(lightnovel, ready["volumes"][0]["file"]):
+                    with self.lock:
+                        lightnovel.last_read_chapter += chapters_to_download_count
+                    self.save_data()
+                    ReadyCache.remove(ready["directory"])
+                input("Press enter to continue...")
+                return
+
             downloaded_chapters_folder = self.download_chapters_from_media_server(lightnovel, chapters_to_download_count)
 
             if downloaded_chapters_folder:
@@ -203,6 +337,8 @@ class LightnovelManager:
                     success = self.upload_to_reader(lightnovel, epub_file)
 
                     if success:
-                        lightnovel.last_read_chapter += chapters_to_download_count
+                        with self.lock:
+                            lightnovel.last_read_chapter += chapters_to_download_count
+                        self.save_data()
 
             input("Press enter to continue...")
\ No newline at end of file
@@ -1,40 +1,64 @@
 from rich.progress import Progress
-from typing import List
+from typing import Callable, List
+import asyncio
 import traceback
 import json
 import os
+import shutil
+import threading
 
 from books.models.manga import Manga
+from books.sync_schedule import SyncSchedule
 from books.converter import Converter
+from books.ready_cache import ReadyCache
 from connectivity.media_server import MediaServer
-from connectivity.ebook_reader import EbookReader
+from connectivity.ebook_reader import EbookReaderGroup
+from connectivity.prefetch import ChapterPrefetcher
+from managers.conversion_jobs import ConversionJobs
 from cli import Cli
 from cli.questions import choose_manga, choose_action_for_manga_or_lightnovel, modify_last_chapter_read, get_chapters_download_count
 from utils.log import Log
+from utils.throttle import BandwidthLimiter
 
-from config import TRACKED_MANGAS_FILE, DOWNLOADS_DIR
+from config import TRACKED_MANGAS_FILE, DOWNLOADS_DIR, PREFETCH_CHAPTERS
 
 class MangaManager:
 
     tracked_mangas: List[Manga] = []
 
     def __init__(self):
+        # Syncs may go on in the background (see CoverTheAir.update_books) and uploads update the last read chapter
+        # once they are over : tracked_mangas and their chapters are only changed while holding it
+        self.lock = threading.RLock()
+
         if not os.path.isfile(TRACKED_MANGAS_FILE):
             Log.debug(f"Creating {TRACKED_MANGAS_FILE}")
             with open(TRACKED_MANGAS_FILE, "w"): pass
 
+        self.load_data()
+
+    def load_data(self):
+        # Also used by the daemon to catch up with what the CLI saved in the meantime : if reading fails,
+        # what was loaded before is kept
+        tracked_mangas = []
+
         # First we read tracked mangas from the associated JSON file
         if os.stat(TRACKED_MANGAS_FILE).st_size != 0:
-            data = json.load(open(TRACKED_MANGAS_FILE, "r"))
+            with open(TRACKED_MANGAS_FILE, "r") as f:
+                data = json.load(f)
             for entry in data["mangas"]:
                 if not entry["missing"]:
-                    manga = Manga(entry["title"], entry["source"], entry["chapters"], entry["last_read_chapter"])
-                    self.tracked_mangas.append(manga)
-                    self.tracked_mangas = sorted(self.tracked_mangas, key=lambda manga: manga.title)
+                    manga = Manga(entry["title"], entry["source"], entry["chapters"], entry["last_read_chapter"], entry.get("last_new_chapter_at"), entry.get("last_synced_at"))
+                    tracked_mangas.append(manga)
+
+        with self.lock:
+            self.tracked_mangas = sorted(tracked_mangas, key=lambda manga: manga.title)
 
     #### ACTIONS ####
 
-    def update(self):
+    def update(self, full: bool = False, report: Callable = print):
+        # Cold titles are skipped until they are due (see SyncSchedule), unless full
+        # report() shows what changed, it doesn't print once the sync went on in the background (see CoverTheAir.update_books)
         media_server = MediaServer()
         media_server.connect()
         
@@ -45,17 +69,25 @@ class MangaManager:
 
             # We compare whether mangas are both tracked and downloaded on the media server or not
             mangas_in_media_server_titles = [manga["title"] for manga in mangas_in_media_server]
-            tracked_mangas_titles = [manga.title for manga in self.tracked_mangas]
+            with self.lock:
+                tracked_mangas = list(self.tracked_mangas)
+            tracked_mangas_titles = [manga.title for manga in tracked_mangas]
+            cold_count = 0
 
-            for tracked_manga in self.tracked_mangas:
+            for tracked_manga in tracked_mangas:
                 # First we handle the mangas that are already in our list and are on the media server
                 if tracked_manga.title in mangas_in_media_server_titles:
+                    if not full and not SyncSchedule.is_due(tracked_manga):
+                        cold_count += 1
+                        continue
+
                     chapters = media_server.list_manga_chapters(tracked_manga.title, tracked_manga.source)
-                    new_chapters = tracked_manga.update_chapters(chapters)
+                    with self.lock:
+                        new_chapters = tracked_manga.update_chapters(chapters)
 
                     if len(new_chapters) != 0:
                         Log.info(f"New chapters for {tracked_manga.title} : {', '.join(new_chapters)}")
-                        print(f"- {tracked_manga.title} => {len(new_chapters)} new chapters")
+                        report(f"- {tracked_manga.title} => {len(new_chapters)} new chapters")
                 
                 # Then we handle the mangas that we have in our list but are not on the media server anymore
                 else:
@@ -70,23 +102,52 @@ class MangaManager:
                         source=downloaded_manga["source"]
                     )
                     new_tracked_manga.update_chapters(media_server.list_manga_chapters(downloaded_manga["title"], downloaded_manga["source"]))
-                    self.tracked_mangas.append(new_tracked_manga)
+                    with self.lock:
+                        self.tracked_mangas.append(new_tracked_manga)
 
                     Log.info(f"Added new tracked manga : {new_tracked_manga.title}")
-                    print(f"- {new_tracked_manga.title} => **NEW**")
+                    report(f"- {new_tracked_manga.title} => **NEW**")
+
+            if cold_count:
+                Log.info(f"Skipped {cold_count} cold mangas, not due for a sync yet")
 
         except Exception:
             Log.error("Failed to sync mangas", traceback.format_exc())
 
         media_server.disconnect()
 
-    def download_chapters_from_media_server(self, manga: Manga, chapters_count: int):
+    def refresh(self, manga: Manga):
+        # Opened titles are synced right away, cold or not. When the background sync is on it too, whichever
+        # comes second waits for the other one to be done with it.
+        if manga.missing:
+            return
+
+        media_server = MediaServer()
+        media_server.connect()
+
+        try:
+            chapters = media_server.list_manga_chapters(manga.title, manga.source)
+            with self.lock:
+                new_chapters = manga.update_chapters(chapters)
+            if len(new_chapters) != 0:
+                Log.info(f"New chapters for {manga.title} : {', '.join(new_chapters)}")
+        except Exception:
+            Log.error(f"Failed to sync {manga.title}", traceback.format_exc())
+
+        media_server.disconnect()
+
+    def next_chapters(self, manga: Manga, chapters_count: int = None):
+        # The next unread chapters (all of them by default), a sync could reorder them in the meantime otherwise
+        with self.lock:
+            last_chapter = manga.last_read_chapter + chapters_count if chapters_count is not None else None
+            return manga.chapters[manga.last_read_chapter:last_chapter]
+
+    def download_chapters_from_media_server(self, manga: Manga, chapters_count: int, prefetcher: ChapterPrefetcher = None):
         if manga.missing:
             input(f"{manga.title} is missing from Media Server ! Press Enter to abort...")
             return None
         
         media_server = MediaServer()
-        media_server.connect()
     
         try:
             target_dir = os.path.join(DOWNLOADS_DIR, manga.title.replace(" ","_"))
@@ -94,21 +155,27 @@ class MangaManager:
             if not os.path.isdir(target_dir):
                 os.mkdir(target_dir)
 
-            chapters_to_download = []
-            for i in range(chapters_count):
-                chapter_id = manga.last_read_chapter + i
-                chapter_name = manga.chapters[chapter_id]
-                chapters_to_download.append(chapter_name)
+            chapters_to_download = self.next_chapters(manga, chapters_count)
 
-            Log.info(f"Downloading following chapters for {manga.title} : {', '.join(chapters_to_download)}")
+            # Chapters downloaded in the background while the user was choosing don't need to be downloaded again
+            if prefetcher:
+                prefetched_chapters = prefetcher.take(chapters_to_download, target_dir)
+                chapters_to_download = [chapter_name for chapter_name in chapters_to_download if chapter_name not in prefetched_chapters]
 
-            with Progress() as progress:
-                progress_bar_length = max(1000, len(chapters_to_download))
-                task = progress.add_task(f"[red]Downloading {len(chapters_to_download)} chapters for {manga.title}...", total=progress_bar_length)
+            if chapters_to_download:
+                media_server.connect()
+
+                Log.info(f"Downloading following chapters for {manga.title} : {', '.join(chapters_to_download)}")
+
+                with Progress() as progress:
+                    progress_bar_length = max(1000, len(chapters_to_download))
+                    task = progress.add_task(f"[red]Downloading {len(chapters_to_download)} chapters for {manga.title}...", total=progress_bar_length)
 
-                for chapter in chapters_to_download:
-                    media_server.download_manga_chapter(manga.title, manga.source, chapter, target_dir)
-                    progress.update(task, advance=progress_bar_length / len(chapters_to_download))
+                    # Chapters are downloaded concurrently, each on its own SFTP channel
+                    asyncio.run(media_server.download_manga_chapters(
+                        manga.title, manga.source, chapters_to_download, target_dir,
+                        on_downloaded=lambda chapter, success: progress.update(task, advance=progress_bar_length / len(chapters_to_download))
+                    ))
 
         except:
             Log.error(f"Failed to download chapters for {manga.title}", traceback.format_exc())
@@ -119,38 +186,118 @@ class MangaManager:
         print(" ") if target_dir else print("\n[-] Something went wrong when downloading chapters !")
         return target_dir
 
-    def upload_to_reader(self, manga: Manga, source_path: str):
-        reader = EbookReader()
+    def upload_ready_to_reader(self, manga: Manga, ready: dict):
+        # Volumes built beforehand by the daemon (see ReadyCache), only the upload is left.
+        # Returns the number of chapters sent, only counting the volumes before the first one that failed.
+        readers = EbookReaderGroup()
+        sent_chapters_count = 0
+
         try:
-            Log.info(f"Uploading {source_path} to Ebook Reader")
+            Log.info(f"Uploading {len(ready['chapters'])} ready chapters of {manga.title} to Ebook Reader")
+
+            readers.connect()
 
-            reader.connect()
-            success = reader.upload_book(manga.title, source_path)
+            with Progress() as progress:
+                for volume in ready["volumes"]:
+                    if not readers.upload_book(volume["title"], volume["file"], progress=progress):
+                        break
+                    sent_chapters_count += len(volume["chapters"])
 
         except Exception:
-            Log.error(f"Failed to upload {source_path} to Ebook Reader", traceback.format_exc())
-            success = False
-        
+            Log.error(f"Failed to upload {manga.title} to Ebook Reader", traceback.format_exc())
+
+        success = sent_chapters_count == len(ready["chapters"])
+        if success:
+            ReadyCache.remove(ready["directory"])
+
         print(" ") if success else print("\n[-] Something went wrong when uploading to Ebook Reader !")
 
-        reader.disconnect()
+        readers.disconnect()
+        return sent_chapters_count
+
+    def prepare_next_chapters(self, manga: Manga, chapters_count: int, limiter: BandwidthLimiter = None, build_workers: int = 1):
+        # Downloads and converts the next unread chapters into the ReadyCache, so that sending them only takes the upload.
+        # Returns whether they are ready.
+        chapters = self.next_chapters(manga, chapters_count)
+        if manga.missing or not chapters:
+            ReadyCache.discard("manga", manga.title)
+            return False
+
+        ready = ReadyCache.find("manga", manga.title, chapters)
+        if ready and ready["chapters"] == chapters:
+            ReadyCache.discard("manga", manga.title, keep=ready["directory"])
+            return True
+
+        ReadyCache.discard("manga", manga.title)
+        directory = ReadyCache.build_directory("manga", manga.title, chapters)
+
+        media_server = MediaServer()
+        media_server.connect()
+
+        try:
+            Log.info(f"Preparing following chapters for {manga.title} : {', '.join(chapters)}")
+            print(f"- {manga.title} => preparing {len(chapters)} chapters")
+
+            downloaded = asyncio.run(media_server.download_manga_chapters(
+                manga.title, manga.source, chapters, directory,
+                limiter=limiter
+            ))
+            # Not needed while converting
+            media_server.disconnect()
+
+            if not all(downloaded):
+                raise IOError(f"Could only download {sum(downloaded)} chapters out of {len(chapters)}")
+
+            volumes = Converter.merge_cbz_to_volumes(manga, directory, max_workers=build_workers)
+            if not volumes or not all(epub_file for _, epub_file, _ in volumes):
+                raise IOError(f"Could not convert chapters for {manga.title}")
+
+            # Only the EPUBs are kept, along with the chapters each one holds
+            ready_volumes = []
+            for title, epub_file, volume_chapters_count in volumes:
+                first_chapter = sum(len(volume["chapters"]) for volume in ready_volumes)
+                ready_volumes.append({"title": title, "file": epub_file, "chapters": chapters[first_chapter:first_chapter + volume_chapters_count]})
+
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                elif not name.endswith(".epub"):
+                    os.unlink(path)
+
+            ReadyCache.store(directory, chapters, ready_volumes)
+            success = True
+
+        except Exception:
+            Log.error(f"Failed to prepare chapters for {manga.title}", traceback.format_exc())
+            ReadyCache.remove(directory)
+            success = False
+
+        media_server.disconnect()
         return success
 
     def save_data(self):
         Log.info(f"Saving mangas to {TRACKED_MANGAS_FILE}")
 
         data = {"mangas": []}
-        for manga in self.tracked_mangas:
-            entry = {
-                "title": manga.title,
-                "source": manga.source,
-                "chapters": manga.chapters,
-                "last_read_chapter": manga.last_read_chapter,
-                "missing": manga.missing
-            }
-            data["mangas"].append(entry)
-        
-        json.dump(data, open(TRACKED_MANGAS_FILE, "w"))
+        # Titles being synced are saved either before or after their sync, not halfway through.
+        # The file is written aside then moved over it, the daemon may read it at any time (see Daemon).
+        with self.lock:
+            for manga in self.tracked_mangas:
+                entry = {
+                    "title": manga.title,
+                    "source": manga.source,
+                    "chapters": manga.chapters,
+                    "last_read_chapter": manga.last_read_chapter,
+                    "missing": manga.missing,
+                    "last_new_chapter_at": manga.last_new_chapter_at,
+                    "last_synced_at": manga.last_synced_at
+                }
+                data["mangas"].append(entry)
+
+            with open(TRACKED_MANGAS_FILE + ".tmp", "w") as f:
+                json.dump(data, f)
+            os.replace(TRACKED_MANGAS_FILE + ".tmp", TRACKED_MANGAS_FILE)
 
 
     #### MENUS ####
@@ -161,14 +308,16 @@ class MangaManager:
         while stay_in_menu:
 
             # User chooses a manga in the list of displayed tracked mangas
-            chosen_manga = choose_manga(self.tracked_mangas)
+            with self.lock:
+                tracked_mangas = list(self.tracked_mangas)
+            chosen_manga = choose_manga(tracked_mangas)
 
             if chosen_manga == "Back":
                 stay_in_menu = False
 
             else:
                 manga_title = chosen_manga[0:60].strip()
-                manga = next((tracked_manga for tracked_manga in self.tracked_mangas if tracked_manga.title == manga_title), None)
+                manga = next((tracked_manga for tracked_manga in tracked_mangas if tracked_manga.title == manga_title), None)
     
                 if not manga:
                     Log.warning(f"Could not find {manga_title}")
@@ -179,34 +328,77 @@ class MangaManager:
                     self.book_action_menu(manga)
 
     def book_action_menu(self, manga: Manga):
-        action = choose_action_for_manga_or_lightnovel()
-        
-        if action == "Modify last chapter read":
-            last_read_chapter = modify_last_chapter_read(manga)
-            if last_read_chapter is not None:
-                manga.last_read_chapter = last_read_chapter
-                Log.debug(f"Modified {manga.title} last read chapter to {last_read_chapter}")
+        self.refresh(manga)
+        prefetcher = self.prefetch_next_chapters(manga)
 
-        elif action == "Upload new chapters to Ebook Reader":
-            self.chapters_download_menu(manga)
+        try:
+            action = choose_action_for_manga_or_lightnovel()
+            
+            if action == "Modify last chapter read":
+                last_read_chapter = modify_last_chapter_read(manga)
+                if last_read_chapter is not None:
+                    with self.lock:
+                        manga.last_read_chapter = last_read_chapter
+                    Log.debug(f"Modified {manga.title} last read chapter to {last_read_chapter}")
+                    self.save_data()
+
+            elif action == "Upload new chapters to Ebook Reader":
+                self.chapters_download_menu(manga, prefetcher)
+
+        finally:
+            # Whatever wasn't used is cancelled and deleted
+            if prefetcher:
+                prefetcher.cancel()
+
+    def prefetch_next_chapters(self, manga: Manga):
+        # New chapters are usually sent right after opening a manga : they start downloading while the user is still choosing.
+        # Not needed when the daemon already prepared them.
+        chapters = self.next_chapters(manga, PREFETCH_CHAPTERS)
+        if manga.missing or not chapters or ReadyCache.find("manga", manga.title, chapters):
+            return None
 
-    def chapters_download_menu(self, manga: Manga):
-        answer = get_chapters_download_count(manga)
+        return ChapterPrefetcher(
+            chapters,
+            os.path.join(DOWNLOADS_DIR, ".prefetch", manga.title.replace(" ","_")),
+            lambda media_server, chapter_names, target_dir: media_server.download_manga_chapters(manga.title, manga.source, chapter_names, target_dir)
+        ).start()
+
+    def chapters_download_menu(self, manga: Manga, prefetcher: ChapterPrefetcher = None):
+        # Its last read chapter is only updated once the background job is over
+        if ConversionJobs.find(manga.title):
+            input(f"{manga.title} is already being sent in the background ! Press Enter to go back...")
+            return
+
+        # The daemon may have already built the next chapters
+        ready = ReadyCache.find("manga", manga.title, self.next_chapters(manga))
+        answer = get_chapters_download_count(manga, ready_count=len(ready["chapters"]) if ready else None)
                                         
         if answer != "Back":
             Cli.print("") # Just to get a clean page
 
-            chapters_to_download_count = int(answer)
-            downloaded_chapters_folder = self.download_chapters_from_media_server(manga, chapters_to_download_count)
+            chapters_to_download_count = int(answer.split()[0])
 
-            if downloaded_chapters_folder:
-                epub_file = Converter.merge_cbz_to_epub(manga, downloaded_chapters_folder)
+            if ready and chapters_to_download_count == len(ready["chapters"]):
+                sent_chapters_count = self.upload_ready_to_reader(manga, ready)
+                with self.lock:
+                    manga.last_read_chapter += sent_chapters_count
+                self.save_data()
+                input("Press enter to continue...")
+                return
 
-                if epub_file:
-                    success = self.upload_to_reader(manga, epub_file)
+            downloaded_chapters_folder = self.download_chapters_from_media_server(manga, chapters_to_download_count, prefetcher)
 
-                    if success:
-                        manga.last_read_chapter += chapters_to_download_count
+            if downloaded_chapters_folder:
+                # Chapters of the volumes that made it to the reader are read, even if a later volume failed
+                # Saved straight away, for the daemon (see Daemon)
+                def on_done(sent_chapters_count: int):
+                    with self.lock:
+                        manga.last_read_chapter += min(sent_chapters_count, chapters_to_download_count)
+                    self.save_data()
+
+                # Conversion and upload go on in the background, the user can keep browsing
+                ConversionJobs.submit(manga, downloaded_chapters_folder, on_done=on_done)
+                print(f"{manga.title} is being converted and sent in the background, see \"Background jobs\" in the main menu")
 
             input("Press enter to continue...")
 
@@ -0,0 +1,36 @@
+import pytest
+
+from benchmarks.environment import BenchmarkEnvironment
+from benchmarks.netem import EmulatedLink, NetworkConditions
+
+# Tests run against the local SFTP stand-ins of the benchmarks, reached through emulated links so that they can cut connections.
+# The configuration is exported through COTA_CONFIG when pytest starts, before the test modules import anything.
+environment = BenchmarkEnvironment(log_level="DEBUG")
+links = {}
+
+def pytest_configure(config):
+    environment.start()
+    links["media_server"] = EmulatedLink(environment.media_server).start()
+    links["ebook_reader"] = EmulatedLink(environment.ebook_reader).start()
+    environment.write_config(links["media_server"].port, links["ebook_reader"].port)
+
+def pytest_unconfigure(config):
+    for link in links.values():
+        link.stop()
+    environment.stop()
+
+@pytest.fixture
+def env():
+    return environment
+
+# Links behave again after each test
+
+@pytest.fixture
+def media_server_link():
+    yield links["media_server"]
+    links["media_server"].set_conditions(NetworkConditions())
+
+@pytest.fixture
+def reader_link():
+    yield links["ebook_reader"]
+    links["ebook_reader"].set_conditions(NetworkConditions())
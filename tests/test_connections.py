@@ -0,0 +1,31 @@
+from benchmarks.netem import NetworkConditions
+from connectivity.connections import ConnectionPool
+from connectivity.ebook_reader import EbookReader
+
+def test_connect_after_failed_warm_up(reader_link):
+    # The reader was asleep at launch : the connection opened in the background is cut during the handshake
+    reader_link.set_conditions(NetworkConditions(disconnect_after_bytes=1))
+    EbookReader().warm_up()
+
+    reader = EbookReader()
+    reader.connect()
+    try:
+        assert reader_link.disconnections == 1
+        assert reader.backend.is_connected()
+        assert reader.backend.listdir(reader.base_path) is not None
+    finally:
+        reader.disconnect()
+        ConnectionPool.close_all()
+
+def test_connect_takes_over_warmed_up_connection(reader_link):
+    warmed_up = EbookReader()
+    warmed_up.warm_up()
+
+    reader = EbookReader()
+    reader.connect()
+    try:
+        assert reader.backend is warmed_up.backend
+        assert reader.backend.is_connected()
+    finally:
+        reader.disconnect()
+        ConnectionPool.close_all()
@@ -0,0 +1,77 @@
+import os
+import random
+
+from benchmarks.environment import EBOOK_READER_BASE_PATH
+from benchmarks.netem import NetworkConditions
+from connectivity.connections import ConnectionPool
+from connectivity.delta import DELTA_BLOCK_SIZE
+from connectivity.ebook_reader import EbookReaderGroup, PARTIAL_SUFFIX
+
+def write_book(path, size, seed):
+    with open(path, "wb") as file:
+        file.write(random.Random(seed).randbytes(size))
+    return path
+
+def read(path):
+    with open(path, "rb") as file:
+        return file.read()
+
+def test_cut_send_keeps_previous_book(env, reader_link, tmp_path):
+    first_version = write_book(tmp_path / "first.epub", 1024 * 1024, seed=1)
+    # Smaller, so that it is sent whole rather than updated in place
+    second_version = write_book(tmp_path / "second.epub", 512 * 1024, seed=2)
+    target_path = os.path.join(env.reader_root, EBOOK_READER_BASE_PATH.lstrip("/"), "Cut_Book.epub")
+
+    readers = EbookReaderGroup()
+    readers.connect()
+    try:
+        assert readers.upload_book("Cut Book", first_version, quiet=True)
+    finally:
+        readers.disconnect()
+
+    # The reader goes out of reach in the middle of the next version
+    reader_link.set_conditions(NetworkConditions(disconnect_after_bytes=128 * 1024))
+    readers = EbookReaderGroup()
+    readers.connect()
+    try:
+        assert not readers.upload_book("Cut Book", second_version, quiet=True)
+    finally:
+        readers.disconnect()
+        ConnectionPool.close_all()
+
+    assert reader_link.disconnections == 1
+    assert read(target_path) == read(first_version)
+
+    # The next send goes through and replaces what was left of the cut one
+    readers = EbookReaderGroup()
+    readers.connect()
+    try:
+        assert readers.upload_book("Cut Book", second_version, quiet=True)
+    finally:
+        readers.disconnect()
+        ConnectionPool.close_all()
+
+    assert read(target_path) == read(second_version)
+    assert not os.path.exists(target_path + PARTIAL_SUFFIX)
+
+def test_grown_book_only_gets_its_changes(env, tmp_path):
+    # Like a volume getting new chapters : its metadata is rewritten and pages are appended
+    content = random.Random(4).randbytes(5 * DELTA_BLOCK_SIZE)
+    first_version = tmp_path / "first.epub"
+    first_version.write_bytes(content)
+    second_version = tmp_path / "second.epub"
+    second_version.write_bytes(content[:2 * DELTA_BLOCK_SIZE] + b"metadata" + content[2 * DELTA_BLOCK_SIZE + 8:] + random.Random(5).randbytes(DELTA_BLOCK_SIZE + DELTA_BLOCK_SIZE // 2))
+    target_path = os.path.join(env.reader_root, EBOOK_READER_BASE_PATH.lstrip("/"), "Grown_Book.epub")
+
+    readers = EbookReaderGroup()
+    readers.connect()
+    try:
+        assert readers.upload_book("Grown Book", str(first_version), quiet=True)
+        assert readers.upload_book("Grown Book", str(second_version), quiet=True)
+        # Only the rewritten block and the appended ones are written
+        assert readers.readers[0].bytes_saved == 4 * DELTA_BLOCK_SIZE
+    finally:
+        readers.disconnect()
+        ConnectionPool.close_all()
+
+    assert read(target_path) == read(second_version)
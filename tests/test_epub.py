@@ -0,0 +1,113 @@
+import os
+import queue
+import random
+import re
+import shutil
+import xml.etree.ElementTree as ElementTree
+import zipfile
+
+import PIL.Image
+import pytest
+from ebooklib import epub
+
+from books.formats.epub import EPubMaker, METADATA_FILES, StopException
+
+OPF_NAMESPACE = {"opf": "http://www.idpf.org/2007/opf"}
+
+def make_chapters(directory, first_chapter, chapters, pages, seed):
+    # Chapter folders of distinct pages, like the ones unzipped from .cbz files
+    rng = random.Random(seed)
+    for chapter in range(first_chapter, first_chapter + chapters):
+        chapter_directory = os.path.join(directory, f"Chapter {chapter}")
+        os.makedirs(chapter_directory)
+        for page in range(pages):
+            image = PIL.Image.new("L", (60, 90), 255)
+            image.putdata([rng.randint(0, 255) for _ in range(60 * 90)])
+            image.save(os.path.join(chapter_directory, f"{page + 1:03d}.jpg"), format="JPEG")
+    return directory
+
+def build(input_dir, file, base=None):
+    epub_maker = EPubMaker(master=None, input_dir=input_dir, file=file, name="Manga", author="Writer", wrap_pages=True,
+                           grayscale=False, max_width=None, max_height=None, dedup="exact", base=base)
+    return epub_maker
+
+@pytest.fixture
+def volume(tmp_path):
+    # A kept volume of 9 pages (image_0 to image_8) and a copy of it to append 6 pages to
+    base_file = str(tmp_path / "base.epub")
+    base_maker = build(make_chapters(str(tmp_path / "base"), 1, 3, 3, seed=1), base_file)
+    base_maker.run()
+
+    grown_file = str(tmp_path / "grown.epub")
+    shutil.copyfile(base_file, grown_file)
+    new_chapters = make_chapters(str(tmp_path / "new"), 4, 2, 3, seed=2)
+    return base_file, grown_file, new_chapters, base_maker.snapshot()
+
+def test_append_gives_a_valid_epub(volume):
+    base_file, grown_file, new_chapters, snapshot = volume
+    build(new_chapters, grown_file, base=snapshot).run()
+
+    assert not os.path.exists(grown_file + ".tmp")
+    with zipfile.ZipFile(grown_file) as grown_zip:
+        assert grown_zip.testzip() is None
+        infos = grown_zip.infolist()
+        names = [info.filename for info in infos]
+        assert names[0] == "mimetype" and infos[0].compress_type == zipfile.ZIP_STORED
+        assert len(names) == len(set(names))
+        # Metadata files come last, once
+        assert names[-len(METADATA_FILES):] == METADATA_FILES
+
+        package = ElementTree.fromstring(grown_zip.read("package.opf"))
+        manifest = {item.get("id"): item.get("href") for item in package.iterfind("opf:manifest/opf:item", OPF_NAMESPACE)}
+        spine = [itemref.get("idref") for itemref in package.iterfind("opf:spine/opf:itemref", OPF_NAMESPACE)]
+
+    assert all(href in names for href in manifest.values())
+    assert all(idref in manifest for idref in spine)
+    assert len(spine) == 15
+
+    # Appended images are numbered like the existing ones
+    image_ids = [item_id for item_id in manifest if re.fullmatch(r"image_\d+", item_id)]
+    assert image_ids == [f"image_{count}" for count in range(15)]
+
+    # The cover is one of the pages
+    book = epub.read_epub(grown_file)
+    assert len([item for item in book.get_items() if item.media_type == "image/jpeg"]) == 15
+
+def test_append_keeps_the_existing_bytes(volume):
+    # Only what follows the existing pages differs, which is what the delta upload relies on
+    base_file, grown_file, new_chapters, snapshot = volume
+    build(new_chapters, grown_file, base=snapshot).run()
+
+    with zipfile.ZipFile(base_file) as base_zip:
+        pages_end = min(info.header_offset for info in base_zip.infolist() if info.filename in METADATA_FILES)
+    with open(base_file, "rb") as base, open(grown_file, "rb") as grown:
+        assert grown.read(pages_end) == base.read(pages_end)
+
+def test_failed_append_leaves_the_epub_as_it_was(volume):
+    base_file, grown_file, new_chapters, snapshot = volume
+    epub_maker = build(new_chapters, grown_file, base=snapshot)
+    epub_maker.stop()
+
+    with pytest.raises(StopException):
+        epub_maker.make_epub()
+
+    assert not os.path.exists(grown_file + ".tmp")
+    with open(base_file, "rb") as base, open(grown_file, "rb") as grown:
+        assert grown.read() == base.read()
+
+def test_failed_build_reports_to_its_master(tmp_path):
+    # Like VolumeBuild, the master runs the callbacks from its own thread, once the exception is gone
+    class Master:
+        generic_queue = queue.Queue()
+
+        def showerror(self, title, message, stacktrace=""):
+            self.error = (message, stacktrace)
+
+    master = Master()
+    EPubMaker(master=master, input_dir=str(tmp_path / "missing"), file=str(tmp_path / "missing.epub"), name="Manga", author="Writer",
+              wrap_pages=True, grayscale=False, max_width=None, max_height=None).run()
+    master.generic_queue.get_nowait()()
+
+    message, stacktrace = master.error
+    assert message.startswith("The following error was thrown")
+    assert "Traceback" in stacktrace
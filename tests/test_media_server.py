@@ -0,0 +1,38 @@
+import os
+import random
+
+from benchmarks.library import MANGAS_DIR
+from benchmarks.netem import NetworkConditions
+from config import MEDIA_SERVER_PATH_TO_MANGAS
+from connectivity.connections import ConnectionPool
+from connectivity.media_server import MediaServer
+
+# Nothing resumes a cut transfer : it is reported as failed, and getting the file again from a new connection gives all of it
+
+def test_get_again_after_cut_transfer(env, media_server_link, tmp_path):
+    content = random.Random(3).randbytes(1024 * 1024)
+    with open(os.path.join(env.library_root, MANGAS_DIR, "cut.cbz"), "wb") as file:
+        file.write(content)
+    source_path = MEDIA_SERVER_PATH_TO_MANGAS + "/cut.cbz"
+    target_path = str(tmp_path / "cut.cbz")
+
+    media_server_link.set_conditions(NetworkConditions(disconnect_after_bytes=256 * 1024))
+    media_server = MediaServer()
+    media_server.connect()
+    try:
+        assert not media_server.get(source_path, target_path)
+        assert media_server_link.disconnections == 1
+    finally:
+        media_server.disconnect()
+        ConnectionPool.close_all()
+
+    media_server = MediaServer()
+    media_server.connect()
+    try:
+        assert media_server.get(source_path, target_path)
+    finally:
+        media_server.disconnect()
+        ConnectionPool.close_all()
+
+    with open(target_path, "rb") as file:
+        assert file.read() == content
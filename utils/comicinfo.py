@@ -1,26 +1,62 @@
 import xml.etree.ElementTree as ET
 import traceback
+from typing import IO, Dict
 
 from utils.log import Log
 
 class ComicInfo:
 
     path: str
-    data: ET.Element = None
+    writer: str = ""
+    series: str = ""
+    number: str = ""
+    pages: Dict[int, dict] = None  # Page index => {"width", "height", "size"}
 
-    def __init__(self, path: str):
-        try:
-            self.path = path
+    def __init__(self, path: str, file: IO = None):
+        # file allows parsing a ComicInfo.xml without extracting it (e.g. a .cbz member), path is then only used in logs
+        self.path = path
+        self.pages = {}
+        self.found_writer = False
 
-            with open(path, "r") as f:
-                content = f.read()
-                self.data = ET.fromstring(content)
+        try:
+            if file:
+                self.parse(file)
+            else:
+                with open(path, "rb") as f:
+                    self.parse(f)
         except Exception:
             Log.error(f"Failed to parse {path} as a ComicInfo.xml file", traceback.format_exc())
 
-    def get_writer(self):
+    def parse(self, file: IO):
+        # Streaming parse : elements are dropped as soon as they are read, so long Pages lists never stay in memory
+        for _, element in ET.iterparse(file, events=("end",)):
+            tag = element.tag.rsplit("}", 1)[-1]
+
+            if tag == "Writer":
+                self.writer = (element.text or "").strip()
+                self.found_writer = True
+            elif tag == "Series":
+                self.series = (element.text or "").strip()
+            elif tag == "Number":
+                self.number = (element.text or "").strip()
+            elif tag == "Page":
+                self.add_page(element)
+
+            element.clear()
+
+    def add_page(self, element: ET.Element):
         try:
-            return self.data.find('Writer').text
-        except:
+            index = int(element.get("Image"))
+            width = int(element.get("ImageWidth"))
+            height = int(element.get("ImageHeight"))
+        except (TypeError, ValueError):
+            # Page without usable dimensions (they are optional)
+            return
+
+        size = element.get("ImageSize")
+        self.pages[index] = {"width": width, "height": height, "size": int(size) if size and size.isdigit() else None}
+
+    def get_writer(self):
+        if not self.found_writer:
             Log.warning(f"Couldn't find Writer in provided ComicInfo.xml ({self.path})")
-            return ""
\ No newline at end of file
+        return self.writer
@@ -1,28 +1,69 @@
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import atexit
 import logging
+import queue
 
-from config import LOGFILE, LOG_LEVEL
+from config import LOGFILE, LOG_LEVEL, LOG_MAX_SIZE, LOG_BACKUPS
 
-# We re-create the logfile at each execution (to avoid infinite logfile)
-with open(LOGFILE, "w") as f: pass
+# Records are only queued by whoever logs, a background thread formats and writes them to the logfile.
+# The logfile is kept across executions and rotated once it reaches LOG_MAX_SIZE (LOG_BACKUPS previous ones are kept)
+def open_logfile(path: str):
+    file_handler = RotatingFileHandler(path, maxBytes=LOG_MAX_SIZE, backupCount=LOG_BACKUPS, encoding="utf-8", delay=True)
+    file_handler.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+    return file_handler
+
+class RawQueueHandler(QueueHandler):
+    # QueueHandler formats records before queuing them, the listener thread does it instead
+    def prepare(self, record: logging.LogRecord):
+        return record
+
+log_queue = queue.SimpleQueue()
+listener = QueueListener(log_queue, open_logfile(LOGFILE))
+listener.start()
+# Whatever is still queued is written before exiting
+atexit.register(listener.stop)
 
 # We set up the logging globally
 level = getattr(logging, LOG_LEVEL.upper(), logging.DEBUG)
-logging.basicConfig(filename=LOGFILE, filemode='a', format='%(levelname)s: %(message)s', level=level)
+logging.basicConfig(handlers=[RawQueueHandler(log_queue)], level=level)
 logging.getLogger('paramiko.transport').setLevel(logging.ERROR)
 
+logger = logging.getLogger()
+
 class Log:
+    # args are %-style, only merged into msg if the record is written : e.g. Log.debug("Found %d chapters for %s", count, title)
+    # Messages costly to build are guarded with debug_enabled()
+
+    @classmethod
+    def use_logfile(self, path: str):
+        # Processes running next to the CLI (i.e. the daemon) need their own logfile : when one of them rotates
+        # a shared one, the other keeps writing to the renamed file. Called before anything is logged.
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+        listener.handlers = (open_logfile(path),)
+        listener.start()
+
+    @classmethod
+    def debug_enabled(self):
+        return logger.isEnabledFor(logging.DEBUG)
+
     @classmethod
-    def info(self, msg: str):
-        logging.info(msg)
+    def info(self, msg: str, *args):
+        logger.info(msg, *args)
 
     @classmethod
-    def debug(self, msg: str):
-        logging.debug(msg)
+    def debug(self, msg: str, *args):
+        logger.debug(msg, *args)
 
     @classmethod
-    def warning(self, msg: str):
-        logging.warning(msg)
+    def warning(self, msg: str, *args):
+        logger.warning(msg, *args)
 
     @classmethod
-    def error(self, msg: str, stacktrace: str):
-        logging.error(msg + "\n\n" + stacktrace)
\ No newline at end of file
+    def error(self, msg: str, stacktrace: str, *args):
+        # Without args, msg is written as is (it may already contain a %)
+        if args:
+            logger.error(msg + "\n\n%s", *args, stacktrace)
+        else:
+            logger.error(msg + "\n\n" + stacktrace)
@@ -0,0 +1,168 @@
+import cProfile
+import os
+import threading
+import time
+import traceback
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+
+from config import PROFILE, PROFILES_DIR
+from utils.log import Log
+
+TOP_ALLOCATIONS_COUNT = 25
+TRACEMALLOC_FRAMES = 5
+
+class ProfilingStage:
+
+    name: str
+    cpu_profiler: cProfile.Profile = None
+    start_snapshot: tracemalloc.Snapshot = None
+    peak: int = 0
+
+    def __init__(self, name: str):
+        self.name = name
+
+
+# Runs named stages under cProfile and tracemalloc and dumps the results into PROFILES_DIR.
+# Stages can be nested : the enclosing stage is paused while an inner one runs, so each .pstats file only covers its own stage.
+class Profiler:
+
+    enabled: bool = PROFILE
+    run_id: str = time.strftime("%Y%m%d-%H%M%S")
+    stage_count: int = 0
+    running_stages: int = 0
+    started_tracemalloc: bool = False
+    lock = threading.Lock()
+    local = threading.local()
+
+    @classmethod
+    def enable(self):
+        self.enabled = True
+
+    @classmethod
+    @contextmanager
+    def stage(self, name: str):
+        if not self.enabled:
+            yield
+            return
+
+        stages = self._stages()
+        stage = ProfilingStage(name)
+
+        try:
+            self._start_stage(stage, stages[-1] if stages else None)
+        except Exception:
+            Log.error(f"Failed to start profiling stage {name}", traceback.format_exc())
+            self._release_tracemalloc()
+            yield
+            return
+
+        stages.append(stage)
+        try:
+            yield
+        finally:
+            stages.pop()
+            try:
+                self._stop_stage(stage, stages[-1] if stages else None)
+            except Exception:
+                Log.error(f"Failed to write profiling results for stage {name}", traceback.format_exc())
+            finally:
+                self._release_tracemalloc()
+
+    @classmethod
+    def profiled(self, name: str):
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @classmethod
+    def _stages(self):
+        if not hasattr(self.local, "stages"):
+            self.local.stages = []
+        return self.local.stages
+
+    @classmethod
+    def _start_stage(self, stage: ProfilingStage, parent: ProfilingStage):
+        with self.lock:
+            self.running_stages += 1
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+                self.started_tracemalloc = True
+
+        # The enclosing stage keeps its own peak and stops collecting CPU samples until we are done
+        if parent:
+            parent.peak = max(parent.peak, tracemalloc.get_traced_memory()[1])
+            if parent.cpu_profiler:
+                parent.cpu_profiler.disable()
+
+        tracemalloc.reset_peak()
+        stage.start_snapshot = tracemalloc.take_snapshot()
+
+        stage.cpu_profiler = cProfile.Profile()
+        try:
+            stage.cpu_profiler.enable()
+        except ValueError:
+            # Another profiler is already running (e.g. a stage in another thread on Python 3.12+)
+            Log.warning(f"Could not start CPU profiling for stage {stage.name}, only memory will be profiled")
+            stage.cpu_profiler = None
+
+    @classmethod
+    def _stop_stage(self, stage: ProfilingStage, parent: ProfilingStage):
+        if stage.cpu_profiler:
+            stage.cpu_profiler.disable()
+
+        current, peak = tracemalloc.get_traced_memory()
+        peak = max(stage.peak, peak)
+        end_snapshot = tracemalloc.take_snapshot()
+
+        with self.lock:
+            self.stage_count += 1
+            basename = f"{self.run_id}-{self.stage_count:03d}-{stage.name}"
+
+        os.makedirs(PROFILES_DIR, exist_ok=True)
+
+        if stage.cpu_profiler:
+            pstats_file = os.path.join(PROFILES_DIR, basename + ".pstats")
+            stage.cpu_profiler.dump_stats(pstats_file)
+            Log.info(f"Wrote CPU profile of {stage.name} to {pstats_file}")
+
+        snapshot_filters = [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, cProfile.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>")
+        ]
+        end_snapshot = end_snapshot.filter_traces(snapshot_filters)
+        allocations = end_snapshot.compare_to(stage.start_snapshot.filter_traces(snapshot_filters), "lineno")
+
+        memory_file = os.path.join(PROFILES_DIR, basename + ".memory.txt")
+        with open(memory_file, "w") as f:
+            f.write(f"Stage: {stage.name}\n")
+            f.write(f"Peak traced memory: {peak / 1024 / 1024:.2f} MiB\n")
+            f.write(f"Traced memory at the end of the stage: {current / 1024 / 1024:.2f} MiB\n\n")
+            f.write(f"Top {TOP_ALLOCATIONS_COUNT} allocation sites (compared to the start of the stage):\n")
+            for allocation in allocations[:TOP_ALLOCATIONS_COUNT]:
+                f.write(f"{allocation}\n")
+
+        end_snapshot.dump(os.path.join(PROFILES_DIR, basename + ".tracemalloc"))
+        Log.info(f"Wrote memory profile of {stage.name} to {memory_file}")
+
+        # Give the enclosing stage the peak we reached and let it collect CPU samples again
+        if parent:
+            parent.peak = max(parent.peak, peak)
+            tracemalloc.reset_peak()
+            if parent.cpu_profiler:
+                parent.cpu_profiler.enable()
+
+    @classmethod
+    def _release_tracemalloc(self):
+        with self.lock:
+            self.running_stages -= 1
+            if self.running_stages == 0 and self.started_tracemalloc:
+                tracemalloc.stop()
+                self.started_tracemalloc = False
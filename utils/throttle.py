@@ -0,0 +1,41 @@
+import threading
+import time
+
+class BandwidthLimiter:
+    # Keeps transfers under bytes_per_second overall (0 for no limit), however many of them run at the same time.
+    # Its progress_callback is given to the transfers : it sleeps in the transferring thread as long as needed.
+    # Downloads only ask for the next chunk once it returns (see AsyncTransport.get), or the network isn't limited at all.
+
+    def __init__(self, bytes_per_second: int):
+        self.bytes_per_second = bytes_per_second
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.next_slot = time.monotonic()
+
+    def consume(self, size: int):
+        if not self.bytes_per_second or size <= 0:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            self.next_slot = max(self.next_slot, now) + size / self.bytes_per_second
+            delay = self.next_slot - now
+
+        if delay > 0:
+            time.sleep(delay)
+
+    def progress_callback(self, transferred: int, total: int):
+        # Transfers report the bytes transferred so far, each thread keeps track of the file it is transferring
+        previous = getattr(self.local, "transferred", 0)
+        if transferred < previous:
+            previous = 0
+
+        self.consume(transferred - previous)
+        self.local.transferred = 0 if transferred >= total else transferred
+
+    def reset(self):
+        # Once the transfer of the calling thread is over, even if it failed halfway
+        self.local.transferred = 0
+
+    def is_limiting(self):
+        return self.bytes_per_second > 0